@@ -0,0 +1,269 @@
+"""
+Benchmarks for encoding and decoding bencode.
+
+Measures throughput, per-message latency and peak memory allocated per
+message for a corpus of message shapes that resemble real nREPL traffic.
+Needs no nREPL server.
+
+Run it from the directory that contains the tutkain package (for example,
+your Sublime Text Packages directory):
+
+    $ python -m tutkain.bench.bench_bencode --output before.json
+    $ python -m tutkain.bench.bench_bencode --output after.json --compare before.json
+
+Pass --quick to skip the largest messages.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from tutkain import bencode
+
+
+SESSION = '7c3a2b1e-5d0c-4f6a-9b8e-2a1d3c4b5e6f'
+
+
+def eval_ack():
+    return {'id': 42, 'ns': 'user', 'session': SESSION, 'value': '6'}
+
+
+def status_done():
+    return {'id': 42, 'session': SESSION, 'status': ['done']}
+
+
+def describe():
+    ops = [
+        'add-middleware', 'clone', 'close', 'completions', 'describe', 'eval',
+        'interrupt', 'load-file', 'lookup', 'ls-middleware', 'ls-sessions',
+        'sideloader-provide', 'sideloader-start', 'stdin', 'swap-middleware'
+    ]
+
+    return {
+        'aux': {'current-ns': 'user'},
+        'id': 3,
+        'ops': {op: {} for op in ops},
+        'session': SESSION,
+        'status': ['done'],
+        'versions': {
+            'clojure': {
+                'incremental': 1,
+                'major': 1,
+                'minor': 10,
+                'version-string': '1.10.1'
+            },
+            'java': {
+                'major': '11',
+                'minor': '0',
+                'version-string': '11.0.7'
+            },
+            'nrepl': {
+                'major': 0,
+                'minor': 7,
+                'version-string': '0.7.0'
+            }
+        }
+    }
+
+
+def out(size):
+    line = '{:0>78}\n'.format('x')
+    return lambda: {
+        'id': 42,
+        'out': (line * (size // len(line) + 1))[:size],
+        'session': SESSION
+    }
+
+
+def nested(depth):
+    def build():
+        value = {'leaf': [1, 'two']}
+
+        for n in range(depth):
+            value = [{'n': n, 'next': value}]
+
+        return {'id': 42, 'session': SESSION, 'value': value}
+
+    return build
+
+
+KB = 1024
+MB = 1024 * KB
+
+CORPUS = [
+    ('eval-ack', eval_ack),
+    ('status-done', status_done),
+    ('describe', describe),
+    ('out-10kb', out(10 * KB)),
+    ('out-1mb', out(1 * MB)),
+    ('out-50mb', out(50 * MB)),
+    ('nested-100', nested(100))
+]
+
+LARGE = {'out-50mb'}
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+
+def measure(f, min_time, min_runs):
+    """Call `f` until at least `min_time` seconds and `min_runs` calls have
+    passed. Return the duration of every call in seconds."""
+    samples = []
+    started = time.perf_counter()
+
+    while len(samples) < min_runs or time.perf_counter() - started < min_time:
+        start = time.perf_counter()
+        f()
+        samples.append(time.perf_counter() - start)
+
+    return samples
+
+
+def peak_allocation(f):
+    """Return the peak number of bytes allocated during one call to `f`."""
+    tracemalloc.start()
+
+    try:
+        f()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def summarize(samples, size):
+    total = sum(samples)
+
+    return {
+        'runs': len(samples),
+        'mean_us': total / len(samples) * 1e6,
+        'p50_us': percentile(samples, 50) * 1e6,
+        'p95_us': percentile(samples, 95) * 1e6,
+        'mb_per_s': size * len(samples) / total / MB if total else None
+    }
+
+
+def decode_chunked(data):
+    """Decode `data` the way Client.recv_loop does, one socket read worth of
+    bytes at a time."""
+    def run():
+        decoder = bencode.Decoder(lazy=True)
+
+        with memoryview(data) as view:
+            for i in range(0, len(data), bencode.CHUNK_SIZE):
+                decoder.feed(view[i:i + bencode.CHUNK_SIZE])
+
+                for _ in decoder:
+                    pass
+
+    return run
+
+
+def bench(name, build, min_time, min_runs):
+    message = build()
+    encoder = bencode.Encoder()
+    data = bencode.encode(message)
+    size = len(data)
+
+    cases = [
+        ('encode', lambda: encoder.encode(message)),
+        ('decode', lambda: bencode.decode(data)),
+        ('decode-chunked', decode_chunked(data))
+    ]
+
+    results = []
+
+    for operation, f in cases:
+        result = {'shape': name, 'operation': operation, 'bytes': size}
+        result.update(summarize(measure(f, min_time, min_runs), size))
+        result['peak_alloc_bytes'] = peak_allocation(f)
+        results.append(result)
+        print(
+            '{shape:<12} {operation:<15} {bytes:>10} B {mean_us:>12.1f} us '
+            '{p95_us:>12.1f} us p95 {peak_alloc_bytes:>11} B peak'.format(**result),
+            file=sys.stderr
+        )
+
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL
+        ).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, path):
+    with open(path, 'r') as file:
+        baseline = {
+            (r['shape'], r['operation']): r for r in json.load(file)['results']
+        }
+
+    for result in results:
+        before = baseline.get((result['shape'], result['operation']))
+
+        if before:
+            print(
+                '{:<12} {:<15} {:>6.2f}x time {:>6.2f}x peak alloc'.format(
+                    result['shape'],
+                    result['operation'],
+                    result['mean_us'] / before['mean_us'],
+                    result['peak_alloc_bytes'] / max(before['peak_alloc_bytes'], 1)
+                ),
+                file=sys.stderr
+            )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('--output', help='write JSON results into this file')
+    parser.add_argument('--compare', help='compare against earlier JSON results')
+    parser.add_argument('--quick', action='store_true', help='skip the largest messages')
+    parser.add_argument('--shape', action='append', help='only run these shapes')
+    parser.add_argument('--min-time', type=float, default=0.5)
+    parser.add_argument('--min-runs', type=int, default=5)
+    args = parser.parse_args(argv)
+
+    results = []
+
+    for name, build in CORPUS:
+        if args.quick and name in LARGE:
+            continue
+
+        if args.shape and name not in args.shape:
+            continue
+
+        results.extend(bench(name, build, args.min_time, args.min_runs))
+
+    report = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.time(),
+        'results': results
+    }
+
+    if args.compare:
+        compare(results, args.compare)
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
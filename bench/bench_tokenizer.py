@@ -0,0 +1,109 @@
+"""
+Benchmarks for scanning large Clojure files outside of the editor.
+
+Measures how long it takes to tokenize a file, to find its top-level forms
+and to build the structure index of it, and how long finding the form
+around a point takes once the index exists.
+
+Run it from the directory that contains the tutkain package (for example,
+your Sublime Text Packages directory):
+
+    $ python -m tutkain.bench.bench_tokenizer --file core.clj
+"""
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+
+from tutkain import forms
+from tutkain import structure
+from tutkain import tokenizer
+from tutkain.bench.bench_bencode import git_revision, measure, percentile
+
+
+# A top-level form with a bit of everything in it.
+FORM = '''
+(defn f{n}
+  "Does things with \\"x\\" (and y)."
+  [x & {:keys [y] :or {y \\(}}]
+  ;; A comment with (brackets
+  (let [z #"[()]+" w #{1 2 3}]
+    (map #(str % \\) y) (re-seq z x))))
+'''
+
+
+def generate(lines):
+    """Return Clojure source code at least `lines` lines long."""
+    parts = []
+    n = 0
+
+    # FORM is full of braces, so it can't go through str.format.
+    while n * FORM.count('\n') < lines:
+        parts.append(FORM.replace('{n}', str(n)))
+        n += 1
+
+    return '(ns bench.core)\n' + ''.join(parts)
+
+
+def summarize(name, samples):
+    result = {
+        'benchmark': name,
+        'runs': len(samples),
+        'mean_us': sum(samples) / len(samples) * 1e6,
+        'p50_us': percentile(samples, 50) * 1e6,
+        'p95_us': percentile(samples, 95) * 1e6
+    }
+
+    print('{benchmark:<16} {mean_us:>12.1f} us mean {p95_us:>12.1f} us p95'.format(**result), file=sys.stderr)
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('--file', help='benchmark this file instead of generated code')
+    parser.add_argument('--lines', type=int, default=5000, help='how long the generated code is')
+    parser.add_argument('--output', help='write JSON results into this file')
+    args = parser.parse_args(argv)
+
+    if args.file:
+        with open(args.file, 'r') as file:
+            text = file.read()
+    else:
+        text = generate(args.lines)
+
+    index = structure.Index(text)
+    points = [random.randrange(len(text)) for _ in range(1000)]
+
+    def form_at():
+        for point in points:
+            index.form_at(point)
+
+    results = [
+        summarize('tokenize', measure(lambda: list(tokenizer.tokenize(text)), 1, 5)),
+        summarize('top-level forms', measure(lambda: forms.top_level_forms(text), 1, 5)),
+        summarize('index', measure(lambda: structure.Index(text), 1, 5)),
+        summarize('form_at x 1000', measure(form_at, 1, 5))
+    ]
+
+    report = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.time(),
+        'size': len(text),
+        'lines': text.count('\n'),
+        'results': results
+    }
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
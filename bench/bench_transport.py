@@ -0,0 +1,135 @@
+"""
+Benchmarks for the round-trip latency of evaluations over each transport.
+
+Starts a stand-in nREPL server (tests/fake_server.py) and measures how long
+it takes from sending an `eval` op to getting its `done` response, one op
+at a time and with ops pipelined, over:
+
+- TCP with Nagle's algorithm on, the way sockets start out
+- TCP with TCP_NODELAY on both ends
+- a Unix domain socket
+
+Run it from the directory that contains the tutkain package (for example,
+your Sublime Text Packages directory):
+
+    $ python -m tutkain.bench.bench_transport --output transport.json
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+from tutkain.bench.bench_bencode import git_revision, percentile
+from tutkain.repl import Client
+from tutkain.tests.fake_server import FakeServer
+
+
+def tcp(nodelay):
+    def start():
+        server = FakeServer(nodelay=nodelay).start()
+        return server, Client(*server.address, nodelay=nodelay).go()
+
+    return start
+
+
+def unix():
+    path = os.path.join(tempfile.mkdtemp(), 'nrepl.sock')
+    server = FakeServer(path=path).start()
+    return server, Client('localhost', path).go()
+
+
+TRANSPORTS = [
+    ('tcp', tcp(False)),
+    ('tcp-nodelay', tcp(True)),
+    ('unix', unix)
+]
+
+
+def sequential(session, runs):
+    """Send `runs` ops, each once the one before it is done. Return the
+    round-trip time of every op in seconds."""
+    samples = []
+
+    for n in range(runs):
+        start = time.perf_counter()
+        session.request({'op': 'eval', 'code': str(n)}).result(timeout=5)
+        samples.append(time.perf_counter() - start)
+
+    return samples
+
+
+def pipelined(session, runs):
+    """Send `runs` ops at once, eight in flight at a time. Return the
+    time it took for all of them to be done in seconds, per op."""
+    start = time.perf_counter()
+    futures = session.request_all([{'op': 'eval', 'code': str(n)} for n in range(runs)])
+
+    for future in futures:
+        future.result(timeout=5)
+
+    return [(time.perf_counter() - start) / runs]
+
+
+def summarize(samples):
+    return {
+        'runs': len(samples),
+        'mean_us': sum(samples) / len(samples) * 1e6,
+        'p50_us': percentile(samples, 50) * 1e6,
+        'p95_us': percentile(samples, 95) * 1e6
+    }
+
+
+def bench(name, start, runs):
+    server, client = start()
+    results = []
+
+    try:
+        session = client.clone_session(timeout=5)
+
+        for mode, f in [('sequential', sequential), ('pipelined', pipelined)]:
+            result = {'transport': name, 'mode': mode}
+            result.update(summarize(f(session, runs)))
+            results.append(result)
+            print(
+                '{transport:<12} {mode:<11} {mean_us:>10.1f} us mean {p95_us:>10.1f} us p95'.format(**result),
+                file=sys.stderr
+            )
+    finally:
+        client.halt()
+        server.stop()
+
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('--output', help='write JSON results into this file')
+    parser.add_argument('--runs', type=int, default=200)
+    args = parser.parse_args(argv)
+
+    results = []
+
+    for name, start in TRANSPORTS:
+        results.extend(bench(name, start, args.runs))
+
+    report = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.time(),
+        'results': results
+    }
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+"""
+A load generator for Client and Session.
+
+Starts a stand-in nREPL server (tests/fake_server.py), clones N sessions on
+one connection, and sends M evaluations from each session, at most C of
+them in flight per session at a time. Reports throughput, round-trip
+latency per op (from the client's latency tracker) and memory.
+
+Run it from the directory that contains the tutkain package (for example,
+your Sublime Text Packages directory):
+
+    $ python -m tutkain.bench.loadgen --sessions 8 --ops 1000 --concurrency 16
+    $ python -m tutkain.bench.loadgen --out-size 65536 --chunk-size 4096
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from tutkain.bench.bench_bencode import git_revision
+from tutkain.repl import Client
+from tutkain.tests.fake_server import FakeServer
+
+
+def run(args):
+    path = os.path.join(tempfile.mkdtemp(), 'nrepl.sock') if args.unix else None
+
+    server = FakeServer(
+        path=path,
+        nodelay=True,
+        delay=args.delay,
+        out_size=args.out_size,
+        chunk_size=args.chunk_size
+    ).start()
+
+    tracemalloc.start()
+
+    try:
+        client = Client(*server.address).go(timeout=5)
+        sessions, _ = client.handshake(sessions=args.sessions, timeout=5)
+
+        started = time.perf_counter()
+
+        futures = [
+            future
+            for session in sessions
+            for future in session.request_all(
+                [{'op': 'eval', 'code': str(n)} for n in range(args.ops)],
+                max_in_flight=args.concurrency
+            )
+        ]
+
+        failed = 0
+
+        for future in futures:
+            try:
+                future.result(timeout=args.timeout)
+            except Exception:
+                failed += 1
+
+        elapsed = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+        stats = client.stats()
+        client.halt()
+    finally:
+        tracemalloc.stop()
+        server.stop()
+
+    ops = len(futures)
+
+    return {
+        'sessions': args.sessions,
+        'ops_per_session': args.ops,
+        'concurrency': args.concurrency,
+        'out_size': args.out_size,
+        'chunk_size': args.chunk_size,
+        'delay': args.delay,
+        'transport': 'unix' if args.unix else 'tcp',
+        'ops': ops,
+        'failed': failed,
+        'seconds': elapsed,
+        'ops_per_s': ops / elapsed,
+        'mb_per_s': ops * args.out_size / elapsed / (1024 * 1024),
+        'latency': stats['latency'],
+        'recvq': stats['recvq'],
+        'peak_alloc_bytes': peak,
+        # Kilobytes on Linux, bytes on macOS.
+        'max_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('--output', help='write JSON results into this file')
+    parser.add_argument('--sessions', type=int, default=4, help='how many sessions to clone')
+    parser.add_argument('--ops', type=int, default=500, help='how many ops each session sends')
+    parser.add_argument('--concurrency', type=int, default=8, help='how many ops each session has in flight')
+    parser.add_argument('--out-size', type=int, default=0, help='bytes of output per eval')
+    parser.add_argument('--chunk-size', type=int, help='bytes of output per response')
+    parser.add_argument('--delay', type=float, default=0, help='seconds each eval takes')
+    parser.add_argument('--timeout', type=float, default=30, help='seconds to wait for each op')
+    parser.add_argument('--unix', action='store_true', help='connect over a Unix domain socket')
+    args = parser.parse_args(argv)
+
+    result = run(args)
+    eval_total = result['latency'].get('eval', {}).get('total', {})
+
+    print(
+        '{ops} ops in {seconds:.2f} s: {ops_per_s:.0f} ops/s, {failed} failed, '
+        '{peak_alloc_bytes} B peak alloc'.format(**result),
+        file=sys.stderr
+    )
+
+    if eval_total.get('count'):
+        print(
+            'eval round trip: p50 {p50_ms:.2f} ms, p95 {p95_ms:.2f} ms, p99 {p99_ms:.2f} ms'.format(**eval_total),
+            file=sys.stderr
+        )
+
+    report = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.time(),
+        'result': result
+    }
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -23,113 +23,771 @@ Example:
     print(bencode.write(buf, {'foo': 42, 'bar': 'spam'}))
     # => b'd3:bar4:spam3:fooi42ee'
 
+To read several values per socket read, use a Decoder:
+
+    decoder = bencode.Decoder()
+    chunk = bytearray(bencode.CHUNK_SIZE)
+
+    while decoder.recv(socket, chunk):
+        for value in decoder:
+            print(value)
+
 Has complete faith in the sending end. That is, does not try to recover from
 any errors.
 """
 
+import codecs
+import sys
+
 
 ENCODING = 'utf-8'
 
+# How many bytes to ask the socket for at a time.
+CHUNK_SIZE = 65536
+
+# The key of a streamed message piece that continues the line the previous
+# piece left off.
+CONTINUED = 'tutkain.bencode/continued'
+
+
+class DecodeError(ValueError):
+    """Raised when the bytes the decoder reads aren't valid bencode, or when
+    they exceed one of the decoder's limits."""
+
+
+class Incomplete(Exception):
+    """Raised when the buffer ends before the value it holds does.
+
+    `need` is the smallest buffer length that could possibly hold the whole
+    value."""
+    def __init__(self, need):
+        self.need = need
+
+
+class LazyDict(dict):
+    """
+    A dict whose bytes values turn into strings when you first access them.
+
+    The decoder puts the string values of dicts into a LazyDict as raw bytes
+    when it's in lazy mode, so that it doesn't need to decode large values
+    nobody ever looks at.
+
+    Every way to get at the values decodes them, including copying the dict
+    into a plain one with dict(), {**d} or dict.update().
+    """
+
+    def __iter__(self):
+        # dict() and friends copy the raw values of a dict subclass unless it
+        # has its own __iter__, in which case they go through keys() and
+        # __getitem__ instead.
+        return dict.__iter__(self)
+
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+
+        if type(value) is bytes:
+            value = str(value, ENCODING)
+            dict.__setitem__(self, key, value)
+
+        return value
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def pop(self, key, *default):
+        if key in self:
+            value = self[key]
+            dict.__delitem__(self, key)
+            return value
+
+        return dict.pop(self, key, *default)
+
+    def setdefault(self, key, default=None):
+        if key in self:
+            return self[key]
+
+        dict.__setitem__(self, key, default)
+        return default
+
+    def popitem(self):
+        key, value = dict.popitem(self)
+
+        if type(value) is bytes:
+            value = str(value, ENCODING)
+
+        return key, value
+
+    def copy(self):
+        """Return a LazyDict with the same items, without decoding any."""
+        return LazyDict(dict.items(self))
+
+    def values(self):
+        return [self[k] for k in self]
+
+    def items(self):
+        return [(k, self[k]) for k in self]
+
+    def __eq__(self, other):
+        return dict(self.items()) == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+# How many lists or dicts deep a value can be nested by default.
+MAX_DEPTH = 256
+
+# How many digits a string length can have. Enough for lengths up to a
+# petabyte.
+MAX_LENGTH_DIGITS = 16
+
+
+def read_length(buf, pos, max_string_length=None):
+    """Read the length prefix of the string that starts at index `pos` of
+    `buf`.
+
+    Return the length and the index of the first byte of the string."""
+    colon = buf.find(b':', pos, pos + MAX_LENGTH_DIGITS + 1)
+
+    if colon == -1:
+        if len(buf) - pos > MAX_LENGTH_DIGITS:
+            raise DecodeError('String length prefix at {} is too long'.format(pos))
+
+        raise Incomplete(len(buf) + 1)
+
+    # Callers have checked that the first byte is a digit, so int() can't
+    # mistake the length for a negative number.
+    try:
+        n = int(buf[pos:colon])
+    except ValueError:
+        raise DecodeError('Invalid string length {!r} at {}'.format(bytes(buf[pos:colon]), pos))
+
+    if max_string_length is not None and n > max_string_length:
+        raise DecodeError(
+            'String of {} bytes at {} exceeds the limit of {} bytes'.format(
+                n, pos, max_string_length
+            )
+        )
+
+    return n, colon + 1
+
+
+def read_bytes(buf, view, pos, max_string_length=None):
+    n, start = read_length(buf, pos, max_string_length)
+    end = start + n
+
+    if end > len(buf):
+        raise Incomplete(end)
+
+    return view[start:end], end
+
+
+def read_str(buf, view, pos, max_string_length=None):
+    bs, end = read_bytes(buf, view, pos, max_string_length)
+
+    try:
+        return str(bs, ENCODING), end
+    except UnicodeDecodeError as e:
+        raise DecodeError('Invalid {} string at {}: {}'.format(ENCODING, pos, e))
+
+
+# Keys that show up in almost every nREPL response. The decoder decodes
+# every key, then looks it up in INTERNED and keeps the interned string
+# instead, so that every response shares the same key objects.
+KEYS = [
+    'id', 'session', 'status', 'value', 'out', 'err', 'ns', 'ex', 'root-ex',
+    'new-session', 'nrepl.middleware.caught/throwable', 'versions', 'ops',
+    'aux', 'changed-namespaces'
+]
 
-def read_until(b, terminator):
-    """Read bytes until the given terminator byte.
+# The well-known keys by themselves, to look up the interned one with.
+INTERNED = {key: sys.intern(key) for key in KEYS}
 
-    Return the bytes, excluding the terminator byte."""
-    bs = bytearray()
-    byte = b.read(1)
 
-    while byte != terminator:
-        bs.extend(byte)
-        byte = b.read(1)
+def read_key(buf, view, pos, max_string_length=None):
+    """Like read_str, but returns the interned key if it's one of the
+    well-known KEYS."""
+    key, end = read_str(buf, view, pos, max_string_length)
+    return INTERNED.get(key, key), end
 
-    return bs
 
+def read_int(buf, pos):
+    end = buf.find(b'e', pos)
 
-def read_list(b):
-    items = []
+    if end == -1:
+        if len(buf) - pos > MAX_LENGTH_DIGITS + 2:
+            raise DecodeError('Integer at {} is too long'.format(pos))
+
+        raise Incomplete(len(buf) + 1)
+
+    try:
+        return int(buf[pos + 1:end]), end + 1
+    except ValueError:
+        raise DecodeError('Invalid integer {!r} at {}'.format(bytes(buf[pos:end + 1]), pos))
+
+
+def is_digit(byte):
+    return 0x30 <= byte <= 0x39
+
+
+def read_value(buf, view, pos, lazy=False, max_depth=None, max_string_length=None):
+    """Read the bencoded value that starts at index `pos` of `buf`.
+
+    Return the value and the index of the first byte after it. If `lazy` is
+    true, read dicts into LazyDicts.
+
+    Keeps the lists and dicts it's in the middle of reading on a stack
+    instead of recursing, so that the nesting depth of the value doesn't
+    matter unless `max_depth` says so."""
+    # The lists and dicts we're in the middle of reading, outermost first.
+    containers = []
+    # For each container, if it's a dict, the key we're reading the value
+    # of.
+    keys = []
+    # The innermost container, whether it's a dict, and whether the next
+    # value is a key of that dict.
+    container = None
+    in_dict = False
+    expect_key = False
+    n = len(buf)
+    find = buf.find
 
     while True:
-        item = read(b)
+        if pos >= n:
+            raise Incomplete(pos + 1)
+
+        byte = buf[pos]
+
+        if 0x30 <= byte <= 0x39:  # 0-9
+            # Strings are most of what there is to read, so read them here
+            # instead of with read_str: the function calls add up.
+            colon = find(b':', pos, pos + MAX_LENGTH_DIGITS + 1)
+
+            try:
+                if colon == -1:
+                    raise ValueError
+
+                length = int(buf[pos:colon])
+
+                if max_string_length is not None and length > max_string_length:
+                    raise ValueError
+            except ValueError:
+                # Let read_length raise the right error.
+                read_length(buf, pos, max_string_length)
+
+            start = colon + 1
+            end = start + length
+
+            if end > n:
+                raise Incomplete(end)
+
+            if lazy and in_dict and not expect_key:
+                value = bytes(view[start:end])
+            else:
+                try:
+                    value = str(view[start:end], ENCODING)
+                except UnicodeDecodeError as e:
+                    raise DecodeError('Invalid {} string at {}: {}'.format(ENCODING, pos, e))
+
+            pos = end
+
+            if expect_key:
+                keys[-1] = INTERNED.get(value, value)
+                expect_key = False
+                continue
+        elif expect_key and byte != 0x65:  # e
+            raise DecodeError('Dict key at {} is not a string'.format(pos))
+        elif byte == 0x69:  # i
+            value, pos = read_int(buf, pos)
+        elif byte == 0x64 or byte == 0x6c:  # d or l
+            if max_depth is not None and len(containers) >= max_depth:
+                raise DecodeError(
+                    'Value at {} is nested deeper than {} levels'.format(pos, max_depth)
+                )
+
+            in_dict = byte == 0x64
+            expect_key = in_dict
+            container = (LazyDict() if lazy else {}) if in_dict else []
+            containers.append(container)
+            keys.append(None)
+            pos += 1
+            continue
+        elif byte == 0x65:  # e
+            if container is None:
+                raise DecodeError('Unexpected end of list or dict at {}'.format(pos))
+            elif in_dict and not expect_key:
+                raise DecodeError('Dict key {!r} has no value'.format(keys[-1]))
+
+            value = containers.pop()
+            keys.pop()
+            pos += 1
+
+            if containers:
+                container = containers[-1]
+                in_dict = type(container) is not list
+            else:
+                return value, pos
+        else:
+            raise DecodeError('Unexpected byte {!r} at {}'.format(bytes([byte]), pos))
 
-        if item is None:
-            return items
+        if container is None:
+            return value, pos
+        elif in_dict:
+            container[keys[-1]] = value
+            expect_key = True
         else:
-            items.append(item)
+            container.append(value)
+
+
+class Stream(object):
+    """A string value the decoder is handing out in chunks."""
+
+    def __init__(self, key, remaining):
+        self.key = key
+        self.remaining = remaining
+        self.decoder = codecs.getincrementaldecoder(ENCODING)()
+        self.continued = False
+
+    def decode(self, bs, final=False):
+        try:
+            return self.decoder.decode(bs, final)
+        except UnicodeDecodeError as e:
+            raise DecodeError('Invalid {} in string {!r}: {}'.format(ENCODING, self.key, e))
+
+
+class Decoder(object):
+    """
+    An incremental bencode decoder.
+
+    Feed it bytes as they come in with `feed()`, then iterate over it to get
+    every value that has arrived in full. Bytes that belong to a value that
+    hasn't arrived in full yet stay in the buffer until the next `feed()`.
+
+        decoder = Decoder()
+        decoder.feed(b'i42ei4')
+        list(decoder)
+        # => [42]
+        decoder.feed(b'3e')
+        list(decoder)
+        # => [43]
+
+    If `lazy` is true, the decoder reads dicts into LazyDicts that hold
+    their string values as bytes until you access them.
+
+    If `stream_threshold` is a number, the decoder doesn't wait for string
+    values of top-level dicts that are at least that many bytes long to
+    arrive in full. Instead, every time more of the string arrives, it
+    hands out a copy of the dict with the keys it has read so far and the
+    new piece of the string, splitting it after the last newline where
+    possible. The dict that ends up holding the rest of the string has
+    every key. If a piece picks up in the middle of a line the previous
+    piece left off, it has the CONTINUED key. Pieces don't have the keys
+    that come after the string, so `streaming` tells you whether the dict
+    is still to come.
+
+    The decoder raises a DecodeError if the bytes it reads aren't valid
+    bencode, or if a value:
+
+    - is nested more than `max_depth` lists or dicts deep
+    - has a string longer than `max_string_length` bytes
+    - needs more than `max_message_size` bytes of buffer (string values the
+      decoder streams don't count)
+
+    Limits that are None don't apply. Once the decoder has raised a
+    DecodeError, there's no telling where the next value starts, so don't
+    use it anymore.
+    """
+
+    def __init__(
+        self,
+        lazy=False,
+        stream_threshold=None,
+        max_depth=MAX_DEPTH,
+        max_string_length=None,
+        max_message_size=None
+    ):
+        self.buffer = bytearray()
+        self.pos = 0
+        self.need = 0
+        self.lazy = lazy
+        self.stream_threshold = stream_threshold
+        self.max_depth = max_depth
+        self.max_string_length = max_string_length
+        self.max_message_size = max_message_size
+        self.message = None
+        self.stream = None
+
+    def feed(self, data):
+        """Append bytes to the receive buffer."""
+        self.buffer.extend(data)
+
+    @property
+    def streaming(self):
+        """True if the last value the decoder handed out is a piece of a
+        dict that hasn't arrived in full yet."""
+        return self.message is not None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        buf = self.buffer
+
+        # We already know the value we're waiting for isn't here yet, so don't
+        # bother parsing it again.
+        if self.pos >= len(buf) or len(buf) < self.need:
+            self.compact()
+            raise StopIteration
+
+        try:
+            with memoryview(buf) as view:
+                if self.stream_threshold is None:
+                    value, self.pos = read_value(
+                        buf,
+                        view,
+                        self.pos,
+                        self.lazy,
+                        self.max_depth,
+                        self.max_string_length
+                    )
+                else:
+                    value = self.read_streaming(buf, view)
+        except Incomplete as e:
+            if self.max_message_size is not None and e.need - self.pos > self.max_message_size:
+                raise DecodeError(
+                    'Message exceeds the limit of {} bytes'.format(self.max_message_size)
+                )
+
+            self.need = e.need
+            self.compact()
+            raise StopIteration
+
+        self.need = 0
+        return value
+
+    def read_streaming(self, buf, view):
+        """Read a value, handing out large string values of a top-level dict
+        in pieces.
+
+        Reads a top-level dict one item at a time and remembers the items
+        it has read, so that it can pick up where it left off."""
+        max_depth = self.max_depth
+        max_string_length = self.max_string_length
+
+        if self.message is None:
+            # Most messages have arrived in full by the time we get to them,
+            # so try reading the whole thing in one go first.
+            try:
+                value, self.pos = read_value(
+                    buf, view, self.pos, self.lazy, max_depth, max_string_length
+                )
+
+                return value
+            except Incomplete:
+                if buf[self.pos] != 0x64:  # d
+                    raise
+
+            if max_depth is not None and max_depth < 1:
+                raise DecodeError(
+                    'Value at {} is nested deeper than {} levels'.format(self.pos, max_depth)
+                )
+
+            self.message = LazyDict() if self.lazy else {}
+            self.pos += 1
+
+        message = self.message
+
+        while True:
+            if self.stream is not None:
+                chunk = self.read_chunk(buf, view)
+
+                if chunk is not None:
+                    return chunk
+
+            pos = self.pos
+
+            if pos >= len(buf):
+                raise Incomplete(pos + 1)
+            elif buf[pos] == 0x65:  # e
+                self.pos = pos + 1
+                self.message = None
+                return message
+
+            k, pos = read_key(buf, view, pos, max_string_length)
+
+            if pos < len(buf) and is_digit(buf[pos]):
+                n, start = read_length(buf, pos, max_string_length)
+                end = start + n
+
+                if end > len(buf):
+                    if n < self.stream_threshold:
+                        raise Incomplete(end)
+
+                    self.pos = start
+                    self.stream = Stream(k, n)
+                elif self.lazy:
+                    message[k] = bytes(view[start:end])
+                    self.pos = end
+                else:
+                    message[k], self.pos = read_str(buf, view, pos, max_string_length)
+            else:
+                message[k], self.pos = read_value(
+                    buf,
+                    view,
+                    pos,
+                    self.lazy,
+                    None if max_depth is None else max_depth - 1,
+                    max_string_length
+                )
+
+    def read_chunk(self, buf, view):
+        """Read as much of the string we're streaming as has arrived.
+
+        Return a copy of the current message with the new piece of the
+        string, or None if the string has arrived in full and its last piece
+        is in the message itself."""
+        stream = self.stream
+        pos = self.pos
+        n = min(len(buf) - pos, stream.remaining)
+
+        if n == stream.remaining:
+            text = stream.decode(view[pos:pos + n], True)
+            self.pos += n
+            self.stream = None
+            self.message[stream.key] = text
+
+            if stream.continued:
+                self.message[CONTINUED] = 'true'
+
+            return None
+
+        newline = buf.rfind(b'\n', pos, pos + n)
+
+        if newline != -1:
+            n = newline + 1 - pos
+
+        text = stream.decode(view[pos:pos + n])
+        self.pos += n
+        stream.remaining -= n
+
+        if not text:
+            raise Incomplete(len(buf) + 1)
 
+        chunk = self.message.copy()
+        chunk[stream.key] = text
+
+        if stream.continued:
+            chunk[CONTINUED] = 'true'
 
-def into_dict(l):
-    """Convert a list into a dict."""
-    return {l[i]: l[i + 1] for i in range(0, len(l), 2)}
+        stream.continued = not text.endswith('\n')
+        return chunk
 
+    def compact(self):
+        """Drop the bytes of the values we've already read."""
+        if self.pos > 0:
+            self.need = max(self.need - self.pos, 0)
+            del self.buffer[:self.pos]
+            self.pos = 0
 
-def read_dict(b):
-    return into_dict(read_list(b))
+    def recv(self, sock, chunk):
+        """Read up to `len(chunk)` bytes from `sock` into the receive buffer
+        via the writable buffer `chunk`.
 
+        Return the number of bytes read. Zero means the peer has closed the
+        connection."""
+        n = sock.recv_into(chunk)
 
-def read_int(b):
-    return int(read_until(b, b'e'))
+        with memoryview(chunk) as view:
+            self.feed(view[:n])
+
+        return n
 
 
 def read(b):
-    """Read bencodes values from a BufferedReader into Python values."""
-    first_byte = b.read(1)
+    """Read one bencoded value from a BufferedReader into a Python value.
+
+    Only consumes the bytes that belong to the value."""
+    decoder = Decoder()
+
+    while True:
+        data = b.peek(CHUNK_SIZE)
+
+        if not data:
+            raise EOFError('End of stream while reading bencode')
+
+        offset = len(decoder.buffer)
+        decoder.feed(data)
+
+        for value in decoder:
+            b.read(decoder.pos - offset)
+            return value
+
+        b.read(len(data))
+
+
+def decode(data):
+    """Decode every bencoded value in `data` and return them in a list."""
+    decoder = Decoder()
+    decoder.feed(data)
+    return list(decoder)
 
-    if first_byte == b'e':
-        return None
-    elif first_byte == b'd':
-        return read_dict(b)
-    elif first_byte == b'l':
-        return read_list(b)
-    elif first_byte == b'i':
-        return read_int(b)
-    else:
-        n = int(first_byte + read_until(b, b':'))
-        return b.read(n).decode(ENCODING)
 
+def write_int(out, i):
+    out += b'i'
+    out += str(i).encode(ENCODING)
+    out += b'e'
 
-def write_int(buf, i):
-    buf.write('i{}e'.format(i).encode(ENCODING))
 
+def write_bytes(out, bs):
+    out += str(len(bs)).encode(ENCODING)
+    out += b':'
+    out += bs
 
-def write_str(buf, s):
-    buf.write('{}:{}'.format(len(s.encode(ENCODING)), s).encode(ENCODING))
 
+def write_str(out, s):
+    write_bytes(out, s.encode(ENCODING))
 
-def write_list(buf, l):
-    buf.write(b'l')
+
+def write_list(out, l):
+    out += b'l'
 
     for x in l:
-        write_value(buf, x)
+        write_value(out, x)
+
+    out += b'e'
+
+
+def write_dict(out, d):
+    out += b'd'
+
+    for k in sorted(d):
+        write_str(out, k)
+        write_value(out, d[k])
+
+    out += b'e'
 
-    buf.write(b'e')
 
+class Template(object):
+    """
+    Dict items that go into many outgoing dicts, encoded once.
 
-def write_dict(buf, d):
-    buf.write(b'd')
-    ks = list(d.keys())
-    ks.sort()
+        template = Template({'session': 'abc', 'nrepl.middleware.print/stream?': 'true'})
+        encode(Templated(template, {'op': 'eval', 'code': '(+ 1 2)'}))
+        # => b'd4:code7:(+ 1 2)30:nrepl.middleware.print/stream?4:true2:op4:eval7:session3:abce'
+    """
 
-    for k in ks:
-        write_value(buf, k)
-        write_value(buf, d[k])
+    def __init__(self, d):
+        self.dict = dict(d)
+        self.items = []
 
-    buf.write(b'e')
+        for k in sorted(d):
+            out = bytearray()
+            write_str(out, k)
+            write_value(out, d[k])
+            self.items.append((k, bytes(out)))
 
 
-def write_value(buf, x):
-    if isinstance(x, int):
-        write_int(buf, x)
-    elif isinstance(x, str):
-        write_str(buf, x)
-    elif isinstance(x, list):
-        write_list(buf, x)
-    elif isinstance(x, dict):
-        write_dict(buf, x)
-    else:
+class Templated(dict):
+    """A dict to encode along with the items of a Template.
+
+    Only the items of the dict itself are encoded every time. If the dict
+    and the template have the same key, the dict wins."""
+    __slots__ = ('template',)
+
+    def __init__(self, template, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.template = template
+
+    def __repr__(self):
+        return repr(dict(self.template.dict, **self))
+
+
+def write_templated(out, d):
+    out += b'd'
+    items = d.template.items
+    i = 0
+
+    # Merge the template's items into the dict's items in key order.
+    for k in sorted(d):
+        while i < len(items) and items[i][0] < k:
+            out += items[i][1]
+            i += 1
+
+        if i < len(items) and items[i][0] == k:
+            i += 1
+
+        write_str(out, k)
+        write_value(out, d[k])
+
+    for _, bs in items[i:]:
+        out += bs
+
+    out += b'e'
+
+
+WRITERS = {
+    int: write_int,
+    str: write_str,
+    bytes: write_bytes,
+    bytearray: write_bytes,
+    list: write_list,
+    tuple: write_list,
+    dict: write_dict,
+    Templated: write_templated
+}
+
+
+def writer(t):
+    """Find the writer for a type that isn't in WRITERS, such as a subclass of
+    one of the types that is."""
+    for base, write in WRITERS.items():
+        if issubclass(t, base):
+            return write
+
+
+def write_value(out, x):
+    """Append the bencoded bytes of `x` into the bytearray `out`."""
+    write = WRITERS.get(type(x)) or writer(type(x))
+
+    if write is None:
         raise ValueError("Can't write {} into bencode".format(x))
 
+    write(out, x)
+
+
+class Encoder(object):
+    """
+    Encodes Python values into a single bytearray that it reuses for every
+    value, so that sending a message means handing one buffer to the socket.
+
+        encoder = Encoder()
+        socket.sendall(encoder.encode({'op': 'eval', 'code': '(+ 1 2)'}))
+
+    The buffer `encode()` returns is only valid until the next call.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def encode(self, x):
+        del self.buffer[:]
+        write_value(self.buffer, x)
+        return self.buffer
+
+
+def encode(x):
+    """Encode a Python value into bencoded bytes."""
+    out = bytearray()
+    write_value(out, x)
+    return bytes(out)
+
 
 def write(buf, x):
     """Write a Python value into BufferedReader as bencode."""
-    write_value(buf, x)
+    out = bytearray()
+    write_value(out, x)
+    buf.write(out)
     buf.flush()
@@ -1,123 +1,230 @@
 import sublime
-LBRACKETS = {'(': ')', '[': ']', '{': '}'}
-RBRACKETS = {')': '(', ']': '[', '}': '{'}
 
+from . import scanner
+from . import structure
+
+from .scanner import LBRACKETS, RBRACKETS
+
+
+# The tokens brackets in which don't count, and how many characters they
+# start with before you're inside them.
+LITERALS = {'string': 1, 'regex': 2, 'char': 1, 'comment': 0}
+
+
+def inside(view, point, kinds):
+    """Return True if `point` is inside a token of one of `kinds`."""
+    if point >= view.size():
+        return False
+
+    token = scanner.token_at(lambda begin, end: char_range(view, begin, end), point)
 
-def inside_string(view, point):
     return (
-        view.match_selector(point, 'string')
-        and not view.match_selector(
-            point,
-            'punctuation.definition.string.begin'
-        )
+        token is not None
+        and token.kind in kinds
+        and token.start + LITERALS[token.kind] <= point < token.end
     )
 
 
+def inside_string(view, point):
+    return inside(view, point, ('string', 'regex'))
+
+
 def inside_comment(view, point):
-    # FIXME
-    return view.match_selector(point, 'comment')
+    return inside(view, point, ('comment',))
 
 
 def ignore(view, point):
-    return inside_string(view, point) or inside_comment(view, point)
+    return inside(view, point, LITERALS)
 
 
 def char_range(view, start, end):
     return view.substr(sublime.Region(start, end))
 
 
-def find_lbracket(view, start_point):
-    point = start_point
-    stack = 0
+# The syntax scopes brackets in which don't count.
+IGNORED_SCOPES = 'string, comment, constant.character'
+
+
+def settings():
+    return sublime.load_settings('tutkain.sublime-settings')
 
-    while point > 0:
-        char = char_range(view, point, point - 1)
 
-        if ignore(view, point):
-            point -= 1
-        elif char in RBRACKETS:
-            stack += 1
-            point -= 1
-        elif stack > 0 and char in LBRACKETS:
-            stack -= 1
-            point -= 1
-        elif stack == 0 and char in LBRACKETS:
-            return char, point - 1
+def ignored(view):
+    """Return the spans of `view` brackets in which don't count, from the
+    syntax scopes of the whole view, fetched in one call."""
+    spans = []
+
+    for region in sorted(view.find_by_selector(IGNORED_SCOPES)):
+        # Merge the regions that overlap.
+        if spans and region.begin() <= spans[-1][1]:
+            spans[-1] = (spans[-1][0], max(spans[-1][1], region.end()))
         else:
-            point -= 1
+            spans.append((region.begin(), region.end()))
+
+    return scanner.Spans(spans)
+
 
-    return None, None
+def find_lbracket(view, start_point, ignored=None):
+    """Return the opening bracket of the innermost form open at
+    `start_point` and where it is, or (None, None).
 
+    Brackets in `ignored` don't count, if you give it. Otherwise, the
+    tokenizer tells which brackets count."""
+    return scanner.find_open(
+        lambda begin, end: char_range(view, begin, end),
+        start_point,
+        ignored
+    )
 
-def find_rbracket_point(view, lbracket, start_point):
-    point = start_point
-    stack = 0
-    max_point = view.size()
 
+def find_rbracket_point(view, lbracket, start_point, ignored=None):
     if lbracket is None:
         return None
 
-    while point < max_point:
-        char = char_range(view, point, point + 1)
-
-        if ignore(view, point):
-            point += 1
-        elif char == RBRACKETS[lbracket]:
-            stack += 1
-            point += 1
-        elif stack > 0 and char == lbracket:
-            stack -= 1
-            point += 1
-        elif stack == 0 and char == lbracket:
-            return point + 1
-        else:
-            point += 1
+    return scanner.find_close(
+        lambda begin, end: char_range(view, begin, end),
+        start_point,
+        view.size(),
+        lbracket,
+        ignored
+    )
 
 
 def calculate_start_point(view, point):
-    next_char = char_range(view, point, point + 1)
+    begin = max(point - 1, 0)
+    text = char_range(view, begin, point + 2)
+    previous_char = text[:point - begin]
+    next_char = text[point - begin:point - begin + 1]
+    nnext_char = text[point - begin + 1:point - begin + 2]
 
     # next char is a left bracket
     if next_char in LBRACKETS:
         return point + 1
 
     # previous char is a right bracket
-    elif char_range(view, point, point - 1) in RBRACKETS:
+    elif previous_char in RBRACKETS:
         return point - 1
 
     # next char is the hash mark of a set or anon fn
     elif next_char == '#':
-        nnext_char = char_range(view, point + 1, point + 2)
         return point + 2 if nnext_char in {'(', '{'} else point
 
     # next char is a quote or an at sign preceding a left paren
     elif next_char in {'\'', '@'}:
-        nnext_char = char_range(view, point + 1, point + 2)
         return point + 2 if nnext_char == '(' else point
 
     return point
 
 
-def current_form_region(view, point):
+def scan_form_region(view, point, scopes=False):
+    """Return the region of the form around `point` like
+    current_form_region, but by searching the text around `point` instead
+    of with the structure index."""
     start_point = calculate_start_point(view, point)
-    lbracket, lpoint = find_lbracket(view, start_point)
+    spans = ignored(view) if scopes else None
+    lbracket, lpoint = find_lbracket(view, start_point, spans)
 
     if lbracket:
-        rpoint = find_rbracket_point(view, LBRACKETS[lbracket], lpoint + 1)
+        rpoint = find_rbracket_point(view, LBRACKETS[lbracket], lpoint + 1, spans)
 
-        if char_range(view, lpoint, lpoint - 1) in {'#', '@', '\''}:
+        if rpoint is None:
+            return None
+        elif char_range(view, lpoint - 1, lpoint) in {'#', '@', '\''}:
             return sublime.Region(lpoint - 1, rpoint)
         else:
             return sublime.Region(lpoint, rpoint)
 
 
+# The structure index of every buffer, with the change count of the buffer
+# it's up to date with, by buffer ID.
+indexes = {}
+
+
+def index(view):
+    """Return the structure index of the buffer of `view`, building it if
+    it's not up to date."""
+    change_count = view.change_count()
+    change_count_then, found = indexes.get(view.buffer_id(), (None, None))
+
+    if change_count_then != change_count:
+        found = structure.Index(char_range(view, 0, view.size()))
+        indexes[view.buffer_id()] = (change_count, found)
+
+    return found
+
+
+def update_index(view, change):
+    """Update the structure index of the buffer of `view`, if it has one,
+    after `change`, a TextChange.
+
+    Drop the index instead if it isn't up to date with the text the change
+    was made to, or if the buffer has changed again since: the text we'd
+    read then isn't the text right after the change."""
+    change_count_then, found = indexes.pop(view.buffer_id(), (None, None))
+
+    if found is None or change.a.change_count != change_count_then:
+        return
+
+    change_count = view.change_count()
+
+    if change_count != change_count_then + 1:
+        return
+
+    found.edit(
+        lambda begin, end: char_range(view, begin, end),
+        view.size(),
+        change.a.pt,
+        change.b.pt,
+        len(change.str)
+    )
+
+    if view.change_count() == change_count:
+        indexes[view.buffer_id()] = (change_count, found)
+
+
+def forget_index(view):
+    indexes.pop(view.buffer_id(), None)
+
+
+def current_form_region(view, point):
+    if not settings().get('structure_index', True):
+        return scan_form_region(view, point, settings().get('syntax_scopes', False))
+
+    region = index(view).form_at(point)
+
+    if region:
+        return sublime.Region(*region)
+
+
+def current_form_regions(view, points):
+    """Return the region of the form around each of `points`, or None, like
+    current_form_region, but finding them all with the same index."""
+    if not settings().get('structure_index', True):
+        scopes = settings().get('syntax_scopes', False)
+        return [scan_form_region(view, point, scopes) for point in points]
+
+    found = index(view)
+    regions = []
+
+    for point in points:
+        region = found.form_at(point)
+        regions.append(sublime.Region(*region) if region else None)
+
+    return regions
+
+
 def is_next_to_expand_anchor(view, point):
+    if settings().get('structure_index', True):
+        return index(view).is_anchor(point)
+
+    begin = max(point - 1, 0)
+    text = char_range(view, begin, point + 2)
+    previous_char = text[:point - begin]
+    next_chars = text[point - begin:]
+
     return (
-        char_range(view, point, point + 1) in LBRACKETS or
-        char_range(view, point, point + 1) in RBRACKETS or
-        char_range(view, point, point + 2) == '#{' or
-        char_range(view, point, point + 2) == '#(' or
-        char_range(view, point, point + 2) == '@(' or
-        char_range(view, point, point + 2) == '\'(' or
-        char_range(view, point, point - 1) in RBRACKETS
+        next_chars[:1] in LBRACKETS or
+        next_chars[:1] in RBRACKETS or
+        next_chars in {'#{', '#(', '@(', '\'('} or
+        previous_char in RBRACKETS
     )
@@ -0,0 +1,233 @@
+import heapq
+import itertools
+import selectors
+import socket
+import time
+from threading import Lock, Thread
+
+from .log import log
+
+
+class Engine(object):
+    '''
+    Does the socket I/O of every Client on a single background thread.
+
+    Clients register their (non-blocking) sockets with the engine. When a
+    socket has bytes to read, the engine calls the client's `on_readable()`.
+    When a client has bytes to write, it calls `wake(client)` from whichever
+    thread it's on, and the engine calls the client's `flush()` on its own
+    thread. If the socket can't take every byte at once, the client asks the
+    engine to call `on_writable()` once it can with `update()`. To have the
+    engine call a function later, use `call_later()`.
+
+    Everything a client does in these callbacks runs on the engine thread,
+    so none of it must block.
+    '''
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.lock = Lock()
+        self.pending = set()
+        self.calls = []
+        # The calls to make later, as a heap of (when, sequence number,
+        # function) tuples.
+        self.timers = []
+        self.sequence = itertools.count()
+        # Every registered client, even those the selector isn't watching.
+        self.clients = set()
+        self.running = False
+        self.thread = None
+
+        # Writing into this socket pair wakes the engine up from select().
+        self.waker, self.wakee = socket.socketpair()
+        self.waker.setblocking(False)
+        self.wakee.setblocking(False)
+        self.selector.register(self.wakee, selectors.EVENT_READ, None)
+
+    def start(self):
+        with self.lock:
+            if not self.running:
+                self.running = True
+                self.thread = Thread(daemon=True, target=self.loop)
+                self.thread.name = 'tutkain.engine'
+                self.thread.start()
+
+        return self
+
+    def stop(self):
+        with self.lock:
+            self.running = False
+
+        self.poke()
+
+        if self.thread is not None:
+            self.thread.join()
+
+    def poke(self):
+        try:
+            self.waker.send(b'\0')
+        except (BlockingIOError, OSError):
+            # The engine already has a wake-up call waiting, or it's gone.
+            pass
+
+    def wake(self, client):
+        '''Ask the engine to call `client.flush()` on the engine thread.'''
+        with self.lock:
+            self.pending.add(client)
+
+        self.poke()
+
+    def call_soon(self, f):
+        '''Ask the engine to call `f` on the engine thread.'''
+        with self.lock:
+            self.calls.append(f)
+
+        self.poke()
+
+    def call_later(self, delay, f):
+        '''Ask the engine to call `f` on the engine thread in `delay`
+        seconds.'''
+        with self.lock:
+            heapq.heappush(self.timers, (time.monotonic() + delay, next(self.sequence), f))
+
+        self.poke()
+
+    def register(self, client):
+        '''Start doing the socket I/O of `client`.'''
+        def register():
+            self.clients.add(client)
+            self.update(client)
+            client.flush()
+
+        self.call_soon(register)
+
+    def unregister(self, client):
+        self.clients.discard(client)
+
+        try:
+            self.selector.unregister(client.socket)
+        except (KeyError, ValueError):
+            pass
+
+    def update(self, client):
+        '''Tell the engine to call `client.on_readable()` only if
+        `client.reading` is true, and `client.on_writable()` only if
+        `client.outbuf` has bytes left to write.
+
+        Runs on the engine thread.'''
+        events = 0
+
+        if client.reading:
+            events |= selectors.EVENT_READ
+
+        if client.outbuf:
+            events |= selectors.EVENT_WRITE
+
+        try:
+            key = self.selector.get_map().get(client.socket)
+
+            if key is None:
+                if events:
+                    self.selector.register(client.socket, events, client)
+            elif not events:
+                self.selector.unregister(client.socket)
+            elif key.events != events:
+                self.selector.modify(client.socket, events, client)
+        except (KeyError, ValueError, OSError):
+            pass
+
+    def drain_waker(self):
+        try:
+            while self.wakee.recv(4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+
+    def run_pending(self):
+        with self.lock:
+            calls = self.calls
+            clients = self.pending
+            self.calls = []
+            self.pending = set()
+
+        for f in calls:
+            self.call(f)
+
+        for client in clients:
+            self.call(client.flush)
+
+        now = time.monotonic()
+        due = []
+
+        with self.lock:
+            while self.timers and self.timers[0][0] <= now:
+                due.append(heapq.heappop(self.timers)[2])
+
+        for f in due:
+            self.call(f)
+
+    def timeout(self):
+        '''Return how long to wait for I/O before the next timer is due, or
+        None if there are no timers.'''
+        with self.lock:
+            if not self.timers:
+                return None
+
+            return max(0, self.timers[0][0] - time.monotonic())
+
+    def call(self, f):
+        try:
+            f()
+        except Exception as e:
+            log.error({'event': 'engine/error', 'exception': e}, exc_info=True)
+
+    def loop(self):
+        while self.running:
+            for key, mask in self.selector.select(self.timeout()):
+                client = key.data
+
+                if client is None:
+                    self.drain_waker()
+                    continue
+
+                if mask & selectors.EVENT_READ:
+                    self.call(client.on_readable)
+
+                if mask & selectors.EVENT_WRITE:
+                    self.call(client.on_writable)
+
+            self.run_pending()
+
+        # Close the connections of the clients that are still around.
+        for client in list(self.clients):
+            self.call(client.close)
+
+        self.selector.close()
+        self.waker.close()
+        self.wakee.close()
+
+        log.debug({'event': 'thread/exit'})
+
+
+engine = None
+lock = Lock()
+
+
+def get():
+    '''Return the engine every Client shares, starting it if necessary.'''
+    global engine
+
+    with lock:
+        if engine is None:
+            engine = Engine()
+
+    return engine.start()
+
+
+def stop():
+    global engine
+
+    with lock:
+        if engine is not None:
+            engine.stop()
+            engine = None
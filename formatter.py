@@ -1,9 +1,19 @@
-def format_out(out):
+from .bencode import CONTINUED
+
+
+def format_out(out, continued=False):
+    """Prefix every line of `out` with a comment marker.
+
+    If `continued` is true, `out` picks up in the middle of a line that has
+    already been printed, so leave its first line alone."""
     # TODO: Why do I need to do this?
     maybe_newline = '\n' if out.endswith('\n') else ''
+    lines = out.splitlines()
+    head = lines[:1] if continued else []
+    tail = lines[1:] if continued else lines
 
     return '\n'.join(
-        map(lambda line: ';; {}'.format(line), out.splitlines())
+        head + list(map(lambda line: ';; {}'.format(line), tail))
     ) + maybe_newline
 
 
@@ -13,11 +23,11 @@ def format(message):
     if 'nrepl.middleware.caught/throwable' in message:
         return message.get('nrepl.middleware.caught/throwable')
     if 'out' in message:
-        return format_out(message['out'])
+        return format_out(message['out'], CONTINUED in message)
     if 'append' in message:
         return message['append']
     if 'err' in message:
-        return format_out(message.get('err'))
+        return format_out(message.get('err'), CONTINUED in message)
     if 'versions' in message:
         versions = message.get('versions')
 
@@ -0,0 +1,126 @@
+'''
+Finds the top-level forms in Clojure source code.
+
+Doesn't need Sublime Text, so it works on any string and you can test it
+without an editor.
+'''
+import bisect
+import collections
+import re
+
+from . import tokenizer
+
+
+# A top-level form: where it starts and ends in the text, and the line and
+# column it starts on, both 1-based.
+Form = collections.namedtuple('Form', ['start', 'end', 'line', 'column'])
+
+
+def read(tokens, token):
+    '''Read the rest of the form that starts with `token` from `tokens`, an
+    iterator of significant tokens, and return its last token.'''
+    kind = token.kind
+
+    if kind == 'open':
+        depth = 1
+        last = token
+
+        for last in tokens:
+            if last.kind == 'open':
+                depth += 1
+            elif last.kind == 'close':
+                depth -= 1
+
+                if depth == 0:
+                    break
+
+        return last
+    elif kind in ('meta', 'discard'):
+        # Metadata and then the form it goes on, or a discarded form and
+        # then the form that counts.
+        return read_next(tokens, read_next(tokens, token))
+    elif kind in ('prefix', 'tag'):
+        return read_next(tokens, token)
+    else:
+        # An atom, a string, or a stray closing bracket. Let the reader
+        # complain about that last one.
+        return token
+
+
+def read_next(tokens, last):
+    '''Read the form after `last` and return its last token, or `last` if
+    there's nothing after it.'''
+    token = next(tokens, None)
+    return last if token is None else read(tokens, token)
+
+
+def spans(text, start=0):
+    '''Yield where every top-level form from `start` on starts and ends, in
+    order, skipping forms discarded with #_.
+
+    `start` must be outside of any form.'''
+    tokens = tokenizer.significant(text, start)
+
+    for token in tokens:
+        if token.kind == 'discard':
+            read_next(tokens, token)
+        else:
+            yield token.start, read(tokens, token).end
+
+
+def top_level_forms(text):
+    '''Return every top-level form in `text`, in order, skipping forms
+    discarded with #_.'''
+    newlines = [i for i, c in enumerate(text) if c == '\n']
+    forms = []
+
+    for start, end in spans(text):
+        line = bisect.bisect_left(newlines, start)
+        column = start - (newlines[line - 1] + 1 if line else 0)
+        forms.append(Form(start, end, line + 1, column + 1))
+
+    return forms
+
+
+NS = re.compile(r'\(\s*ns\s+(?:\^:?[^\s()\[\]{}]+\s+)*([^\s()\[\]{}^]+)')
+
+
+def namespace_form(text, forms):
+    '''Return the first ns form among `forms`, or None.'''
+    for form in forms:
+        if NS.match(text, form.start, form.end):
+            return form
+
+
+def namespace(text, forms):
+    '''Return the name of the namespace the first ns form among `forms`
+    declares, or None.'''
+    form = namespace_form(text, forms)
+
+    if form:
+        return NS.match(text, form.start, form.end).group(1)
+
+
+class Evaluated(object):
+    '''
+    The hashes of the top-level forms of a text as they were when they were
+    last evaluated, so that you can tell which forms changed since.
+    '''
+
+    def __init__(self):
+        self.hashes = set()
+
+    def add(self, code):
+        self.hashes.add(hash(code))
+
+    def changed(self, text, forms=None):
+        '''Return the top-level forms of `text` that changed since they were
+        last evaluated, in order.
+
+        Forgets the hashes of forms that are no longer in the text.'''
+        if forms is None:
+            forms = top_level_forms(text)
+
+        hashes = [hash(text[form.start:form.end]) for form in forms]
+        self.hashes.intersection_update(hashes)
+        return [form for form, h in zip(forms, hashes) if h not in self.hashes]
@@ -0,0 +1,181 @@
+import collections
+import json
+import math
+import time
+from threading import Lock
+
+from . import bencode
+
+
+# Every bucket of a Histogram holds durations up to this many times longer
+# than the bucket before it holds.
+GROWTH = 2 ** 0.25
+
+# The op types that get a histogram of their own. Every other op goes into
+# 'other'.
+OPS = ('eval', 'load-file', 'clone', 'interrupt', 'describe')
+
+PHASES = ('total', 'queue', 'wire', 'server')
+
+
+class Histogram(object):
+    '''
+    Counts of durations in geometrically growing buckets, so that it takes
+    the same amount of memory however many durations go in, and its
+    percentiles are off by less than a fifth.
+    '''
+
+    def __init__(self):
+        self.buckets = collections.Counter()
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        us = max(seconds * 1e6, 1.0)
+        self.buckets[int(math.log(us, GROWTH))] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, p):
+        '''Return the upper bound of the bucket the `p`th percentile is in,
+        in seconds.'''
+        rank = self.count * p / 100
+        seen = 0
+
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+
+            if seen >= rank:
+                return min(GROWTH ** (bucket + 1) / 1e6, self.max)
+
+        return self.max
+
+    def summary(self):
+        if not self.count:
+            return {'count': 0}
+
+        return {
+            'count': self.count,
+            'mean_ms': self.sum / self.count * 1000,
+            'p50_ms': self.percentile(50) * 1000,
+            'p95_ms': self.percentile(95) * 1000,
+            'p99_ms': self.percentile(99) * 1000,
+            'max_ms': self.max * 1000
+        }
+
+
+def op_key(op):
+    '''Return the key Tracker knows an outgoing op by.'''
+    session = op.get('session')
+
+    if session is None and isinstance(op, bencode.Templated):
+        session = op.template.dict.get('session')
+
+    return (session, op.get('id'))
+
+
+class Timing(object):
+    __slots__ = ('op', 'enqueued', 'written', 'received')
+
+    def __init__(self, op, enqueued):
+        self.op = op
+        self.enqueued = enqueued
+        self.written = None
+        self.received = None
+
+
+class Tracker(object):
+    '''
+    Times every op from when it goes into the send queue until the server
+    is done with it, and keeps a Histogram per op type and phase:
+
+    - queue: from going into the send queue to being written into the socket
+    - wire: from being written into the socket to the first response, which
+      includes the time the server takes to start answering
+    - server: from the first response to the done response
+    - total: all of the above
+
+    Ops are known by their session ID and op ID; ops sent outside of any
+    session have a session ID of None.
+    '''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.pending = dict()
+        self.histograms = collections.defaultdict(
+            lambda: {phase: Histogram() for phase in PHASES}
+        )
+
+    def enqueued(self, key, op):
+        with self.lock:
+            self.pending[key] = Timing(op if op in OPS else 'other', time.perf_counter())
+
+    def written(self, key):
+        timing = self.pending.get(key)
+
+        if timing is not None and timing.written is None:
+            timing.written = time.perf_counter()
+
+    def received(self, key, done):
+        timing = self.pending.get(key)
+
+        if timing is None:
+            return
+
+        now = time.perf_counter()
+
+        if timing.received is None:
+            timing.received = now
+
+        if done:
+            with self.lock:
+                self.pending.pop(key, None)
+
+                # Ops that got a response before we saw them go out count
+                # as written when the first response arrived.
+                written = timing.written or timing.received
+                histograms = self.histograms[timing.op]
+                histograms['total'].add(now - timing.enqueued)
+                histograms['queue'].add(written - timing.enqueued)
+                histograms['wire'].add(timing.received - written)
+                histograms['server'].add(now - timing.received)
+
+    def forget(self, key):
+        with self.lock:
+            self.pending.pop(key, None)
+
+    def report(self):
+        '''Return the summaries of every histogram, by op type and phase.'''
+        with self.lock:
+            return {
+                op: {phase: histogram.summary() for phase, histogram in histograms.items()}
+                for op, histograms in self.histograms.items()
+            }
+
+
+def format_report(report):
+    '''Return a report as a table to print.'''
+    row = '{:<10} {:<7} {:>7} {:>10} {:>10} {:>10} {:>10}'
+    lines = [row.format('op', 'phase', 'count', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms')]
+
+    for op in sorted(report):
+        for phase in PHASES:
+            summary = report[op][phase]
+
+            if summary['count']:
+                lines.append(row.format(
+                    op,
+                    phase,
+                    summary['count'],
+                    *['{:.2f}'.format(summary[k]) for k in ('p50_ms', 'p95_ms', 'p99_ms', 'max_ms')]
+                ))
+
+    return '\n'.join(lines) + '\n'
+
+
+def export(report, path):
+    '''Write a report into the file at `path` as JSON.'''
+    with open(path, 'w') as file:
+        json.dump({'timestamp': time.time(), 'ops': report}, file, indent=2, sort_keys=True)
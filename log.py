@@ -1,4 +1,11 @@
+import collections
+import json
 import logging
+import logging.handlers
+import queue
+import time
+
+DEBUG = logging.DEBUG
 
 log = logging.getLogger(__package__)
 handler = logging.StreamHandler()
@@ -8,11 +15,109 @@ formatter = logging.Formatter(
     datefmt='%Y-%m-%d %H:%M:%S'
 )
 handler.setFormatter(formatter)
-log.addHandler(handler)
+
+# Records go through this queue to a background thread that formats and
+# writes them, so that logging doesn't slow down the threads that log.
+records = queue.Queue()
+listener = logging.handlers.QueueListener(records, handler)
+listening = False
+
+
+class Handoff(logging.handlers.QueueHandler):
+    '''
+    Hands records over to the listener thread as they are. Unlike
+    QueueHandler, it doesn't format them first, because that's the slow
+    part.
+
+    Handles records itself until the listener starts.
+    '''
+
+    def prepare(self, record):
+        return record
+
+    def emit(self, record):
+        if listening:
+            logging.handlers.QueueHandler.emit(self, record)
+        else:
+            handler.handle(record)
+
+
+log.addHandler(Handoff(records))
+
+
+def start_writer():
+    '''Start writing log records on a background thread.'''
+    global listening
+
+    if not listening:
+        listener.start()
+        listening = True
+
+
+def stop_writer():
+    '''Write the records that are still waiting and stop the thread.'''
+    global listening
+
+    if listening:
+        listening = False
+        listener.stop()
 
 
 def enable_debug():
-    log.setLevel(logging.DEBUG)
+    log.setLevel(DEBUG)
 
 
 # enable_debug()
+
+
+class FlightRecorder(object):
+    '''
+    The last `size` wire events, kept in memory whether debug logging is on
+    or not, so that you can dump them into a file after a hang or a
+    slowdown.
+
+    An event keeps only the ID, op or status and keys of the message it's
+    about, not the message itself, so that large messages don't stay in
+    memory.
+    '''
+
+    def __init__(self, size=1000):
+        self.events = collections.deque(maxlen=size)
+
+    def resize(self, size):
+        self.events = collections.deque(self.events, maxlen=size)
+
+    def record(self, event, item=None):
+        if item is None:
+            self.events.append((time.time(), event, None, None, None))
+        else:
+            self.events.append((
+                time.time(),
+                event,
+                item.get('id'),
+                item.get('op') or item.get('status'),
+                tuple(item)
+            ))
+
+    def dump(self, path):
+        '''Write every event into the file at `path`, one JSON object per
+        line, oldest first. Return how many events it wrote.'''
+        events = list(self.events)
+
+        with open(path, 'w') as file:
+            for timestamp, event, id, what, keys in events:
+                file.write(json.dumps({
+                    'time': '{}.{:06d}'.format(
+                        time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp)),
+                        int(timestamp % 1 * 1e6)
+                    ),
+                    'event': event,
+                    'id': id,
+                    'what': what,
+                    'keys': keys
+                }, default=str) + '\n')
+
+        return len(events)
+
+
+recorder = FlightRecorder()
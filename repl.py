@@ -1,34 +1,107 @@
+import collections
+import os
 import queue
 import socket
-from threading import Thread, Event, Lock
+import tempfile
+import time
+from concurrent.futures import Future, wait
+from threading import Event, Lock
 
 from . import bencode
-from .log import log
-from . import sessions
+from . import engine
+from . import latency
+from .log import DEBUG, log, recorder
 
 
-class Session():
-    handlers = dict()
-    errors = dict()
+def is_done(response):
+    return 'done' in response.get('status', ())
+
+
+class Result(object):
+    '''
+    Every response the server sent for one op, and the parts of them you
+    usually want.
+
+    `value`, `out` and `err` join the pieces of the value, the output and
+    the error output across responses, or are None if there weren't any.
+    `error` is the exception the op threw, if any.
+    '''
+
+    def __init__(self):
+        self.responses = []
+        self.status = set()
+
+    def add(self, response):
+        self.responses.append(response)
+        self.status.update(response.get('status', ()))
+
+    def get(self, key):
+        '''Return the value of `key` in the first response that has it.'''
+        for response in self.responses:
+            if key in response:
+                return response[key]
+
+    def join(self, key):
+        pieces = [response[key] for response in self.responses if key in response]
+        return ''.join(pieces) if pieces else None
+
+    @property
+    def value(self):
+        return self.join('value')
+
+    @property
+    def out(self):
+        return self.join('out')
+
+    @property
+    def err(self):
+        return self.join('err')
+
+    @property
+    def error(self):
+        return self.join('nrepl.middleware.caught/throwable') or self.join('ex')
+
+    @property
+    def failed(self):
+        return 'eval-error' in self.status or 'error' in self.status
+
+
+# How many ops a session keeps handlers for at most. When it sends one more,
+# it forgets the oldest.
+MAX_HANDLERS = 1024
+
 
+class CapacityError(RuntimeError):
+    """Raised when a session forgets the handler of an op because it has
+    more ops waiting for a response than it keeps handlers for."""
+
+
+class Session():
     def __init__(self, id, client):
         self.id = id
         self.client = client
-        self.op_count = 0
         self.lock = Lock()
 
-    def op_id(self):
-        with self.lock:
-            self.op_count += 1
+        # The handlers of the ops that aren't done yet, by op ID, oldest
+        # first, with the time they were added.
+        self.handlers = collections.OrderedDict()
+        self.errors = dict()
+        self.evicted = 0
 
-        return self.op_count
+        # The futures of the requests that haven't got a done response yet.
+        self.requests = dict()
+        client.sessions[id] = self
+
+        # The items every op this session sends has, encoded once.
+        self.template = bencode.Template({
+            'session': self.id,
+            'nrepl.middleware.caught/print?': 'true',
+            'nrepl.middleware.print/stream?': 'true'
+        })
 
     def op(self, d):
-        d['session'] = self.id
-        d['id'] = self.op_id()
-        d['nrepl.middleware.caught/print?'] = 'true'
-        d['nrepl.middleware.print/stream?'] = 'true'
-        return d
+        d['id'] = self.client.op_id()
+        return bencode.Templated(self.template, d)
 
     def output(self, x):
         self.client.recvq.put(x)
@@ -39,18 +112,188 @@ class Session():
         if not handler:
             handler = self.client.recvq.put
 
-        self.handlers[op['id']] = handler
+        self.add_handler(op['id'], handler)
+        self.client.latency.enqueued((self.id, op['id']), op.get('op'))
         self.client.sendq.put(op)
 
+    def request(self, op, handler=None):
+        """Send an op and return a concurrent.futures.Future that resolves
+        into a Result once the server has sent every response to it.
+
+        If you give a handler, it gets every response as it arrives, too. The
+        future fails with a ConnectionError if the connection closes first.
+        """
+        future = Future()
+        result = Result()
+        op = self.op(op)
+        id = op['id']
+
+        def collect(response):
+            result.add(response)
+
+            try:
+                if handler:
+                    handler(response)
+            finally:
+                if is_done(response):
+                    self.requests.pop(id, None)
+                    future.set_result(result)
+
+        self.requests[id] = future
+        self.add_handler(id, collect)
+        self.client.latency.enqueued((self.id, id), op.get('op'))
+        self.client.sendq.put(op)
+
+        if self.client.closed:
+            self.abandon()
+
+        return future
+
+    def request_async(self, op, handler=None):
+        """Like request, but return an asyncio future. Call it from a
+        coroutine."""
+        import asyncio
+        return asyncio.wrap_future(self.request(op, handler))
+
+    def request_all(self, ops, max_in_flight=8, stop=None, handlers=None):
+        """Send every op in `ops`, but only `max_in_flight` at a time, and
+        return a future for each op, in order.
+
+        Sends the next op whenever an op in flight is done. At most half of
+        the session's `max_handlers` ops are in flight at a time, so that
+        the ops it sends can't make the session forget the handlers of the
+        ones it's waiting for. If `stop` is a function, it gets the Result
+        of every op. Once it returns true, no more ops go out, and the
+        futures of the ops that didn't go out get cancelled.
+
+        If you give `handlers`, a handler for each op, each one gets every
+        response to its op as it arrives."""
+        futures = [Future() for _ in ops]
+        pending = collections.deque(zip(ops, futures, handlers or [None] * len(ops)))
+        lock = Lock()
+
+        def cancel():
+            with lock:
+                rest = list(pending)
+                pending.clear()
+
+            for _, future, _ in rest:
+                future.cancel()
+
+        def send_next():
+            with lock:
+                if not pending:
+                    return
+
+                op, future, handler = pending.popleft()
+
+            def done(f):
+                if f.exception() is not None:
+                    future.set_exception(f.exception())
+                else:
+                    if stop is not None and stop(f.result()):
+                        cancel()
+
+                    future.set_result(f.result())
+
+                send_next()
+
+            self.request(op, handler).add_done_callback(done)
+
+        max_in_flight = min(max_in_flight, max(1, self.client.max_handlers // 2))
+
+        for _ in range(min(max_in_flight, len(ops))):
+            send_next()
+
+        return futures
+
+    def abandon(self):
+        """Fail the futures of every request still waiting for a response."""
+        for id, future in list(self.requests.items()):
+            self.requests.pop(id, None)
+            self.client.latency.forget((self.id, id))
+
+            with self.lock:
+                self.handlers.pop(id, None)
+
+            if not future.done():
+                future.set_exception(ConnectionError('Connection to nREPL server closed'))
+
+    def add_handler(self, id, handler):
+        with self.lock:
+            self.handlers[id] = (handler, time.monotonic())
+
+        self.sweep()
+
+    def sweep(self):
+        """Forget the handlers of the ops the server never finished: the
+        oldest ones past `client.max_handlers`, and the ones older than
+        `client.handler_ttl` seconds, if it's a number.
+
+        The futures of their requests fail with a CapacityError or a
+        TimeoutError. Return how many handlers it forgot."""
+        max_handlers = self.client.max_handlers
+        ttl = self.client.handler_ttl
+        evicted = []
+
+        with self.lock:
+            while len(self.handlers) > max_handlers:
+                id = self.handlers.popitem(last=False)[0]
+                evicted.append((id, CapacityError('Too many ops waiting, forgot op {}'.format(id))))
+
+            if ttl is not None:
+                deadline = time.monotonic() - ttl
+                expired = []
+
+                # Every handler lives as long, so the oldest expire first.
+                for id, (_, added) in self.handlers.items():
+                    if added > deadline:
+                        break
+
+                    expired.append(id)
+
+                for id in expired:
+                    self.handlers.pop(id, None)
+                    evicted.append((id, TimeoutError('No response to op {} in time'.format(id))))
+
+            self.evicted += len(evicted)
+
+        for id, error in evicted:
+            log.debug({'event': 'session/evict', 'session': self.id, 'id': id})
+            self.client.latency.forget((self.id, id))
+            self.errors.pop(id, None)
+            future = self.requests.pop(id, None)
+
+            if future is not None and not future.done():
+                future.set_exception(error)
+
+        return len(evicted)
+
+    def stats(self):
+        """Return how many handlers and requests are waiting for a response,
+        and how many handlers the session has forgotten."""
+        with self.lock:
+            return {
+                'handlers': len(self.handlers),
+                'requests': len(self.requests),
+                'evicted': self.evicted
+            }
+
     def handle(self, response):
         id = response.get('id')
-        handler = self.handlers.get(id, self.client.recvq.put)
+        done = is_done(response)
+
+        self.client.latency.received((self.id, id), done)
+
+        with self.lock:
+            entry = self.handlers.pop(id, None) if done else self.handlers.get(id)
+
+        handler = entry[0] if entry else self.client.recvq.put
 
         try:
-            handler.__call__(response)
+            handler(response)
         finally:
-            if response.get('status') == ['done']:
-                self.handlers.pop(id, None)
+            if done:
                 self.errors.pop(id, None)
 
     def denounce(self, response):
@@ -62,29 +305,474 @@ class Session():
     def is_denounced(self, response):
         return response.get('id') in self.errors
 
+    def close(self):
+        """Close this session on the server, leaving the connection and the
+        other sessions on it open. Return a Future that resolves once it's
+        closed."""
+        return self.request({'op': 'close'})
+
     def terminate(self):
         self.client.halt()
 
 
+class OrderedOutput(object):
+    '''
+    Prints the responses to a batch of ops in the order of the ops, each
+    after a header of its own, however they arrive.
+
+    The responses to an op wait until every op before it is done. Once it's
+    an op's turn, its responses go out as they arrive.
+    '''
+
+    def __init__(self, session, headers):
+        self.session = session
+        self.headers = headers
+        self.pending = [[] for _ in headers]
+        self.done = [False] * len(headers)
+        self.current = 0
+        self.lock = Lock()
+
+        if headers:
+            session.output(headers[0])
+
+    def handler(self, n):
+        '''Return a handler for the responses to the `n`th op.'''
+        return lambda response: self.receive(n, response)
+
+    def receive(self, n, response):
+        with self.lock:
+            self.pending[n].append(response)
+
+            if is_done(response):
+                self.done[n] = True
+
+            self.flush()
+
+    def flush(self):
+        while self.current < len(self.headers):
+            n = self.current
+
+            for response in self.pending[n]:
+                if is_done(response):
+                    self.session.output({'append': '\n'})
+                else:
+                    self.session.output(response)
+
+            self.pending[n] = []
+
+            if not self.done[n]:
+                return
+
+            self.current += 1
+
+            if self.current < len(self.headers):
+                self.session.output(self.headers[self.current])
+
+
+# Windows versions of Python don't have Unix domain sockets.
+AF_UNIX = getattr(socket, 'AF_UNIX', None)
+
+
+# Ops that can take a while to send and evaluate. Every other op, such as
+# interrupt or close, jumps ahead of these in the send queue.
+BULK_OPS = {'eval', 'load-file'}
+
+# When the client has this many bytes waiting to go into the socket, it
+# stops taking bulk ops from the send queue until the socket catches up, so
+# that other ops don't need to wait behind them.
+SEND_HIGH_WATER = 4 * bencode.CHUNK_SIZE
+
+
+def is_bulk(item):
+    return item is None or item.get('op') in BULK_OPS
+
+
+class SendQueue(queue.Queue):
+    """A queue of ops to send that wakes up its client's engine whenever it
+    gets an item.
+
+    The queue has two lanes. Ops in BULK_OPS go into the bulk lane, every
+    other op into the control lane. You get items from the control lane
+    before items from the bulk lane. A None goes into the bulk lane, so that
+    it comes out after everything put in before it."""
+
+    def __init__(self, client):
+        queue.Queue.__init__(self)
+        self.client = client
+
+    def _init(self, maxsize):
+        self.control = collections.deque()
+        self.bulk = collections.deque()
+
+    def _qsize(self):
+        return len(self.control) + len(self.bulk)
+
+    def _put(self, item):
+        (self.bulk if is_bulk(item) else self.control).append(item)
+
+    def _get(self):
+        return self.control.popleft() if self.control else self.bulk.popleft()
+
+    def put(self, item, block=True, timeout=None):
+        queue.Queue.put(self, item, block, timeout)
+        self.client.wake()
+
+    def take(self, bulk=True):
+        """Get the next item without blocking, or raise queue.Empty.
+
+        If `bulk` is false, only get items from the control lane."""
+        with self.mutex:
+            if self.control:
+                return self.control.popleft()
+            elif bulk and self.bulk:
+                return self.bulk.popleft()
+            else:
+                raise queue.Empty
+
+
+# The keys a response can have if all it has is output. Consecutive
+# responses like that can merge into one.
+OUTPUT_KEYS = {'id', 'session', 'out', 'err', bencode.CONTINUED}
+
+# Output merges into the item before it until the item has this many
+# characters.
+MERGE_LIMIT = 64 * 1024
+
+OVERFLOW_POLICIES = ('block', 'drop', 'spill')
+
+
+def output_key(item):
+    '''Return 'out' or 'err' if all `item` has is output, else None.'''
+    if isinstance(item, dict) and len(item) <= len(OUTPUT_KEYS) and OUTPUT_KEYS.issuperset(item):
+        if 'out' in item:
+            return None if 'err' in item else 'out'
+        elif 'err' in item:
+            return 'err'
+
+    return None
+
+
+def raw_size(item, key):
+    '''Return the size of `item[key]` in bytes, without decoding it if it's
+    still undecoded.'''
+    value = dict.get(item, key)
+    return len(value) if isinstance(value, bytes) else len(value.encode(bencode.ENCODING))
+
+
+class ReceiveQueue(queue.Queue):
+    """A bounded queue of responses and output for the output panel.
+
+    Consecutive output for the same op merges into one item, so a flood of
+    small `out` responses doesn't take up a slot each.
+
+    When the queue has `maxsize` items (or more) in it, `overflow` decides
+    what happens to the next one:
+
+    - 'block': the item goes in, but `should_pause()` tells the client to
+      stop reading from its socket until the consumer has taken half of the
+      items. The server then blocks on its writes, too.
+    - 'drop': output is dropped. In its place goes a single marker that
+      says how many bytes were dropped. Other responses still go in.
+    - 'spill': items go into a temporary file, and come back out of it, in
+      order, once the consumer has emptied the queue.
+
+    A `maxsize` of zero or less means no bound. A None always goes in, and
+    always comes out last. `stats()` has the counters."""
+
+    def __init__(self, maxsize=0, overflow='block'):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('Unknown overflow policy: {}'.format(overflow))
+
+        queue.Queue.__init__(self, maxsize)
+        self.overflow = overflow
+        # Called without arguments when the consumer has drained a paused queue.
+        self.on_drain = None
+        self.paused = False
+        # The item we merged output into last, if we made it ourselves.
+        self.merged = None
+        self.marker = None
+        self.marker_bytes = 0
+        self.spill = None
+        self.spilled = 0
+        self.spill_offset = 0
+        self.spill_decoder = None
+        self.spilled_none = False
+        self.counters = collections.Counter()
+
+    def _init(self, maxsize):
+        self.items = collections.deque()
+
+    def _qsize(self):
+        return len(self.items) + self.spilled + self.spilled_none
+
+    def full(self):
+        with self.mutex:
+            return 0 < self.maxsize <= len(self.items)
+
+    def put(self, item, block=True, timeout=None):
+        """Put `item` into the queue. Never blocks."""
+        with self.mutex:
+            if not self.merge(item):
+                self.enqueue(item)
+
+            depth = self._qsize()
+
+            if depth > self.counters['max_depth']:
+                self.counters['max_depth'] = depth
+
+            self.not_empty.notify()
+
+    def merge(self, item):
+        key = output_key(item)
+
+        if key is None or not self.items or self.spilled or self.spilled_none:
+            return False
+
+        last = self.items[-1]
+
+        if (
+            last is self.marker
+            or output_key(last) != key
+            or last.get('session') != item.get('session')
+            or last.get('id') != item.get('id')
+        ):
+            return False
+
+        text = last[key]
+
+        if len(text) >= MERGE_LIMIT:
+            return False
+
+        # Don't change a response someone else might hold on to.
+        if last is not self.merged:
+            last = self.merged = dict(last.items())
+            self.items[-1] = last
+
+        last[key] = text + item[key]
+        self.counters['merged'] += 1
+        return True
+
+    def enqueue(self, item):
+        # Once items go into the spill file, every item after them must, too,
+        # to keep them in order.
+        if self.spilled or self.spilled_none:
+            self.spill_item(item)
+        elif item is not None and 0 < self.maxsize <= len(self.items):
+            if self.overflow == 'drop' and output_key(item):
+                self.drop(item)
+            elif self.overflow == 'spill':
+                self.spill_item(item)
+            else:
+                self.append(item)
+        else:
+            self.append(item)
+
+    def append(self, item):
+        self.items.append(item)
+        self.unfinished_tasks += 1
+
+    def drop(self, item):
+        size = raw_size(item, output_key(item))
+        self.counters['dropped'] += 1
+        self.counters['dropped_bytes'] += size
+
+        if self.marker is None:
+            self.marker = {}
+            self.marker_bytes = 0
+            self.append(self.marker)
+
+        self.marker_bytes += size
+        self.marker['err'] = '[{} bytes of output elided]\n'.format(self.marker_bytes)
+
+    def spill_item(self, item):
+        if item is None:
+            self.spilled_none = True
+            return
+
+        if self.spill is None:
+            self.spill = tempfile.TemporaryFile()
+            self.spill_offset = 0
+            self.spill_decoder = bencode.Decoder(lazy=True)
+
+        self.spill.seek(0, os.SEEK_END)
+        self.spill.write(bencode.encode(item))
+        self.spilled += 1
+        self.counters['spilled'] += 1
+
+    def unspill(self):
+        """Move up to half a queue worth of items from the spill file back
+        into the queue."""
+        want = max(1, self.maxsize // 2)
+
+        while self.spilled and len(self.items) < want:
+            self.spill.seek(self.spill_offset)
+            data = self.spill.read(bencode.CHUNK_SIZE)
+            self.spill_offset += len(data)
+            self.spill_decoder.feed(data)
+
+            for item in self.spill_decoder:
+                self.items.append(item)
+                self.spilled -= 1
+
+        if not self.spilled:
+            self.spill.close()
+            self.spill = None
+            self.spill_decoder = None
+
+            if self.spilled_none:
+                self.spilled_none = False
+                self.items.append(None)
+
+    def _get(self):
+        if not self.items:
+            self.unspill()
+
+        item = self.items.popleft()
+
+        if item is self.marker:
+            self.marker = None
+        elif item is self.merged:
+            self.merged = None
+
+        if self.paused and len(self.items) <= self.maxsize // 2:
+            self.paused = False
+
+            if self.on_drain is not None:
+                self.on_drain()
+
+        return item
+
+    def should_pause(self):
+        """Return True if whoever puts items into the queue should stop until
+        `on_drain` gets called."""
+        with self.mutex:
+            if self.overflow == 'block' and 0 < self.maxsize <= len(self.items):
+                if not self.paused:
+                    self.counters['paused'] += 1
+
+                self.paused = True
+
+            return self.paused
+
+    def stats(self):
+        """Return the depth of the queue and how many items it has merged,
+        dropped, spilled and paused for."""
+        with self.mutex:
+            stats = {
+                'depth': self._qsize(),
+                'max_depth': 0,
+                'merged': 0,
+                'dropped': 0,
+                'dropped_bytes': 0,
+                'spilled': 0,
+                'spill_pending': self.spilled,
+                'paused': 0
+            }
+
+            stats.update(self.counters)
+            return stats
+
+
 class Client(object):
     '''
     Here's how Client works:
 
-    1. Open a socket connection to the given host and port.
-    2. Start a worker that gets items from a queue and sends them over the
-       socket for evaluation.
-    3. Start a worker that reads bencode strings from the socket,
-       parses them, and puts them into a queue.
+    1. Open a socket connection to the given host and port. If `port` is
+       the path of a Unix domain socket instead, connect to that and ignore
+       `host`.
+
+       TCP connections set TCP_NODELAY unless `nodelay` is false, and
+       `send_buffer_size` and `receive_buffer_size` set the sizes of the
+       socket's buffers, if given.
+    2. Hand the socket over to the I/O engine every Client shares. The
+       engine runs on a single background thread.
+    3. Whenever an item goes into the send queue, the engine encodes every
+       item in the queue into one buffer and writes it into the socket
+       without blocking. If the socket can't take all of it, the engine
+       writes the rest when it can. Ops like `interrupt` and `close` jump
+       ahead of `eval` and `load-file` ops in the queue.
+    4. Whenever the socket has bytes to read, the engine reads them, parses
+       every bencode value that has arrived in full, and hands them off to
+       the session they belong to (or puts them into a queue).
+
+       If `stream_threshold` is a number, string values at least that many
+       bytes long are handed off piece by piece as they arrive, instead of
+       all at once when they've arrived in full.
 
-    Calling `halt()` on a Client will stop the background threads and close
-    the socket connection. Client is a context manager, so you can use it
-    with the `with` statement.
+       `limits` are keyword arguments for bencode.Decoder that limit how
+       deeply nested, long and large responses can be. If a response
+       breaks a limit or isn't valid bencode, the client reports it and
+       closes the connection.
+
+       The queue holds `recvq_size` items, or any number of them if it's
+       zero. `overflow` decides what happens when it's full; see
+       ReceiveQueue.
+
+       Each session keeps the handlers of at most `max_handlers` ops the
+       server hasn't finished, and for at most `handler_ttl` seconds if
+       it's a number; see Session.sweep. The client sweeps every session
+       on the engine thread every `handler_ttl / 2` seconds, too.
+
+    Session handlers run on the engine thread, so they must not block.
+
+    Calling `halt()` on a Client will close the nREPL session and the socket
+    connection. Client is a context manager, so you can use it with the
+    `with` statement.
     '''
 
-    def connect(self):
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.connect((self.host, self.port))
-        self.buffer = self.socket.makefile(mode='rwb')
+    def is_path(self):
+        return isinstance(self.port, str) and not self.port.isdigit()
+
+    def is_unix(self):
+        return AF_UNIX is not None and self.is_path()
+
+    def open_socket(self, family, address, timeout):
+        sock = socket.socket(family, socket.SOCK_STREAM)
+
+        try:
+            if family != AF_UNIX:
+                if self.nodelay:
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+                # Set buffer sizes before connecting so that they count when
+                # the two ends agree on a window size.
+                if self.send_buffer_size:
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.send_buffer_size)
+
+                if self.receive_buffer_size:
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.receive_buffer_size)
+
+            sock.settimeout(timeout)
+            sock.connect(address)
+            return sock
+        except OSError:
+            sock.close()
+            raise
+
+    def connect(self, timeout=None):
+        if self.is_unix():
+            self.socket = self.open_socket(AF_UNIX, os.path.expanduser(self.port), timeout)
+        elif self.is_path():
+            raise OSError('Unix domain sockets are not available on this platform')
+        else:
+            error = None
+
+            # Like socket.create_connection, try every address the host has.
+            for family, _, _, _, address in socket.getaddrinfo(
+                self.host, int(self.port), 0, socket.SOCK_STREAM
+            ):
+                try:
+                    self.socket = self.open_socket(family, address, timeout)
+                    error = None
+                    break
+                except OSError as e:
+                    error = e
+
+            if error is not None:
+                raise error
+
+        self.socket.setblocking(False)
+        recorder.record('socket/connect')
 
         log.debug({
             'event': 'socket/connect',
@@ -98,88 +786,416 @@ class Client(object):
         if self.socket is not None:
             try:
                 self.socket.shutdown(socket.SHUT_RDWR)
-                self.socket.close()
-                log.debug({'event': 'socket/disconnect'})
             except OSError as e:
                 log.debug({'event': 'error', 'exception': e})
+            finally:
+                self.socket.close()
+                log.debug({'event': 'socket/disconnect'})
 
-    def __init__(self, host, port):
+    def __init__(
+        self,
+        host,
+        port,
+        stream_threshold=None,
+        limits=None,
+        recvq_size=0,
+        overflow='block',
+        max_handlers=MAX_HANDLERS,
+        handler_ttl=None,
+        nodelay=True,
+        send_buffer_size=None,
+        receive_buffer_size=None
+    ):
         self.host = host
         self.port = port
-        self.sendq = queue.Queue()
-        self.recvq = queue.Queue()
+        self.nodelay = nodelay
+        self.send_buffer_size = send_buffer_size
+        self.receive_buffer_size = receive_buffer_size
+        self.socket = None
+        self.engine = None
+        self.sendq = SendQueue(self)
+        self.recvq = ReceiveQueue(recvq_size, overflow)
+        self.recvq.on_drain = self.resume
+        # Whether the engine reads from the socket.
+        self.reading = True
+        # The sessions cloned on this connection, by ID.
+        self.sessions = dict()
+        self.max_handlers = max_handlers
+        self.handler_ttl = handler_ttl
+        self.lock = Lock()
+        self.op_count = 0
+        self.latency = latency.Tracker()
+        # The collectors and futures of the ops sent outside of any session
+        # that haven't got a done response yet, by op ID.
+        self.requests = dict()
         self.stop_event = Event()
+        self.closing = False
+        self.closed = False
+        self.outbuf = bytearray()
+        self.chunk = bytearray(bencode.CHUNK_SIZE)
+        # The pieces of a streamed response that arrived before its ID.
+        self.held = []
+
+        # Let handlers decide which string values are worth decoding.
+        self.decoder = bencode.Decoder(
+            lazy=True,
+            stream_threshold=stream_threshold,
+            **(limits or {})
+        )
+
+    def op_id(self):
+        """Return an op ID no other op on this connection has, so that a
+        response can find its session by its ID alone."""
+        with self.lock:
+            self.op_count += 1
+            return self.op_count
+
+    def request(self, op):
+        """Send an op outside of any session, such as `clone` or `describe`,
+        and return a future like Session.request does.
+
+        The op gets a string ID, so that its responses can't be mistaken for
+        those of a session's ops."""
+        future = Future()
+        result = Result()
+
+        id = 'tutkain-{}'.format(self.op_id())
+
+        def collect(response):
+            result.add(response)
+
+            if is_done(response):
+                self.requests.pop(id, None)
+                future.set_result(result)
+
+        self.requests[id] = (collect, future)
+        self.latency.enqueued((None, id), op.get('op'))
+        self.sendq.put(dict(op, id=id))
+
+        if self.closed:
+            self.abandon()
+
+        return future
+
+    def abandon(self):
+        """Fail the futures of every request still waiting for a response."""
+        for id, (_, future) in list(self.requests.items()):
+            self.requests.pop(id, None)
+
+            if not future.done():
+                future.set_exception(ConnectionError('Connection to nREPL server closed'))
+
+    def new_session(self, result):
+        """Return a Session for the result of a `clone` op."""
+        id = result.get('new-session')
+
+        if id is None:
+            raise ConnectionError('nREPL server did not clone a session')
 
-    def clone_session(self):
-        self.sendq.put({'op': 'clone'})
-        id = self.recvq.get().get('new-session')
         return Session(id, self)
 
-    def go(self):
-        self.connect()
+    def clone_session(self, timeout=None):
+        return self.new_session(self.request({'op': 'clone'}).result(timeout))
+
+    def results(self, futures, timeout=None):
+        """Return the Results of `futures`, or raise a TimeoutError if the
+        server hasn't answered every op in `timeout` seconds."""
+        if wait(futures, timeout).not_done:
+            raise TimeoutError('nREPL server did not answer in {} seconds'.format(timeout))
+
+        return [future.result() for future in futures]
+
+    def clone_sessions(self, count, timeout=None):
+        """Clone `count` sessions, sending every op without waiting for the
+        responses to the ones before it, and return them."""
+        futures = [self.request({'op': 'clone'}) for _ in range(count)]
+        return [self.new_session(result) for result in self.results(futures, timeout)]
+
+    def handshake(self, sessions=2, timeout=None):
+        """Clone `sessions` sessions and describe the server, sending every
+        op without waiting for the responses to the ones before it.
 
-        send_loop = Thread(daemon=True, target=self.send_loop)
-        send_loop.name = 'tutkain.client.send_loop'
-        send_loop.start()
+        Return a list of the sessions and the Result of `describe`. Raise a
+        TimeoutError if the server hasn't answered in `timeout` seconds."""
+        futures = [self.request({'op': 'clone'}) for _ in range(sessions)]
+        futures.append(self.request({'op': 'describe'}))
+        results = self.results(futures, timeout)
+        return [self.new_session(result) for result in results[:-1]], results[-1]
 
-        recv_loop = Thread(daemon=True, target=self.recv_loop)
-        recv_loop.name = 'tutkain.client.recv_loop'
-        recv_loop.start()
+    def stats(self):
+        """Return the counters of the receive queue and of every session, and
+        the latency report of every op type."""
+        return {
+            'latency': self.latency.report(),
+            'recvq': self.recvq.stats(),
+            'sessions': {id: session.stats() for id, session in list(self.sessions.items())}
+        }
+
+    def go(self, timeout=None):
+        """Connect to the server, giving up after `timeout` seconds if it's a
+        number, and start doing I/O."""
+        self.connect(timeout)
+        self.engine = engine.get()
+        self.engine.register(self)
+
+        if self.handler_ttl is not None:
+            self.engine.call_later(self.handler_ttl / 2, self.sweep)
 
         return self
 
+    def sweep(self):
+        """Forget the handlers of every session that have outlived
+        `handler_ttl`, and do it again in half of that time, so that ops the
+        server never finishes fail even if no op comes after them.
+
+        Runs on the engine thread."""
+        if self.closed:
+            return
+
+        for session in list(self.sessions.values()):
+            session.sweep()
+
+        self.engine.call_later(self.handler_ttl / 2, self.sweep)
+
     def __enter__(self):
         self.go()
         return self
 
-    def send_loop(self):
-        while True:
-            item = self.sendq.get()
+    def wake(self):
+        if self.engine is not None:
+            self.engine.wake(self)
 
-            if item is None:
+    def flush(self):
+        """Encode every item in the send queue into one buffer, control ops
+        first, and write as much of it into the socket as it takes in one go.
+
+        Runs on the engine thread."""
+        if self.closed:
+            return
+
+        outbuf = self.outbuf
+        written = []
+
+        while not self.closing:
+            try:
+                item = self.sendq.take(bulk=len(outbuf) < SEND_HIGH_WATER)
+            except queue.Empty:
                 break
 
-            log.debug({'event': 'socket/send', 'item': item})
+            if item is None:
+                self.closing = True
+            else:
+                recorder.record('socket/send', item)
+
+                if log.isEnabledFor(DEBUG):
+                    log.debug({'event': 'socket/send', 'item': item})
+
+                bencode.write_value(outbuf, item)
+                written.append(latency.op_key(item))
 
-            bencode.write(self.buffer, item)
+        self.write()
 
-        log.debug({'event': 'thread/exit'})
+        for key in written:
+            self.latency.written(key)
+
+    def write(self):
+        if self.closed:
+            return
+
+        try:
+            if self.outbuf:
+                n = self.socket.send(self.outbuf)
+                del self.outbuf[:n]
+        except BlockingIOError:
+            pass
+        except OSError as e:
+            log.error({'event': 'error', 'exception': e})
+            self.close()
+            return
+
+        self.engine.update(self)
+
+        # We've sent everything we're ever going to send, so tell the server.
+        if self.closing and not self.outbuf:
+            try:
+                self.socket.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+
+    def on_writable(self):
+        # Now that the socket has caught up, there might be room for more bulk
+        # ops.
+        self.flush()
+
+    def resume(self):
+        """Start reading from the socket again after the receive queue made
+        the client stop."""
+        def resume():
+            if not self.closed:
+                recorder.record('client/resume')
+                self.reading = True
+                self.engine.update(self)
+
+        if self.engine is not None:
+            self.engine.call_soon(resume)
 
     def handle(self, response):
-        id = response.get('session')
-        session = sessions.get_by_id(id)
+        request = self.requests.get(response.get('id'))
+
+        if request:
+            self.latency.received((None, response.get('id')), is_done(response))
+            request[0](response)
+            return
+
+        if 'session' in response:
+            session = self.sessions.get(response.get('session'))
+        else:
+            # A piece of a streamed response that arrived before its session.
+            session = self.owner(response.get('id'))
+
+            if session:
+                response['session'] = session.id
 
         if session:
             session.handle(response)
         else:
             self.recvq.put(response)
 
-    def recv_loop(self):
+    def owner(self, id):
+        """Return the session waiting for responses to the op `id`, or
+        None."""
+        if id is not None:
+            for session in list(self.sessions.values()):
+                if id in session.handlers:
+                    return session
+
+    def route(self, item):
+        """Return the items to handle now that `item` has arrived.
+
+        nREPL sorts the keys of a response, so a streamed `err` arrives
+        before the ID and the session of its response do. Hold on to its
+        pieces until they do, and then give the pieces both."""
+        if self.decoder.streaming and 'id' not in item and 'session' not in item:
+            self.held.append(item)
+            return []
+
+        if not self.held:
+            return [item]
+
+        held, self.held = self.held, []
+
+        for piece in held:
+            for key in ('id', 'session'):
+                if key in item:
+                    piece[key] = item[key]
+
+        held.append(item)
+        return held
+
+    def on_readable(self):
+        """Read whatever bytes the socket has and handle every response that
+        has arrived in full.
+
+        Runs on the engine thread."""
+        if self.closed:
+            return
+
         try:
-            while not self.stop_event.is_set():
-                item = bencode.read(self.buffer)
+            # Zero bytes read means the server closed the connection.
+            if not self.decoder.recv(self.socket, self.chunk):
+                self.close()
+                return
+
+            for item in self.decoder:
+                recorder.record('socket/recv', item)
 
-                # nREPL session closed, break loop
+                # nREPL session closed. If it's one of ours, forget it, else
+                # it's the one halt closed, so close the connection.
                 if item.get('status') == ['done', 'session-closed']:
-                    break
+                    session = self.sessions.pop(item.get('session'), None)
+
+                    if session is None:
+                        self.close()
+                        return
+                    else:
+                        session.handle(item)
+                        continue
 
-                log.debug({'event': 'socket/recv', 'item': item})
-                self.handle(item)
+                if log.isEnabledFor(DEBUG):
+                    log.debug({'event': 'socket/recv', 'item': item})
+
+                for response in self.route(item):
+                    try:
+                        self.handle(response)
+                    except Exception as e:
+                        log.error({'event': 'error', 'exception': e}, exc_info=True)
+        except BlockingIOError:
+            return
+        except bencode.DecodeError as e:
+            recorder.record('error/decode', {'error': str(e)})
+
+            log.error({
+                'event': 'error',
+                'exception': e
+            })
+
+            # We can't tell where the next message starts, so all we can do
+            # is tell the user and hang up.
+            self.recvq.put({
+                'err': 'Disconnecting: invalid response from nREPL server: {}\n'.format(e)
+            })
+
+            self.close()
+            return
         except OSError as e:
+            recorder.record('error/socket', {'error': str(e)})
+
             log.error({
                 'event': 'error',
                 'exception': e
             })
-        finally:
-            # If we receive a stop event, put a None into the queue to tell
-            # consumers to stop reading it.
-            self.recvq.put(None)
 
-            log.debug({'event': 'thread/exit'})
+            self.close()
+            return
+
+        if self.stop_event.is_set():
+            self.close()
+        elif self.recvq.should_pause():
+            # Let the server wait until the consumer catches up.
+            recorder.record('client/pause')
+            self.reading = False
+            self.engine.update(self)
+
+    def close(self):
+        """Stop doing I/O and close the socket connection.
 
-            # We've exited the loop that reads from the socket, so we can
-            # close the connection to the socket.
+        Runs on the engine thread."""
+        if self.closed:
+            return
+
+        self.closed = True
+        self.engine.unregister(self)
+
+        self.abandon()
+
+        for session in list(self.sessions.values()):
+            session.abandon()
+
+        # Put a None into the queue to tell consumers to stop reading it.
+        self.recvq.put(None)
+        recorder.record('client/close')
+
+        log.debug({'event': 'client/close'})
+
+        self.disconnect()
+
+    def abort(self):
+        """Close the connection right away, without waiting for the server to
+        close the session."""
+        if self.engine is None:
             self.disconnect()
+        else:
+            self.engine.call_soon(self.close)
 
     def halt(self):
         # Close nREPL session
@@ -188,8 +1204,8 @@ class Client(object):
         # Feed poison pill to input queue.
         self.sendq.put(None)
 
-        # Trigger the kill switch to tell background threads to stop reading
-        # from the socket.
+        # Trigger the kill switch to tell the engine to close the connection
+        # once the server has answered.
         self.stop_event.set()
 
     def __exit__(self, type, value, traceback):
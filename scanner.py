@@ -0,0 +1,212 @@
+'''
+Finds the brackets around a point without a structure index, by reading
+the text in windows that grow as the search goes on, so that finding a
+bracket nearby takes one read and finding one far away takes a few.
+
+To tell which brackets are in strings, comments and character literals,
+it tokenizes the windows it reads and nothing else. Tokenizing has to start
+somewhere the tokenizer knows nothing comes before, so it starts at the
+last line before the point that starts with an opening bracket, which is
+where top-level forms start by convention.
+
+Doesn't need Sublime Text: it reads text with a function you give it, so
+you can test it on any string.
+'''
+import bisect
+import re
+
+from . import tokenizer
+
+
+LBRACKETS = {'(': ')', '[': ']', '{': '}'}
+RBRACKETS = {')': '(', ']': '[', '}': '{'}
+
+BRACKET = re.compile(r'[()\[\]{}]')
+
+# An opening bracket at the start of a line, after the newline before it.
+TOP_LEVEL = re.compile(r'\n[(\[{]')
+
+# How many characters the first window has. Every window after it is twice
+# as large as the one before it.
+WINDOW = 256
+
+
+class Spans(object):
+    '''
+    The spans of text brackets in which don't count, such as strings and
+    comments, as sorted, non-overlapping (begin, end) pairs.
+    '''
+
+    def __init__(self, spans):
+        self.begins = [begin for begin, _ in spans]
+        self.ends = [end for _, end in spans]
+
+    def __contains__(self, point):
+        i = bisect.bisect_right(self.begins, point) - 1
+        return i >= 0 and point < self.ends[i]
+
+
+def windows_before(fetch, point, size=WINDOW):
+    '''Yield where each window before `point` starts and its text, nearest
+    first.'''
+    end = point
+
+    while end > 0:
+        begin = max(0, end - size)
+        yield begin, fetch(begin, end)
+        end = begin
+        size *= 2
+
+
+def windows_after(fetch, point, limit, size=WINDOW):
+    '''Yield where each window between `point` and `limit` starts and its
+    text, nearest first.'''
+    begin = point
+
+    while begin < limit:
+        end = min(limit, begin + size)
+        yield begin, fetch(begin, end)
+        begin = end
+        size *= 2
+
+
+def top_level_start(fetch, point, size=WINDOW):
+    '''Return where the last line before `point` that starts with an opening
+    bracket starts, or 0.'''
+    end = point
+
+    while end > 0:
+        begin = max(0, end - size)
+
+        # Read one more character to see whether the window starts a line.
+        offset = max(0, begin - 1)
+        match = None
+
+        for match in TOP_LEVEL.finditer(fetch(offset, end)):
+            pass
+
+        if match is not None:
+            return offset + match.start() + 1
+
+        end = begin
+        size *= 2
+
+    return 0
+
+
+def tokens_after(fetch, point, limit, size=WINDOW):
+    '''Yield the tokens between `point` and `limit`, with where they start
+    and end in the whole text and their text, nearest first.
+
+    `point` must be where a token starts. A window can end in the middle of
+    a token, so every window but the last one starts over from the last
+    token of the one before it.'''
+    begin = point
+
+    while begin < limit:
+        end = min(limit, begin + size)
+        text = fetch(begin, end)
+        last = None
+
+        for token in tokenizer.tokenize(text):
+            if last is not None:
+                yield tokenizer.Token(last.kind, begin + last.start, begin + last.end), text[last.start:last.end]
+
+            last = token
+
+        if last is None:
+            return
+        elif end == limit:
+            yield tokenizer.Token(last.kind, begin + last.start, begin + last.end), text[last.start:]
+            return
+
+        begin += last.start
+        size *= 2
+
+
+def brackets_after(fetch, point, limit, size=WINDOW):
+    '''Yield every bracket between `point` and `limit` that isn't in a
+    string, comment or character literal, and where it is, nearest first.
+
+    `point` must be where a token starts.'''
+    for token, text in tokens_after(fetch, point, limit, size):
+        if token.kind == 'open' or token.kind == 'close':
+            yield text, token.start
+
+
+def token_at(fetch, point, size=WINDOW):
+    '''Return the token `point` is in, or None.'''
+    for token, _ in tokens_after(fetch, top_level_start(fetch, point, size), point + 1, size):
+        if token.end > point:
+            return token
+
+
+def find_open(fetch, point, ignored=None, size=WINDOW):
+    '''Return the opening bracket of the innermost form that's open at
+    `point` and where it is, or (None, None).
+
+    `fetch(begin, end)` returns the text between `begin` and `end`. If you
+    give `ignored`, brackets at points in it don't count, and nothing gets
+    tokenized.'''
+    if ignored is None:
+        stack = []
+
+        for char, position in brackets_after(fetch, top_level_start(fetch, point, size), point, size):
+            if char in LBRACKETS:
+                stack.append((char, position))
+            elif stack:
+                stack.pop()
+
+        return stack[-1] if stack else (None, None)
+
+    depth = 0
+
+    for begin, text in windows_before(fetch, point, size):
+        for match in reversed(list(BRACKET.finditer(text))):
+            position = begin + match.start()
+
+            if position in ignored:
+                continue
+
+            char = match.group()
+
+            if char in RBRACKETS:
+                depth += 1
+            elif depth > 0:
+                depth -= 1
+            else:
+                return char, position
+
+    return None, None
+
+
+def find_close(fetch, point, limit, closing, ignored=None, size=WINDOW):
+    '''Return the point after the first `closing` bracket after `point` that
+    isn't closing a form that opens after `point`, or None.
+
+    Only brackets of the same type as `closing` count. Without `ignored`,
+    `point` must be where a token starts, such as right after an opening
+    bracket.'''
+    depth = 0
+    opening = RBRACKETS[closing]
+
+    if ignored is None:
+        found = brackets_after(fetch, point, limit, size)
+    else:
+        pattern = re.compile('[{}]'.format(re.escape(opening + closing)))
+
+        found = (
+            (match.group(), begin + match.start())
+            for begin, text in windows_after(fetch, point, limit, size)
+            for match in pattern.finditer(text)
+            if begin + match.start() not in ignored
+        )
+
+    for char, position in found:
+        if char == opening:
+            depth += 1
+        elif char == closing:
+            if depth > 0:
+                depth -= 1
+            else:
+                return position + 1
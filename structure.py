@@ -0,0 +1,244 @@
+'''
+An index of the top-level forms of Clojure source code and of the bracket
+pairs in them, to find the form around a point without reading the text
+again.
+
+Doesn't need Sublime Text, so it works on any string and you can test it
+without an editor.
+'''
+import bisect
+import collections
+
+from . import forms
+from . import tokenizer
+
+from .scanner import WINDOW
+
+
+# A pair of brackets: where its opening and closing brackets are, and
+# whether there's a #, @ or ' right before the opening one. `close` is None
+# if the opening bracket is never closed.
+Pair = collections.namedtuple('Pair', ['open', 'close', 'prefixed'])
+
+# The bracket pairs of one top-level form, relative to where the form
+# starts, in the order their opening brackets are in. `parents` has the
+# index of the pair each pair is in, or -1.
+Pairs = collections.namedtuple('Pairs', ['opens', 'closes', 'parents', 'prefixed'])
+
+# The prefixes that go with the bracket after them in the form around a
+# point.
+PREFIXES = {'#', '@', "'"}
+
+
+def scan(text, start, end):
+    '''Return the bracket pairs in the form between `start` and `end`.'''
+    opens, closes, parents, prefixed = [], [], [], []
+    stack = []
+    previous = None
+
+    for token in tokenizer.significant(text, start, end):
+        if token.kind == 'open':
+            parents.append(stack[-1] if stack else -1)
+            stack.append(len(opens))
+            opens.append(token.start - start)
+            closes.append(None)
+            prefixed.append(
+                previous is not None
+                and previous.kind == 'prefix'
+                and previous.end == token.start
+                and text[previous.start:previous.end] in PREFIXES
+            )
+        elif token.kind == 'close' and stack:
+            closes[stack.pop()] = token.start - start
+
+        previous = token
+
+    return Pairs(opens, closes, parents, prefixed)
+
+
+def scanned(fetch, point, limit, size=WINDOW):
+    '''Yield where every top-level form between `point` and `limit` starts
+    and ends and its bracket pairs, nearest first, reading the text with
+    `fetch(begin, end)` in windows that grow as it goes.
+
+    `point` must be outside of any form. A window can end in the middle of
+    a form, so every window but the last one starts over from the last form
+    of the one before it.'''
+    begin = point
+
+    while begin < limit:
+        end = min(limit, begin + size)
+        text = fetch(begin, end)
+        last = None
+
+        for start, stop in forms.spans(text):
+            if last is not None:
+                yield begin + last[0], begin + last[1], scan(text, *last)
+
+            last = (start, stop)
+
+        if last is None:
+            if end == limit:
+                return
+        elif end == limit:
+            yield begin + last[0], begin + last[1], scan(text, *last)
+            return
+        else:
+            begin += last[0]
+
+        size *= 2
+
+
+class Index(object):
+    '''
+    The top-level forms of a text and the bracket pairs in each of them.
+
+    Finding the pair around a point takes a binary search for the form and
+    another for the pair, and then a step out per level of nesting.
+
+    Call `edit` after every change to the text to rescan only the forms the
+    change touched.
+    '''
+
+    def __init__(self, text):
+        self.starts = []
+        self.ends = []
+        self.pairs = []
+        self.add(text, forms.spans(text))
+
+    def add(self, text, spans):
+        for start, end in spans:
+            self.starts.append(start)
+            self.ends.append(end)
+            self.pairs.append(scan(text, start, end))
+
+    def edit(self, fetch, limit, begin, end, length, size=WINDOW):
+        '''Update the index after the text between `begin` and `end` was
+        replaced with `length` characters.
+
+        `fetch(begin, end)` returns the text between `begin` and `end` after
+        the change, and `limit` is how long that text is. Only the text from
+        the form before the change up to the first form after it that's the
+        same as before gets read.'''
+        delta = length - (end - begin)
+
+        # A change can merge a form with the one before it, so start from
+        # the form before the first one the change could touch.
+        first = bisect.bisect_left(self.starts, begin) - 1
+
+        if first < 0:
+            first, restart = 0, 0
+        else:
+            restart = self.starts[first]
+
+        starts, ends, pairs = self.starts, self.ends, self.pairs
+        self.starts, self.ends, self.pairs = starts[:first], ends[:first], pairs[:first]
+
+        # The first form after the change that might still be where it was.
+        k = bisect.bisect_left(starts, end)
+
+        for start, stop, found in scanned(fetch, restart, limit, size):
+            if start >= begin + length:
+                while k < len(starts) and starts[k] + delta < start:
+                    k += 1
+
+                # Every form from here on is the same as before, only moved.
+                if k < len(starts) and starts[k] + delta == start:
+                    self.starts.extend(start + delta for start in starts[k:])
+                    self.ends.extend(end + delta for end in ends[k:])
+                    self.pairs.extend(pairs[k:])
+                    return
+
+            self.starts.append(start)
+            self.ends.append(stop)
+            self.pairs.append(found)
+
+    def form(self, point):
+        '''Return the index of the top-level form that starts before
+        `point`, or -1.'''
+        return bisect.bisect_left(self.starts, point) - 1
+
+    def pair(self, i, j):
+        pairs = self.pairs[i]
+        close = pairs.closes[j]
+        start = self.starts[i]
+
+        return Pair(
+            start + pairs.opens[j],
+            None if close is None else start + close,
+            pairs.prefixed[j]
+        )
+
+    def enclosing(self, point):
+        '''Return the innermost pair whose opening bracket is before `point`
+        and that doesn't close before it, or None.'''
+        i = self.form(point)
+
+        if i < 0:
+            return None
+
+        pairs = self.pairs[i]
+        offset = point - self.starts[i]
+        j = bisect.bisect_left(pairs.opens, offset) - 1
+
+        while j >= 0:
+            close = pairs.closes[j]
+
+            if close is None or close >= offset:
+                return self.pair(i, j)
+
+            j = pairs.parents[j]
+
+    def opening(self, point):
+        '''Return the pair whose opening bracket is at `point`, or None.'''
+        i = self.form(point + 1)
+
+        if i >= 0:
+            pairs = self.pairs[i]
+            offset = point - self.starts[i]
+            j = bisect.bisect_left(pairs.opens, offset)
+
+            if j < len(pairs.opens) and pairs.opens[j] == offset:
+                return self.pair(i, j)
+
+    def closing(self, point):
+        '''Return the pair whose closing bracket is at `point`, or None.'''
+        pair = self.enclosing(point)
+
+        if pair and pair.close == point:
+            return pair
+
+    def prefixed_opening(self, point):
+        '''Return the pair whose opening bracket is right after a #, @ or '
+        at `point`, or None.'''
+        pair = self.opening(point + 1)
+
+        if pair and pair.prefixed:
+            return pair
+
+    def is_anchor(self, point):
+        '''Return True if `point` is right before an opening bracket or its
+        prefix, or right before or after a closing bracket.'''
+        return bool(
+            self.opening(point)
+            or self.prefixed_opening(point)
+            or self.closing(point)
+            or self.closing(point - 1)
+        )
+
+    def form_at(self, point):
+        '''Return where the form `point` is next to or in starts and ends.
+
+        If `point` is right before an opening bracket or its prefix, or
+        right after a closing bracket, that's the form. Otherwise it's the
+        innermost form `point` is in. Return None if there's no such form or
+        if it never closes.'''
+        pair = (
+            self.opening(point)
+            or self.closing(point - 1)
+            or self.prefixed_opening(point)
+            or self.enclosing(point)
+        )
+
+        if pair and pair.close is not None:
+            return (pair.open - 1 if pair.prefixed else pair.open, pair.close + 1)
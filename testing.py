@@ -0,0 +1,376 @@
+'''
+Runs clojure.test tests and gets their results back as data.
+
+The Clojure code this module sends collects the results of every test var
+with a custom clojure.test/report and returns them as a JSON string, so
+that nothing needs to parse what clojure.test prints.
+'''
+import hashlib
+import json
+import os
+import queue
+import re
+from threading import Lock, Thread
+
+from . import forms
+
+
+# A function that returns its argument as a JSON string.
+JSON = '''
+(fn json [x]
+  (cond
+    (nil? x) "null"
+    (or (true? x) (false? x) (number? x)) (str x)
+    (keyword? x) (json (name x))
+    (string? x) (str \\"
+                     (clojure.string/escape x {\\" "\\\\\\""
+                                               \\\\ "\\\\\\\\"
+                                               \\newline "\\\\n"
+                                               \\return "\\\\r"
+                                               \\tab "\\\\t"})
+                     \\")
+    (map? x) (str "{" (clojure.string/join "," (map (fn [[k v]] (str (json (name k)) ":" (json v))) x)) "}")
+    (coll? x) (str "[" (clojure.string/join "," (map json x)) "]")
+    :else (json (pr-str x))))
+'''.strip()
+
+# Returns the results of running the test vars `vars` evaluates into as a
+# JSON string: {"tests": [...], "errors": [...]}. Each test has its name,
+# namespace, pass, fail and error counts, time_ms and the assertions that
+# failed. Errors are the ones that happened outside of any test, such as in
+# fixtures.
+RUN_TESTS = '''
+(let [json {json}
+      describe (fn [x] (if (instance? Throwable x) (str x) (pr-str x)))
+      tests (atom [])
+      errors (atom [])
+      test (atom nil)
+      report (fn [m]
+               (case (:type m)
+                 :begin-test-var
+                 (let [{:keys [name ns]} (meta (:var m))]
+                   (reset! test {:name (str name) :ns (str (ns-name ns)) :pass 0 :fail 0 :error 0
+                                 :assertions [] :start (System/nanoTime)}))
+                 :end-test-var
+                 (let [t @test]
+                   (swap! tests conj (-> t
+                                         (assoc :time_ms (/ (- (System/nanoTime) (:start t)) 1e6))
+                                         (dissoc :start)))
+                   (reset! test nil))
+                 :pass
+                 (when @test (swap! test update :pass inc))
+                 (:fail :error)
+                 (let [assertion {:type (:type m)
+                                  :file (:file m)
+                                  :line (:line m)
+                                  :message (:message m)
+                                  :testing (clojure.test/testing-contexts-str)
+                                  :expected (describe (:expected m))
+                                  :actual (describe (:actual m))}]
+                   (if @test
+                     (swap! test #(-> % (update (:type m) inc) (update :assertions conj assertion)))
+                     (swap! errors conj assertion)))
+                 nil))]
+  (binding [clojure.test/report report]
+    (clojure.test/test-vars {vars}))
+  (json {:tests @tests :errors @errors}))
+'''
+
+# Evaluates into every test var in the namespace `ns` evaluates into, in the
+# order they're in the file.
+NAMESPACE_VARS = '''
+(->> (ns-interns {ns}) vals (filter (comp :test meta)) (sort-by (comp :line meta)))
+'''
+
+# Evaluates into the test vars `names` in the namespace `ns` evaluates into.
+NAMED_VARS = '''
+(keep #(ns-resolve {ns} %) '[{names}])
+'''
+
+
+def run_tests_code(ns=None, names=None, require=False):
+    '''Return the code that runs the tests `names` in the namespace `ns`, or
+    every test in it. Without `ns`, the tests are in the current namespace
+    of the session. If `require` is true, the code requires the namespace
+    first.'''
+    target = "'{}".format(ns) if ns else '*ns*'
+
+    if names:
+        vars = NAMED_VARS.format(ns=target, names=' '.join(names)).strip()
+    else:
+        vars = NAMESPACE_VARS.format(ns=target).strip()
+
+    # The code is full of braces, so it can't go through str.format.
+    code = RUN_TESTS.replace('{json}', JSON).replace('{vars}', vars).strip()
+
+    if require and ns:
+        code = "(do (require '{}) {})".format(ns, code)
+
+    return code
+
+
+def parse(value):
+    '''Return the results a value of run_tests_code evaluates into, as a
+    dict.
+
+    The value is a Clojure string literal, which is also a valid JSON
+    string literal.'''
+    return json.loads(json.loads(value, strict=False), strict=False)
+
+
+def run_tests(session, code, handler=None, timeout=None):
+    '''Evaluate `code`, which run_tests_code returned, in `session` and
+    return the results. Raise a RuntimeError if evaluating it fails.
+
+    `handler` gets every response, like the output the tests print.'''
+    result = session.request({'op': 'eval', 'code': code}, handler=handler).result(timeout)
+
+    if result.failed or result.value is None:
+        raise RuntimeError((result.error or result.err or 'Evaluation failed.').strip())
+
+    return parse(result.value)
+
+
+def merge(results):
+    '''Merge the results of several runs into one.'''
+    merged = {'tests': [], 'errors': []}
+
+    for result in results:
+        merged['tests'].extend(result.get('tests', []))
+        merged['errors'].extend(result.get('errors', []))
+
+    return merged
+
+
+def summarize(results):
+    '''Return the totals of a run: how many tests and namespaces ran, how
+    many assertions passed, failed and threw, and how long it took.'''
+    tests = results['tests']
+
+    return {
+        'tests': len(tests),
+        'namespaces': len(set(test['ns'] for test in tests)),
+        'pass': sum(test['pass'] for test in tests),
+        'fail': sum(test['fail'] for test in tests),
+        'error': sum(test['error'] for test in tests) + len(results['errors']),
+        'time_ms': sum(test['time_ms'] for test in tests)
+    }
+
+
+def succeeded(results):
+    summary = summarize(results)
+    return summary['fail'] == 0 and summary['error'] == 0
+
+
+def location(assertion):
+    if assertion.get('file'):
+        return ' ({}:{})'.format(assertion['file'], assertion.get('line'))
+
+    return ''
+
+
+def format_results(results):
+    '''Return a summary of a run to print, with every assertion that failed
+    or threw.'''
+    lines = []
+
+    for test in results['tests']:
+        for assertion in test['assertions']:
+            lines.append('{} in {}/{}{}'.format(
+                assertion['type'].upper(), test['ns'], test['name'], location(assertion)
+            ))
+
+            if assertion.get('testing'):
+                lines.append(assertion['testing'])
+
+            if assertion.get('message'):
+                lines.append(assertion['message'])
+
+            lines.append('expected: {}'.format(assertion['expected']))
+            lines.append('  actual: {}'.format(assertion['actual']))
+
+    for assertion in results['errors']:
+        lines.append('ERROR outside of any test{}'.format(location(assertion)))
+
+        if assertion.get('message'):
+            lines.append(assertion['message'])
+
+        lines.append('  actual: {}'.format(assertion['actual']))
+
+    summary = summarize(results)
+
+    lines.append(
+        'Ran {tests} tests in {namespaces} namespaces ({time_ms:.0f} ms): '
+        '{pass} assertions passed, {fail} failed, {error} errors.'.format(**summary)
+    )
+
+    return '\n'.join(lines) + '\n'
+
+
+DEFTEST = re.compile(r'\(\s*(?:[^\s()\[\]{}/]+/)?deftest\s+(?:\^:?[^\s()\[\]{}]+\s+)*([^\s()\[\]{}^]+)')
+
+
+def tests_in(text, regions, found=None):
+    '''Return the deftest forms among the top-level forms of `text` that
+    overlap any of `regions`, a list of (begin, end) pairs, in the order
+    they're in the text, as (form, name) pairs.'''
+    if found is None:
+        found = forms.top_level_forms(text)
+
+    tests = []
+
+    for form in found:
+        if any(begin <= form.end and form.start <= end for begin, end in regions):
+            match = DEFTEST.match(text, form.start, form.end)
+
+            if match:
+                tests.append((form, match.group(1)))
+
+    return tests
+
+
+def run_namespaces(sessions, namespaces, handler=None, timeout=None):
+    '''Require and run the tests of every namespace in `namespaces`, one
+    namespace at a time per session in `sessions`, and return the results
+    of every namespace by name.
+
+    A namespace that fails to load gets an error in place of its
+    results.'''
+    pending = queue.Queue()
+    results = dict()
+
+    for ns in namespaces:
+        pending.put(ns)
+
+    def work(session):
+        while True:
+            try:
+                ns = pending.get_nowait()
+            except queue.Empty:
+                return
+
+            try:
+                code = run_tests_code(ns, require=True)
+                results[ns] = run_tests(session, code, handler=handler, timeout=timeout)
+            except Exception as e:
+                results[ns] = {
+                    'tests': [],
+                    'errors': [{
+                        'type': 'error',
+                        'message': 'Could not run the tests in {}.'.format(ns),
+                        'expected': None,
+                        'actual': str(e)
+                    }]
+                }
+
+    workers = [Thread(daemon=True, target=work, args=(session,)) for session in sessions]
+
+    for worker in workers:
+        worker.name = 'tutkain.run_namespaces'
+        worker.start()
+
+    for worker in workers:
+        worker.join()
+
+    return results
+
+
+# Returns, as a JSON string, which JVM the REPL runs in and a hash of what
+# every loaded namespace but `ns` holds now.
+#
+# The hash is of the identity of the value of every var, so that any def,
+# whether it came from a file or from an unsaved buffer, changes it. A
+# multimethod keeps its identity when you add a method to it, so it counts
+# by its method table instead. Hashing every namespace rather than only the
+# ones `ns` requires means that a change anywhere down the dependency tree
+# counts, too.
+STATE = '''
+(let [json {json}
+      ns (find-ns '{ns})
+      runtime (java.lang.management.ManagementFactory/getRuntimeMXBean)
+      identity-hash (fn [^clojure.lang.Var v]
+                      (if (.hasRoot v)
+                        (let [x (.getRawRoot v)]
+                          (System/identityHashCode
+                            (if (instance? clojure.lang.MultiFn x)
+                              (.getMethodTable ^clojure.lang.MultiFn x)
+                              x)))
+                        0))
+      ns-hash (fn [n] (hash (into {} (for [[sym v] (ns-interns n)] [sym (identity-hash v)]))))]
+  (json {:epoch (str (.getStartTime runtime) "@" (.getName runtime))
+         :state (str (hash (into {} (for [n (all-ns) :when (not= n ns)] [(ns-name n) (ns-hash n)]))))}))
+'''
+
+
+def state_code(ns):
+    '''Return the code that tells which REPL this is and what the namespaces
+    other than `ns` it has loaded are like now.'''
+    return STATE.replace('{json}', JSON).replace('{ns}', ns).strip()
+
+
+def cache_key(text, state):
+    '''Return a hash of the source of a test namespace and of the state of
+    the REPL it runs in.'''
+    digest = hashlib.sha1(text.encode('utf-8'))
+    digest.update(state.encode('utf-8'))
+    return digest.hexdigest()
+
+
+# How many REPLs to keep results for.
+MAX_EPOCHS = 8
+
+
+class ResultCache(object):
+    '''
+    The results of the last test run of every namespace, with the key of
+    its code at the time, kept in a file so that they outlive the
+    connection.
+
+    Results are only good for as long as the REPL that got them runs, so
+    they go by the REPL's epoch: which JVM it runs in and when that
+    started. The cache keeps the results of the MAX_EPOCHS REPLs it saw
+    last, so that windows connected to different REPLs don't clear each
+    other's results.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.epochs = dict()
+        self.lock = Lock()
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as file:
+                self.epochs = dict(json.load(file).get('epochs', {}))
+        except (OSError, ValueError, AttributeError, TypeError):
+            pass
+
+    def save(self):
+        with self.lock:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            temporary = self.path + '.tmp'
+
+            with open(temporary, 'w') as file:
+                json.dump({'epochs': self.epochs}, file)
+
+            os.replace(temporary, self.path)
+
+    def get(self, epoch, ns, key):
+        '''Return the cached results of `ns` on the REPL with `epoch` if its
+        key was `key` when they were cached, or else None.'''
+        entry = self.epochs.get(epoch, {}).get(ns)
+
+        if entry and entry['key'] == key:
+            return entry['results']
+
+    def put(self, epoch, ns, key, results):
+        with self.lock:
+            # Move the epoch to the end, so that the ones left at the start
+            # are the ones seen least recently.
+            entries = self.epochs.pop(epoch, {})
+            entries[ns] = {'key': key, 'results': results}
+            self.epochs[epoch] = entries
+
+            for old in list(self.epochs)[:-MAX_EPOCHS]:
+                del self.epochs[old]
@@ -0,0 +1,244 @@
+import os
+import queue
+import socket
+import uuid
+from threading import Event, Lock, Thread
+
+from tutkain import bencode
+
+
+class FakeServer(object):
+    '''
+    A stand-in for an nREPL server that speaks just enough of the protocol
+    to test and benchmark Client against.
+
+    It answers `clone`, `describe`, `eval`, `interrupt` and `close`. What an
+    `eval` gets depends on what `responses` has for its code:
+
+    - nothing: a value that's the code itself
+    - a string: that value
+    - a list of dicts: those responses, and then a done response
+    - a function: whatever the function returns for the message, which is
+      one of the above
+
+    Every `eval` waits `delay` seconds before it answers, unless it gets
+    interrupted, and prints `out_size` bytes of output before its value,
+    `chunk_size` bytes per response if given. Like in nREPL, each session
+    evaluates one thing at a time, in order.
+
+    It writes every response with a single write, or in writes of
+    `write_size` bytes if given.
+
+    It listens on a Unix domain socket at `path` if you give one, or else on
+    a TCP port. Like nREPL, it leaves Nagle's algorithm on for TCP
+    connections unless `nodelay` is true.
+
+        with FakeServer() as server:
+            with Client(*server.address).go() as client:
+                ...
+    '''
+
+    def __init__(
+        self,
+        responses=None,
+        path=None,
+        nodelay=False,
+        delay=0,
+        out_size=0,
+        chunk_size=None,
+        write_size=None
+    ):
+        self.responses = responses or {}
+        self.connections = []
+        self.path = path
+        self.nodelay = nodelay
+        self.delay = delay
+        self.out_size = out_size
+        self.chunk_size = chunk_size
+        self.write_size = write_size
+
+        if path is None:
+            self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.server.bind(('localhost', 0))
+            self.address = self.server.getsockname()
+        else:
+            self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.server.bind(path)
+            self.address = ('localhost', path)
+
+        self.server.listen(8)
+
+    def start(self):
+        accept_loop = Thread(daemon=True, target=self.accept_loop)
+        accept_loop.name = 'tutkain.test.accept_loop'
+        accept_loop.start()
+        return self
+
+    def stop(self):
+        self.server.close()
+
+        if self.path is not None and os.path.exists(self.path):
+            os.unlink(self.path)
+
+        for conn in self.connections:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+            conn.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+
+    def accept_loop(self):
+        while True:
+            try:
+                conn, _ = self.server.accept()
+            except OSError:
+                break
+
+            if self.nodelay and self.path is None:
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            self.connections.append(conn)
+
+            serve_loop = Thread(daemon=True, target=Connection(self, conn).serve_loop)
+            serve_loop.name = 'tutkain.test.serve_loop'
+            serve_loop.start()
+
+
+class Connection(object):
+    '''One client's connection to a FakeServer.'''
+
+    def __init__(self, server, conn):
+        self.server = server
+        self.conn = conn
+        self.lock = Lock()
+        # The eval queues of the sessions cloned on this connection, by ID.
+        self.sessions = dict()
+        # The interrupt events of the evals in progress, by session ID.
+        self.interrupts = dict()
+
+    def send(self, response):
+        data = bencode.encode(response)
+        size = self.server.write_size or len(data)
+
+        with self.lock:
+            for i in range(0, len(data), size):
+                self.conn.sendall(data[i:i + size])
+
+    def serve_loop(self):
+        decoder = bencode.Decoder()
+        chunk = bytearray(bencode.CHUNK_SIZE)
+
+        try:
+            while decoder.recv(self.conn, chunk):
+                for message in decoder:
+                    self.handle(message)
+        except OSError:
+            pass
+        finally:
+            for evals in self.sessions.values():
+                evals.put(None)
+
+            self.conn.close()
+
+    def base(self, message):
+        response = {'session': message.get('session', 'none')}
+
+        if 'id' in message:
+            response['id'] = message['id']
+
+        return response
+
+    def handle(self, message):
+        op = message.get('op')
+        response = self.base(message)
+
+        if op == 'clone':
+            id = str(uuid.uuid4())
+            self.session(id)
+            self.send(dict(response, **{'new-session': id, 'status': ['done']}))
+        elif op == 'describe':
+            self.send(dict(response, **{
+                'versions': {
+                    'clojure': {'version-string': '1.10.1'},
+                    'nrepl': {'version-string': '0.7.0'}
+                },
+                'status': ['done']
+            }))
+        elif op == 'eval':
+            self.session(message.get('session', 'none')).put(message)
+        elif op == 'interrupt':
+            interrupt = self.interrupts.get(message.get('session', 'none'))
+
+            if interrupt is None:
+                self.send(dict(response, status=['done', 'session-idle']))
+            else:
+                interrupt.set()
+                self.send(dict(response, status=['done']))
+        elif op == 'close':
+            self.send(dict(response, status=['done', 'session-closed']))
+        else:
+            self.send(dict(response, status=['done', 'error', 'unknown-op']))
+
+    def session(self, id):
+        if id not in self.sessions:
+            evals = self.sessions[id] = queue.Queue()
+            eval_loop = Thread(daemon=True, target=self.eval_loop, args=(id, evals))
+            eval_loop.name = 'tutkain.test.eval_loop'
+            eval_loop.start()
+
+        return self.sessions[id]
+
+    def eval_loop(self, id, evals):
+        while True:
+            message = evals.get()
+
+            if message is None:
+                break
+
+            interrupt = self.interrupts[id] = Event()
+
+            try:
+                self.evaluate(message, interrupt)
+            except OSError:
+                break
+            finally:
+                self.interrupts.pop(id, None)
+
+    def evaluate(self, message, interrupt):
+        server = self.server
+        response = self.base(message)
+
+        if server.delay and interrupt.wait(server.delay):
+            self.send(dict(response, status=['interrupted']))
+            self.send(dict(response, status=['done']))
+            return
+
+        if server.out_size:
+            line = '{:0>78}\n'.format('x')
+            out = (line * (server.out_size // len(line) + 1))[:server.out_size]
+            size = server.chunk_size or len(out)
+
+            for i in range(0, len(out), size):
+                self.send(dict(response, out=out[i:i + size]))
+
+        code = message.get('code')
+        script = server.responses.get(code, code)
+
+        if callable(script):
+            script = script(message)
+
+        if isinstance(script, list):
+            for item in script:
+                self.send(dict(response, **item))
+        else:
+            self.send(dict(response, ns='user', value=script))
+
+        self.send(dict(response, status=['done']))
@@ -68,3 +68,226 @@ class TestBencode(TestCase):
         self.client.sendall(b'4spam')
         # TODO: What would be a sensible failure mode?
         self.assertRaises(socket.timeout, bencode.read, self.buffer)
+
+
+class TestDecoder(TestCase):
+    def test_several_values_per_feed(self):
+        decoder = bencode.Decoder()
+        decoder.feed(b'i42e3:foold3:bar4:spamee')
+        self.assertEquals(list(decoder), [42, 'foo', [{'bar': 'spam'}]])
+        self.assertEquals(decoder.buffer, b'')
+
+    def test_one_byte_at_a_time(self):
+        data = b'd3:bar4:spam3:fooli42eee'
+        decoder = bencode.Decoder()
+        values = []
+
+        for i in range(len(data)):
+            decoder.feed(data[i:i + 1])
+            values.extend(decoder)
+
+        self.assertEquals(values, [{'foo': [42], 'bar': 'spam'}])
+
+    def test_keeps_leftover_bytes(self):
+        decoder = bencode.Decoder()
+        decoder.feed(b'i1ei2')
+        self.assertEquals(list(decoder), [1])
+        self.assertEquals(decoder.buffer, b'i2')
+        decoder.feed(b'e')
+        self.assertEquals(list(decoder), [2])
+
+    def test_multibyte_string_split_across_feeds(self):
+        data = '4:äö'.encode('utf-8')
+        decoder = bencode.Decoder()
+        decoder.feed(data[:3])
+        self.assertEquals(list(decoder), [])
+        decoder.feed(data[3:])
+        self.assertEquals(list(decoder), ['äö'])
+
+    def test_decode(self):
+        self.assertEquals(bencode.decode(b'i1e0:le'), [1, '', []])
+
+
+class TestEncoder(TestCase):
+    def test_encode(self):
+        self.assertEquals(
+            bencode.encode({'foo': 42, 'bar': ['spam', 'äö']}),
+            b'd3:barl4:spam4:\xc3\xa4\xc3\xb6e3:fooi42ee'
+        )
+
+    def test_encode_bytes(self):
+        self.assertEquals(bencode.encode([b'spam', b'']), b'l4:spam0:e')
+
+    def test_encoder_reuses_buffer(self):
+        encoder = bencode.Encoder()
+        self.assertEquals(encoder.encode({'op': 'clone'}), b'd2:op5:clonee')
+        self.assertIs(encoder.encode(-1), encoder.buffer)
+        self.assertEquals(encoder.buffer, b'i-1e')
+
+    def test_encode_unsupported(self):
+        self.assertRaises(ValueError, bencode.encode, 1.5)
+
+
+class TestLazyDecoder(TestCase):
+    def decode(self, data):
+        decoder = bencode.Decoder(lazy=True)
+        decoder.feed(data)
+        return next(decoder)
+
+    def test_values_stay_bytes_until_accessed(self):
+        d = self.decode(b'd2:idi1e6:statusl4:donee5:value4:\xc3\xa4\xc3\xb6e')
+        self.assertEquals(dict.get(d, 'value'), b'\xc3\xa4\xc3\xb6')
+        self.assertEquals(d.get('status'), ['done'])
+        self.assertEquals(d.get('id'), 1)
+        self.assertEquals(d['value'], 'äö')
+        self.assertEquals(dict.get(d, 'value'), 'äö')
+
+    def test_equals_decoded_dict(self):
+        d = self.decode(b'd3:bar4:spam3:food3:bazli1e3:quxeee')
+        self.assertEquals(d, {'bar': 'spam', 'foo': {'baz': [1, 'qux']}})
+        self.assertEquals(d.get('foo').get('baz'), [1, 'qux'])
+
+    def test_dict_methods(self):
+        d = self.decode(b'd1:a1:x1:b1:ye')
+        self.assertEquals(d.items(), [('a', 'x'), ('b', 'y')])
+        self.assertEquals(d.values(), ['x', 'y'])
+        self.assertEquals(d.pop('a'), 'x')
+        self.assertEquals(d.pop('a', None), None)
+        self.assertEquals(d.get('c', 'z'), 'z')
+        self.assertEquals(d.setdefault('b'), 'y')
+        self.assertEquals(d.popitem(), ('b', 'y'))
+
+    def test_copies_are_decoded(self):
+        d = self.decode(b'd3:err1:x3:out2:hie')
+
+        # A copy stays lazy.
+        copy = d.copy()
+        self.assertEquals(type(copy), bencode.LazyDict)
+        self.assertEquals(dict.get(copy, 'out'), b'hi')
+        self.assertEquals(copy, {'err': 'x', 'out': 'hi'})
+
+        self.assertEquals(dict(d), {'err': 'x', 'out': 'hi'})
+        self.assertEquals(type(dict(d)['out']), str)
+        self.assertEquals({**d}, {'err': 'x', 'out': 'hi'})
+        self.assertEquals(repr(d), "{'err': 'x', 'out': 'hi'}")
+
+
+class TestStreamingDecoder(TestCase):
+    def feed(self, decoder, *chunks):
+        values = []
+
+        for chunk in chunks:
+            decoder.feed(chunk)
+            values.extend(decoder)
+
+        return values
+
+    def test_streams_large_strings(self):
+        decoder = bencode.Decoder(stream_threshold=8)
+
+        self.assertEquals(
+            self.feed(
+                decoder,
+                b'd2:idi1e3:out13:foo\nba',
+                b'r\nbaz',
+                b'!\n7:session1:xe'
+            ),
+            [
+                {'id': 1, 'out': 'foo\n'},
+                {'id': 1, 'out': 'ba'},
+                {'id': 1, 'out': 'r\n', bencode.CONTINUED: 'true'},
+                {'id': 1, 'out': 'baz'},
+                {'id': 1, 'out': '!\n', 'session': 'x', bencode.CONTINUED: 'true'}
+            ]
+        )
+
+        self.assertEquals(decoder.buffer, b'')
+
+    def test_does_not_stream_strings_that_arrive_in_full(self):
+        decoder = bencode.Decoder(stream_threshold=8)
+
+        self.assertEquals(
+            self.feed(decoder, b'd3:out12:foo\nbar\nbaz!', b'ei1e'),
+            [{'out': 'foo\nbar\nbaz!'}, 1]
+        )
+
+    def test_does_not_stream_small_strings(self):
+        decoder = bencode.Decoder(stream_threshold=8)
+        self.assertEquals(self.feed(decoder, b'd3:out3:f', b'ooe'), [{'out': 'foo'}])
+
+    def test_multibyte_character_split_across_chunks(self):
+        decoder = bencode.Decoder(lazy=True, stream_threshold=4)
+        data = 'd5:value6:äöüe'.encode('utf-8')
+
+        self.assertEquals(
+            self.feed(decoder, data[:11], data[11:13], data[13:14], data[14:]),
+            [
+                {'value': 'ä'},
+                {'value': 'ö', bencode.CONTINUED: 'true'},
+                {'value': 'ü', bencode.CONTINUED: 'true'}
+            ]
+        )
+
+
+class TestDecoderLimits(TestCase):
+    def test_deep_nesting(self):
+        depth = 10000
+        data = b'l' * depth + b'e' * depth
+        decoder = bencode.Decoder(max_depth=None)
+        decoder.feed(data)
+        value = next(decoder)
+
+        for _ in range(depth - 1):
+            value = value[0]
+
+        self.assertEquals(value, [])
+
+    def test_max_depth(self):
+        decoder = bencode.Decoder(max_depth=2)
+        decoder.feed(b'llee')
+        self.assertEquals(list(decoder), [[[]]])
+        decoder.feed(b'llleee')
+        self.assertRaises(bencode.DecodeError, list, decoder)
+
+    def test_max_string_length(self):
+        decoder = bencode.Decoder(max_string_length=4)
+        decoder.feed(b'4:spam')
+        self.assertEquals(list(decoder), ['spam'])
+        # Fails before the string arrives.
+        decoder.feed(b'4000000000:')
+        self.assertRaises(bencode.DecodeError, list, decoder)
+
+    def test_max_message_size(self):
+        decoder = bencode.Decoder(max_message_size=16)
+        decoder.feed(b'd3:foo3:bare')
+        self.assertEquals(list(decoder), [{'foo': 'bar'}])
+        decoder.feed(b'd3:foo100:')
+        self.assertRaises(bencode.DecodeError, list, decoder)
+
+    def test_streamed_strings_do_not_count_towards_message_size(self):
+        decoder = bencode.Decoder(stream_threshold=8, max_message_size=16)
+        decoder.feed(b'd3:out32:' + b'x' * 16)
+        self.assertEquals(list(decoder), [{'out': 'x' * 16}])
+        decoder.feed(b'x' * 16 + b'e')
+        self.assertEquals(list(decoder), [{'out': 'x' * 16, bencode.CONTINUED: 'true'}])
+
+    def test_malformed(self):
+        for data in [b'x', b'i4xe', b'-1:a', b'di1ei2ee', b'd1:ae', b'e', b'1:\xff']:
+            decoder = bencode.Decoder()
+            decoder.feed(data)
+            self.assertRaises(bencode.DecodeError, list, decoder)
+
+
+class TestTemplate(TestCase):
+    def test_templated(self):
+        template = bencode.Template({'session': 'abc', 'b': 'true', 'z': 1})
+
+        for d in [{}, {'op': 'eval', 'code': '(+ 1 2)'}, {'a': 1, 'zz': 2}, {'session': 'def'}]:
+            self.assertEquals(
+                bencode.encode(bencode.Templated(template, d)),
+                bencode.encode(dict(template.dict, **d))
+            )
+
+    def test_interned_keys(self):
+        a, b = bencode.decode(b'd6:statusl4:doneee' b'd6:statusl4:doneee')
+        self.assertIs(list(a.keys())[0], list(b.keys())[0])
@@ -1,4 +1,5 @@
 import sublime
+from types import SimpleNamespace
 from unittest import TestCase
 
 from tutkain import brackets
@@ -128,3 +129,14 @@ class TestBrackets(TestCase):
         self.append_to_view(form)
         for n in range(len(form)):
             self.assertEquals(self.form(n), form)
+
+    def test_update_index_drops_stale_index(self):
+        self.append_to_view('(a)\n(b)')
+        brackets.index(self.view)
+
+        # A change made to the text as it was before the index was built.
+        position = SimpleNamespace(pt=0, change_count=self.view.change_count() - 1)
+        brackets.update_index(self.view, SimpleNamespace(a=position, b=position, str='('))
+
+        self.assertNotIn(self.view.buffer_id(), brackets.indexes)
+        self.assertEquals(self.form(5), '(b)')
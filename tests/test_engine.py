@@ -0,0 +1,61 @@
+import threading
+from unittest import TestCase
+
+from tutkain import sessions
+from tutkain.engine import Engine
+from tutkain.repl import Client
+from tutkain.tests.fake_server import FakeServer
+
+
+class TestEngine(TestCase):
+    @classmethod
+    def setUpClass(self):
+        sessions.wipe()
+        self.server = FakeServer({'(+ 1 2 3)': '6'}).start()
+
+    @classmethod
+    def tearDownClass(self):
+        sessions.wipe()
+        self.server.stop()
+
+    def test_clients_share_one_thread(self):
+        clients = [Client(*self.server.address).go() for _ in range(8)]
+
+        for client in clients:
+            client.sendq.put({'op': 'eval', 'code': '(+ 1 2 3)'})
+
+        for client in clients:
+            self.assertEquals(client.recvq.get(timeout=1).get('value'), '6')
+
+        self.assertEquals(
+            [
+                thread.name for thread in threading.enumerate()
+                if thread.name.startswith('tutkain.') and not thread.name.startswith('tutkain.test.')
+            ],
+            ['tutkain.engine']
+        )
+
+        for client in clients:
+            client.halt()
+
+    def test_halt(self):
+        client = Client(*self.server.address).go()
+        client.halt()
+
+        # The client tells consumers of its queue that it's done.
+        self.assertEquals(client.recvq.get(timeout=1), None)
+        self.assertTrue(client.closed)
+
+    def test_call_later(self):
+        engine = Engine().start()
+        called = []
+        done = threading.Event()
+
+        engine.call_later(0.1, lambda: (called.append('later'), done.set()))
+        engine.call_later(0, lambda: called.append('now'))
+
+        try:
+            self.assertTrue(done.wait(1))
+            self.assertEquals(called, ['now', 'later'])
+        finally:
+            engine.stop()
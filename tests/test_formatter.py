@@ -1,6 +1,7 @@
 
 from unittest import TestCase
 
+from tutkain.bencode import CONTINUED
 from tutkain.formatter import format
 
 
@@ -44,3 +45,9 @@ Boom!'''
             }),
             '#error {\n :cause "Boom!"\n :data {:a 1}\n}'
         )
+
+    def test_format_continued(self):
+        self.assertEquals(
+            format({'id': 1, 'out': 'world!\nBye!\n', CONTINUED: 'true'}),
+            'world!\n;; Bye!\n'
+        )
@@ -0,0 +1,82 @@
+from unittest import TestCase
+
+from tutkain import forms
+
+
+def codes(text):
+    return [text[form.start:form.end] for form in forms.top_level_forms(text)]
+
+
+class TestForms(TestCase):
+    def test_top_level_forms(self):
+        text = '(ns foo.bar)\n\n(defn f [x]\n  (inc x))\n:kw 42 "str"'
+
+        self.assertEquals(codes(text), ['(ns foo.bar)', '(defn f [x]\n  (inc x))', ':kw', '42', '"str"'])
+
+        self.assertEquals(
+            [(form.line, form.column) for form in forms.top_level_forms(text)],
+            [(1, 1), (3, 1), (5, 1), (5, 5), (5, 8)]
+        )
+
+    def test_strings_comments_and_chars(self):
+        text = '(str ")" \\) \\( "\\"(") ; (not a form)\n(def x \\newline)'
+        self.assertEquals(codes(text), ['(str ")" \\) \\( "\\"(")', '(def x \\newline)'])
+
+    def test_reader_macros(self):
+        text = "^:private (defn g []) #?(:clj 1 :cljs 2) #\"[()]\" 'x `(a ~@b) #{1} #(inc %) #inst \"2020\""
+
+        self.assertEquals(
+            codes(text),
+            [
+                '^:private (defn g [])',
+                '#?(:clj 1 :cljs 2)',
+                '#"[()]"',
+                "'x",
+                '`(a ~@b)',
+                '#{1}',
+                '#(inc %)',
+                '#inst "2020"'
+            ]
+        )
+
+    def test_discard(self):
+        self.assertEquals(codes('#_(foo) (bar) #_ #_ a b c'), ['(bar)', 'c'])
+
+    def test_unbalanced(self):
+        self.assertEquals(codes('(a (b) ) (c'), ['(a (b) )', '(c'])
+        self.assertEquals(codes(') (a)'), [')', '(a)'])
+
+    def test_empty(self):
+        self.assertEquals(codes(''), [])
+        self.assertEquals(codes(' ; just a comment'), [])
+
+    def test_namespace(self):
+        text = '(comment)\n(ns ^:no-doc foo.bar-baz\n  (:require [a.b]))'
+        self.assertEquals(forms.namespace(text, forms.top_level_forms(text)), 'foo.bar-baz')
+        self.assertEquals(forms.namespace('(+ 1 2)', forms.top_level_forms('(+ 1 2)')), None)
+
+        form = forms.namespace_form(text, forms.top_level_forms(text))
+        self.assertEquals(text[form.start:form.end], '(ns ^:no-doc foo.bar-baz\n  (:require [a.b]))')
+
+
+class TestEvaluated(TestCase):
+    def test_changed(self):
+        evaluated = forms.Evaluated()
+        before = '(ns foo)\n(defn f [] 1)\n(defn g [] 2)'
+
+        self.assertEquals(len(evaluated.changed(before)), 3)
+
+        for code in codes(before):
+            evaluated.add(code)
+
+        self.assertEquals(evaluated.changed(before), [])
+
+        after = '(ns foo)\n\n(defn f [] 10)\n(defn g [] 2)\n(defn h [] 3)'
+
+        self.assertEquals(
+            [after[form.start:form.end] for form in evaluated.changed(after)],
+            ['(defn f [] 10)', '(defn h [] 3)']
+        )
+
+        # Forms that are gone are forgotten.
+        self.assertEquals(len(evaluated.hashes), 2)
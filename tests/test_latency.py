@@ -0,0 +1,78 @@
+import json
+import os
+import tempfile
+from unittest import TestCase
+
+from tutkain import latency
+from tutkain.repl import Client
+from tutkain.tests.fake_server import FakeServer
+
+
+class TestHistogram(TestCase):
+    def test_percentiles(self):
+        histogram = latency.Histogram()
+
+        for ms in range(1, 101):
+            histogram.add(ms / 1000)
+
+        self.assertEquals(histogram.count, 100)
+        self.assertAlmostEqual(histogram.summary()['mean_ms'], 50.5)
+
+        for p in (50, 95, 99):
+            self.assertGreaterEqual(histogram.percentile(p), p / 1000)
+            self.assertLess(histogram.percentile(p), p / 1000 * latency.GROWTH)
+
+        self.assertEquals(histogram.percentile(100), 0.1)
+
+    def test_empty(self):
+        self.assertEquals(latency.Histogram().summary(), {'count': 0})
+
+
+class TestTracker(TestCase):
+    def test_phases(self):
+        tracker = latency.Tracker()
+        tracker.enqueued(('s', 1), 'eval')
+        tracker.written(('s', 1))
+        tracker.received(('s', 1), False)
+        tracker.received(('s', 1), True)
+        tracker.enqueued(('s', 2), 'stdin')
+        tracker.received(('s', 2), True)
+
+        report = tracker.report()
+        self.assertEquals(set(report), {'eval', 'other'})
+        self.assertEquals(set(report['eval']), set(latency.PHASES))
+        self.assertEquals(report['eval']['total']['count'], 1)
+        self.assertEquals(tracker.pending, {})
+
+    def test_forget(self):
+        tracker = latency.Tracker()
+        tracker.enqueued(('s', 1), 'eval')
+        tracker.forget(('s', 1))
+        tracker.received(('s', 1), True)
+        self.assertEquals(tracker.report(), {})
+
+    def test_export(self):
+        tracker = latency.Tracker()
+        tracker.enqueued((None, 'tutkain-1'), 'clone')
+        tracker.received((None, 'tutkain-1'), True)
+        path = os.path.join(tempfile.mkdtemp(), 'latency.json')
+        latency.export(tracker.report(), path)
+
+        with open(path) as file:
+            self.assertEquals(json.load(file)['ops']['clone']['total']['count'], 1)
+
+
+class TestClientLatency(TestCase):
+    def test_client_tracks_every_op(self):
+        with FakeServer(nodelay=True) as server:
+            with Client(*server.address) as client:
+                session = client.clone_session(timeout=1)
+
+                for future in session.request_all([{'op': 'eval', 'code': str(n)} for n in range(10)]):
+                    future.result(timeout=1)
+
+                report = client.stats()['latency']
+                self.assertEquals(report['clone']['total']['count'], 1)
+                self.assertEquals(report['eval']['total']['count'], 10)
+                self.assertEquals(client.latency.pending, {})
+                self.assertIn('eval', latency.format_report(report))
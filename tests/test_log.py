@@ -0,0 +1,89 @@
+import io
+import json
+import os
+import tempfile
+import threading
+from unittest import TestCase
+
+from tutkain import log
+from tutkain.repl import Client
+from tutkain.tests.fake_server import FakeServer
+
+
+class TestWriter(TestCase):
+    def setUp(self):
+        self.stream = io.StringIO()
+        self.previous = log.handler.setStream(self.stream)
+
+    def tearDown(self):
+        log.stop_writer()
+        log.handler.setStream(self.previous)
+
+    def test_writes_on_background_thread(self):
+        threads = []
+        format = log.handler.format
+
+        def record_thread(record):
+            threads.append(threading.current_thread().name)
+            return format(record)
+
+        log.handler.format = record_thread
+
+        try:
+            log.start_writer()
+            log.log.error('hello')
+            log.stop_writer()
+        finally:
+            del log.handler.format
+
+        self.assertIn('hello', self.stream.getvalue())
+        self.assertEquals(len(threads), 1)
+        self.assertNotEqual(threads[0], threading.current_thread().name)
+
+    def test_writes_right_away_without_writer(self):
+        log.log.error('hello')
+        self.assertIn('hello', self.stream.getvalue())
+
+
+class TestFlightRecorder(TestCase):
+    def test_keeps_latest_events(self):
+        recorder = log.FlightRecorder(3)
+
+        for n in range(5):
+            recorder.record('socket/recv', {'id': n, 'value': str(n)})
+
+        self.assertEquals([event[2] for event in recorder.events], [2, 3, 4])
+
+        recorder.resize(2)
+        self.assertEquals([event[2] for event in recorder.events], [3, 4])
+
+    def test_dump(self):
+        recorder = log.FlightRecorder()
+        recorder.record('socket/send', {'op': 'eval', 'code': '(+ 1 2)', 'id': 1})
+        recorder.record('socket/recv', {'id': 1, 'status': ['done']})
+        recorder.record('client/close')
+        path = os.path.join(tempfile.mkdtemp(), 'flight.jsonl')
+
+        self.assertEquals(recorder.dump(path), 3)
+
+        with open(path) as file:
+            events = [json.loads(line) for line in file]
+
+        self.assertEquals(
+            [(e['event'], e['id'], e['what'], e['keys']) for e in events],
+            [
+                ('socket/send', 1, 'eval', ['op', 'code', 'id']),
+                ('socket/recv', 1, ['done'], ['id', 'status']),
+                ('client/close', None, None, None)
+            ]
+        )
+
+    def test_client_records_wire_events(self):
+        log.recorder.events.clear()
+
+        with FakeServer() as server:
+            with Client(*server.address) as client:
+                client.clone_session(timeout=1)
+
+        events = [event[1] for event in log.recorder.events]
+        self.assertEquals(events[:3], ['socket/connect', 'socket/send', 'socket/recv'])
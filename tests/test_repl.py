@@ -1,36 +1,42 @@
+import os
+import socket
+import tempfile
+import threading
+import time
 from unittest import TestCase
 
-from tutkain.repl import Client
+from tutkain import bencode
+from tutkain import repl
 from tutkain import sessions
+from tutkain.engine import Engine
+from tutkain.repl import CapacityError, Client, OrderedOutput, ReceiveQueue, Session
+from tutkain.tests.fake_server import FakeServer
 
 
-# NOTE: Before you run these tests, you must start an nREPL server at
-# localhost:1234:
-#
-#     $ cd tests/fixtures
-#     $ clojure -A:nrepl/server
 class TestClient(TestCase):
     @classmethod
     def setUpClass(self):
         sessions.wipe()
+        self.server = FakeServer({'(+ 1 2 3)': '6'}).start()
 
     @classmethod
     def tearDownClass(self):
         sessions.wipe()
+        self.server.stop()
 
     def test_client(self):
-        with Client('localhost', 1234) as client:
+        with Client(*self.server.address) as client:
             client.sendq.put({'op': 'eval', 'code': '(+ 1 2 3)'})
-            self.assertEquals(client.recvq.get().get('value'), '6')
+            self.assertEquals(client.recvq.get(timeout=1).get('value'), '6')
 
     def test_client_session(self):
-        with Client('localhost', 1234) as client:
+        with Client(*self.server.address) as client:
             session = client.clone_session()
             session.send({'op': 'eval', 'code': '(+ 1 2 3)'})
-            self.assertEquals(client.recvq.get().get('value'), '6')
+            self.assertEquals(client.recvq.get(timeout=1).get('value'), '6')
 
     def test_session_registry(self):
-        with Client('localhost', 1234) as client:
+        with Client(*self.server.address) as client:
             session = client.clone_session()
             sessions.register(1, 'user', session)
             self.assertEquals(sessions.get_by_id(session.id), session)
@@ -40,7 +46,7 @@ class TestClient(TestCase):
             self.assertEquals(sessions.get_by_owner(1, 'user'), None)
 
     def test_session_registry_wipe(self):
-        with Client('localhost', 1234) as client:
+        with Client(*self.server.address) as client:
             session = client.clone_session()
             sessions.register(1, 'user', session)
             self.assertEquals(sessions.get_by_id(session.id), session)
@@ -48,3 +54,563 @@ class TestClient(TestCase):
             sessions.wipe()
             self.assertEquals(sessions.get_by_id(session.id), None)
             self.assertEquals(sessions.get_by_owner(1, 'user'), None)
+
+    def test_session_handler(self):
+        with Client(*self.server.address) as client:
+            session = client.clone_session()
+            sessions.register(1, 'user', session)
+            responses = []
+            done = threading.Event()
+
+            def handler(response):
+                responses.append(response)
+
+                if response.get('status') == ['done']:
+                    done.set()
+
+            session.send({'op': 'eval', 'code': '(+ 1 2 3)'}, handler=handler)
+            self.assertTrue(done.wait(1))
+            self.assertEquals(responses[0].get('value'), '6')
+            self.assertEquals(responses[0].get('session'), session.id)
+            sessions.deregister(1)
+
+
+    def test_handshake(self):
+        with Client(*self.server.address) as client:
+            (a, b), describe = client.handshake(timeout=1)
+
+            self.assertNotEqual(a.id, b.id)
+            self.assertEquals(set(client.sessions), {a.id, b.id})
+            self.assertEquals(describe.get('versions')['nrepl']['version-string'], '0.7.0')
+
+
+    def test_clone_sessions(self):
+        with Client(*self.server.address) as client:
+            sessions = client.clone_sessions(3, timeout=1)
+
+            self.assertEquals(len(set(session.id for session in sessions)), 3)
+            self.assertEquals(set(client.sessions), set(session.id for session in sessions))
+
+
+    def test_handshake_timeout(self):
+        # A server that accepts connections but never answers.
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(('localhost', 0))
+        server.listen(1)
+
+        try:
+            client = Client(*server.getsockname()).go(timeout=1)
+            self.assertRaises(TimeoutError, client.handshake, 2, 0.1)
+            client.abort()
+        finally:
+            server.close()
+
+
+    def test_clone_session_ignores_other_messages(self):
+        with Client(*self.server.address) as client:
+            client.recvq.put({'out': 'hello'})
+            session = client.clone_session(timeout=1)
+
+            self.assertIn(session.id, client.sessions)
+            self.assertEquals(client.recvq.get_nowait(), {'out': 'hello'})
+
+
+    def test_unix_socket(self):
+        path = os.path.join(tempfile.mkdtemp(), 'nrepl.sock')
+
+        with FakeServer({'(+ 1 2 3)': '6'}, path=path) as server:
+            with Client('localhost', path) as client:
+                self.assertTrue(client.is_unix())
+                session = client.clone_session(timeout=1)
+                result = session.request({'op': 'eval', 'code': '(+ 1 2 3)'}).result(timeout=1)
+                self.assertEquals(result.value, '6')
+
+
+    def test_without_unix_sockets(self):
+        af_unix, repl.AF_UNIX = repl.AF_UNIX, None
+
+        try:
+            client = Client('localhost', os.path.join(tempfile.mkdtemp(), 'nrepl.sock'))
+            self.assertFalse(client.is_unix())
+            self.assertRaises(OSError, client.connect, 1)
+
+            with Client(*self.server.address) as client:
+                self.assertIn(client.clone_session(timeout=1).id, client.sessions)
+        finally:
+            repl.AF_UNIX = af_unix
+
+
+    def test_tcp_socket_options(self):
+        with Client(*self.server.address, receive_buffer_size=1 << 16) as client:
+            self.assertEquals(client.socket.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY), 1)
+            self.assertGreaterEqual(client.socket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF), 1 << 16)
+
+
+    def test_large_message(self):
+        code = '(str "{}")'.format('x' * 1000000)
+
+        with Client(*self.server.address) as client:
+            client.sendq.put({'op': 'eval', 'code': code})
+            self.assertEquals(client.recvq.get(timeout=5).get('value'), code)
+
+
+class RecordingSocket(object):
+    def __init__(self):
+        self.sent = []
+
+    def send(self, data):
+        self.sent.append(bytes(data))
+        return len(data)
+
+
+class TestSendQueue(TestCase):
+    def test_control_ops_jump_ahead(self):
+        client = Client('localhost', 0)
+        client.sendq.put({'op': 'eval', 'code': '1'})
+        client.sendq.put({'op': 'load-file', 'file': '2'})
+        client.sendq.put({'op': 'interrupt'})
+        client.sendq.put(None)
+        client.sendq.put({'op': 'close'})
+
+        items = [client.sendq.get_nowait() for _ in range(client.sendq.qsize())]
+
+        self.assertEquals(
+            items,
+            [
+                {'op': 'interrupt'},
+                {'op': 'close'},
+                {'op': 'eval', 'code': '1'},
+                {'op': 'load-file', 'file': '2'},
+                None
+            ]
+        )
+
+    def test_flush_coalesces_ops_into_one_write(self):
+        client = Client('localhost', 0)
+        client.engine = Engine()
+        client.socket = RecordingSocket()
+
+        for n in range(10):
+            client.sendq.put({'op': 'eval', 'code': str(n)})
+
+        client.sendq.put({'op': 'interrupt'})
+        client.flush()
+
+        self.assertEquals(len(client.socket.sent), 1)
+
+        self.assertEquals(
+            bencode.decode(client.socket.sent[0]),
+            [{'op': 'interrupt'}] + [{'op': 'eval', 'code': str(n)} for n in range(10)]
+        )
+
+
+class TestReceiveQueue(TestCase):
+    def drain(self, q):
+        return [q.get_nowait() for _ in range(q.qsize())]
+
+    def test_merges_output(self):
+        q = ReceiveQueue()
+        response = {'id': 1, 'session': 's', 'out': 'a'}
+        q.put(response)
+        q.put({'id': 1, 'session': 's', 'out': 'b'})
+        q.put({'id': 1, 'session': 's', 'err': 'c'})
+        q.put({'id': 2, 'session': 's', 'err': 'd'})
+        q.put({'id': 2, 'session': 's', 'value': 'e'})
+        q.put({'id': 2, 'session': 's', 'err': 'f'})
+
+        self.assertEquals(
+            self.drain(q),
+            [
+                {'id': 1, 'session': 's', 'out': 'ab'},
+                {'id': 1, 'session': 's', 'err': 'c'},
+                {'id': 2, 'session': 's', 'err': 'd'},
+                {'id': 2, 'session': 's', 'value': 'e'},
+                {'id': 2, 'session': 's', 'err': 'f'}
+            ]
+        )
+
+        # The response someone put into the queue stays as it was.
+        self.assertEquals(response, {'id': 1, 'session': 's', 'out': 'a'})
+        self.assertEquals(q.stats()['merged'], 1)
+
+    def test_merges_lazy_output(self):
+        q = ReceiveQueue()
+        decoder = bencode.Decoder(lazy=True)
+        decoder.feed(bencode.encode({'id': 1, 'out': 'a', 'session': 's'}) * 3)
+
+        for message in decoder:
+            q.put(message)
+
+        self.assertEquals(self.drain(q), [{'id': 1, 'session': 's', 'out': 'aaa'}])
+
+    def test_drop(self):
+        q = ReceiveQueue(2, 'drop')
+
+        for n in range(5):
+            q.put({'id': n, 'out': 'xy'})
+
+        q.put({'id': 5, 'value': '1'})
+        q.put(None)
+
+        self.assertEquals(
+            self.drain(q),
+            [
+                {'id': 0, 'out': 'xy'},
+                {'id': 1, 'out': 'xy'},
+                {'err': '[6 bytes of output elided]\n'},
+                {'id': 5, 'value': '1'},
+                None
+            ]
+        )
+
+        stats = q.stats()
+        self.assertEquals(stats['dropped'], 3)
+        self.assertEquals(stats['dropped_bytes'], 6)
+
+    def test_spill(self):
+        q = ReceiveQueue(4, 'spill')
+        items = [{'id': n, 'value': str(n)} for n in range(20)]
+
+        for item in items:
+            q.put(item)
+
+        q.put(None)
+
+        self.assertEquals(q.qsize(), 21)
+        self.assertEquals(q.stats()['spilled'], 16)
+        self.assertEquals([q.get(timeout=1) for _ in range(21)], items + [None])
+        self.assertEquals(q.stats()['spill_pending'], 0)
+        self.assertIsNone(q.spill)
+
+    def test_block(self):
+        q = ReceiveQueue(4, 'block')
+        drained = []
+        q.on_drain = lambda: drained.append(True)
+
+        for n in range(4):
+            q.put({'id': n, 'value': str(n)})
+            self.assertEquals(q.should_pause(), n == 3)
+
+        # A full queue still takes items.
+        q.put({'id': 4, 'value': '4'})
+        self.assertEquals(q.qsize(), 5)
+
+        q.get_nowait()
+        q.get_nowait()
+        self.assertEquals(drained, [])
+        q.get_nowait()
+        self.assertEquals(drained, [True])
+        self.assertFalse(q.should_pause())
+
+    def test_client_stops_reading_until_consumer_catches_up(self):
+        with FakeServer() as server:
+            with Client(*server.address, recvq_size=2) as client:
+                for n in range(10):
+                    client.sendq.put({'op': 'eval', 'code': str(n)})
+
+                deadline = time.time() + 1
+
+                while client.reading and time.time() < deadline:
+                    time.sleep(0.01)
+
+                self.assertFalse(client.reading)
+                values = []
+
+                while len(values) < 10:
+                    item = client.recvq.get(timeout=1)
+
+                    if 'value' in item:
+                        values.append(item['value'])
+
+                self.assertEquals(values, [str(n) for n in range(10)])
+
+
+class TestRequests(TestCase):
+    @classmethod
+    def setUpClass(self):
+        self.server = FakeServer({'(+ 1 2 3)': '6'}).start()
+
+    @classmethod
+    def tearDownClass(self):
+        self.server.stop()
+
+    def test_request(self):
+        with Client(*self.server.address) as client:
+            session = client.clone_session()
+            result = session.request({'op': 'eval', 'code': '(+ 1 2 3)'}).result(timeout=1)
+            self.assertEquals(result.value, '6')
+            self.assertEquals(result.status, {'done'})
+            self.assertFalse(result.failed)
+            self.assertEquals(len(result.responses), 2)
+
+    def test_request_with_handler(self):
+        with Client(*self.server.address) as client:
+            session = client.clone_session()
+            responses = []
+            session.request({'op': 'eval', 'code': '1'}, handler=responses.append).result(timeout=1)
+            self.assertEquals([response.get('value') for response in responses], ['1', None])
+
+    def test_request_async(self):
+        import asyncio
+
+        with Client(*self.server.address) as client:
+            session = client.clone_session()
+
+            async def evaluate():
+                return await session.request_async({'op': 'eval', 'code': '(+ 1 2 3)'})
+
+            self.assertEquals(asyncio.run(evaluate()).value, '6')
+
+    def test_request_all(self):
+        with Client(*self.server.address) as client:
+            session = client.clone_session()
+            ops = [{'op': 'eval', 'code': str(n)} for n in range(20)]
+            futures = session.request_all(ops, max_in_flight=3)
+
+            self.assertEquals(
+                [future.result(timeout=1).value for future in futures],
+                [str(n) for n in range(20)]
+            )
+
+    def test_interrupt(self):
+        with FakeServer(delay=5) as server:
+            with Client(*server.address) as client:
+                session = client.clone_session(timeout=1)
+                future = session.request({'op': 'eval', 'code': '(Thread/sleep 5000)'})
+                time.sleep(0.1)
+                session.request({'op': 'interrupt'}).result(timeout=1)
+                self.assertEquals(future.result(timeout=1).status, {'interrupted', 'done'})
+
+    def test_chunked_output_in_small_writes(self):
+        with FakeServer(out_size=100000, chunk_size=4096, write_size=1000) as server:
+            with Client(*server.address, stream_threshold=8192) as client:
+                session = client.clone_session(timeout=1)
+                result = session.request({'op': 'eval', 'code': '1'}).result(timeout=5)
+                self.assertEquals(len(result.out), 100000)
+                self.assertEquals(result.value, '1')
+
+    def test_scripted_responses(self):
+        script = {
+            'boom': [{'err': 'Oops\n'}, {'ex': 'class java.lang.Exception', 'status': ['eval-error']}],
+            'echo': lambda message: message['code'] * 2
+        }
+
+        with FakeServer(script) as server:
+            with Client(*server.address) as client:
+                session = client.clone_session(timeout=1)
+                result = session.request({'op': 'eval', 'code': 'boom'}).result(timeout=1)
+                self.assertTrue(result.failed)
+                self.assertEquals(result.err, 'Oops\n')
+
+                result = session.request({'op': 'eval', 'code': 'echo'}).result(timeout=1)
+                self.assertEquals(result.value, 'echoecho')
+
+    def test_request_all_stops(self):
+        from concurrent.futures import CancelledError
+
+        script = {'boom': [{'ex': 'class java.lang.Exception', 'status': ['eval-error']}]}
+
+        with FakeServer(script) as server:
+            with Client(*server.address) as client:
+                session = client.clone_session(timeout=1)
+                codes = ['1', 'boom', '3', '4', '5']
+
+                futures = session.request_all(
+                    [{'op': 'eval', 'code': code} for code in codes],
+                    max_in_flight=1,
+                    stop=lambda result: result.failed
+                )
+
+                self.assertEquals(futures[0].result(timeout=1).value, '1')
+                self.assertTrue(futures[1].result(timeout=1).failed)
+
+                for future in futures[2:]:
+                    self.assertRaises(CancelledError, future.result, 1)
+
+    def test_request_all_handlers(self):
+        with FakeServer() as server:
+            with Client(*server.address) as client:
+                session = client.clone_session(timeout=1)
+                received = [[], []]
+
+                futures = session.request_all(
+                    [{'op': 'eval', 'code': '1'}, {'op': 'eval', 'code': '2'}],
+                    handlers=[received[0].append, received[1].append]
+                )
+
+                for future in futures:
+                    future.result(timeout=1)
+
+                self.assertEquals(
+                    [[response.get('value') for response in responses] for responses in received],
+                    [['1', None], ['2', None]]
+                )
+
+    def test_request_fails_when_connection_closes(self):
+        with FakeServer() as server:
+            client = Client(*server.address).go()
+            session = client.clone_session()
+
+        future = session.request({'op': 'eval', 'code': '1'})
+        self.assertRaises(ConnectionError, future.result, 1)
+
+
+class RecordingSession(object):
+    def __init__(self):
+        self.outputs = []
+
+    def output(self, x):
+        self.outputs.append(x)
+
+
+class TestOrderedOutput(TestCase):
+    def test_prints_in_op_order(self):
+        session = RecordingSession()
+        output = OrderedOutput(session, [{'out': 'a'}, {'out': 'b'}, {'out': 'c'}])
+
+        # The responses to the last op arrive first and wait.
+        output.handler(2)({'value': '3'})
+        output.handler(2)({'status': ['done']})
+        output.handler(0)({'value': '1'})
+        output.handler(1)({'out': 'two'})
+        self.assertEquals(session.outputs, [{'out': 'a'}, {'value': '1'}])
+
+        output.handler(0)({'status': ['done']})
+        output.handler(1)({'value': '2'})
+        output.handler(1)({'status': ['done']})
+
+        self.assertEquals(
+            session.outputs,
+            [
+                {'out': 'a'}, {'value': '1'}, {'append': '\n'},
+                {'out': 'b'}, {'out': 'two'}, {'value': '2'}, {'append': '\n'},
+                {'out': 'c'}, {'value': '3'}, {'append': '\n'}
+            ]
+        )
+
+
+class ChunkedSocket(object):
+    '''A socket that has `chunks` to read, one per read.'''
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+
+    def recv_into(self, buf):
+        chunk = self.chunks.pop(0)
+        buf[:len(chunk)] = chunk
+        return len(chunk)
+
+
+class TestStreaming(TestCase):
+    def test_streamed_pieces_go_to_handler(self):
+        client = Client('localhost', 0, stream_threshold=4)
+        session = Session('s', client)
+        received = []
+        future = session.request({'op': 'eval', 'code': '1'}, handler=received.append)
+        id, = session.handlers
+
+        # nREPL sorts keys, so the out pieces arrive before the session, and
+        # the err pieces before the ID, too.
+        data = b''.join(bencode.encode(response) for response in [
+            {'err': 'e1\ne2\n', 'id': id, 'session': 's'},
+            {'id': id, 'out': 'o1\no2\n', 'session': 's'},
+            {'id': id, 'session': 's', 'status': ['done']}
+        ])
+
+        # Split both strings after their first line.
+        chunks = []
+
+        for line in (b'e1\n', b'o1\n'):
+            end = data.index(line) + len(line)
+            chunks.append(data[:end])
+            data = data[end:]
+
+        client.socket = ChunkedSocket(chunks + [data])
+
+        for _ in range(3):
+            client.on_readable()
+
+        self.assertEquals(
+            [(r.get('err'), r.get('out'), r.get('id'), r.get('session')) for r in received],
+            [
+                ('e1\n', None, id, 's'),
+                ('e2\n', None, id, 's'),
+                (None, 'o1\n', id, 's'),
+                (None, 'o2\n', id, 's'),
+                (None, None, id, 's')
+            ]
+        )
+
+        self.assertEquals(future.result(timeout=0).out, 'o1\no2\n')
+        self.assertEquals(future.result(timeout=0).err, 'e1\ne2\n')
+        self.assertTrue(client.recvq.empty())
+
+
+class TestSessionHandlers(TestCase):
+    def test_sessions_have_their_own_handlers(self):
+        client = Client('localhost', 0)
+        a = Session('a', client)
+        b = Session('b', client)
+        responses = []
+
+        a.send({'op': 'eval', 'code': '1'}, handler=lambda r: responses.append(('a', r)))
+        b.send({'op': 'eval', 'code': '2'}, handler=lambda r: responses.append(('b', r)))
+        a.handle({'id': 1, 'session': 'a', 'value': '1'})
+        b.handle({'id': 2, 'session': 'b', 'value': '2'})
+
+        self.assertEquals([(owner, r['value']) for owner, r in responses], [('a', '1'), ('b', '2')])
+
+        # Op IDs are unique across sessions, so a response without a session
+        # still finds its handler.
+        client.handle({'id': 2, 'out': 'x'})
+        self.assertEquals(responses[-1], ('b', {'id': 2, 'session': 'b', 'out': 'x'}))
+
+    def test_any_done_status_removes_handler(self):
+        client = Client('localhost', 0)
+        session = Session('a', client)
+        session.send({'op': 'eval', 'code': '(Thread/sleep 1000)'}, handler=lambda r: None)
+        self.assertEquals(session.stats()['handlers'], 1)
+
+        session.handle({'id': 1, 'session': 'a', 'status': ['done', 'interrupted']})
+        self.assertEquals(session.stats()['handlers'], 0)
+
+    def test_evicts_oldest_handlers(self):
+        client = Client('localhost', 0, max_handlers=2)
+        session = Session('a', client)
+        futures = [session.request({'op': 'eval', 'code': str(n)}) for n in range(3)]
+
+        self.assertRaises(CapacityError, futures[0].result, 0)
+        self.assertFalse(futures[1].done())
+        self.assertEquals(session.stats(), {'handlers': 2, 'requests': 2, 'evicted': 1})
+
+        # Responses to forgotten ops go into the receive queue.
+        session.handle({'id': 1, 'session': 'a', 'value': '0'})
+        self.assertEquals(client.recvq.get_nowait(), {'id': 1, 'session': 'a', 'value': '0'})
+
+    def test_request_all_stays_below_capacity(self):
+        client = Client('localhost', 0, max_handlers=4)
+        session = Session('a', client)
+        futures = session.request_all([{'op': 'eval', 'code': str(n)} for n in range(10)], max_in_flight=10)
+
+        self.assertEquals(session.stats(), {'handlers': 2, 'requests': 2, 'evicted': 0})
+        self.assertFalse(any(future.done() for future in futures))
+
+    def test_evicts_expired_handlers(self):
+        client = Client('localhost', 0, handler_ttl=0.05)
+        session = Session('a', client)
+        future = session.request({'op': 'eval', 'code': '(loop [] (recur))'})
+
+        self.assertEquals(session.sweep(), 0)
+        time.sleep(0.1)
+        self.assertEquals(session.sweep(), 1)
+        self.assertRaises(TimeoutError, future.result, 0)
+        self.assertEquals(client.stats()['sessions']['a']['handlers'], 0)
+
+    def test_sweeps_idle_sessions(self):
+        with FakeServer(delay=5) as server:
+            with Client(*server.address, handler_ttl=0.1) as client:
+                session = client.clone_session(timeout=1)
+                future = session.request({'op': 'eval', 'code': '(Thread/sleep 5000)'})
+
+                # No other op comes along to trigger a sweep.
+                self.assertRaises(TimeoutError, future.result, 1)
@@ -0,0 +1,97 @@
+from unittest import TestCase
+
+from tutkain import scanner
+from tutkain import tokenizer
+
+
+class Text(object):
+    '''A text that counts how many times and how much of it you fetch.'''
+
+    def __init__(self, text):
+        self.text = text
+        self.fetches = 0
+        self.fetched = 0
+
+    def fetch(self, begin, end):
+        self.fetches += 1
+        self.fetched += end - begin
+        return self.text[begin:end]
+
+
+def literals(text):
+    return scanner.Spans([
+        (token.start + (2 if token.kind == 'regex' else 0 if token.kind == 'comment' else 1), token.end)
+        for token in tokenizer.tokenize(text)
+        if token.kind in ('string', 'regex', 'char', 'comment')
+    ])
+
+
+def form(text, point, size=scanner.WINDOW, ignored=None):
+    fetch = Text(text).fetch
+    lbracket, lpoint = scanner.find_open(fetch, point, ignored, size)
+
+    if lbracket:
+        rpoint = scanner.find_close(fetch, lpoint + 1, len(text), scanner.LBRACKETS[lbracket], ignored, size)
+        return text[lpoint:rpoint]
+
+
+class TestScanner(TestCase):
+    def test_finds_form(self):
+        text = '(a {:b :c} [:d] )'
+        self.assertEquals(form(text, 5), '{:b :c}')
+        self.assertEquals(form(text, 12), '[:d]')
+        self.assertEquals(form(text, 16), text)
+
+    def test_ignores_strings_comments_and_chars(self):
+        for text in ['(a "()" \\) #"[(]" ; )\n b)', '(merge {"A" :B})']:
+            self.assertEquals(form(text, len(text) - 1), text)
+            self.assertEquals(form(text, len(text) - 1, ignored=literals(text)), text)
+
+    def test_outside_of_forms(self):
+        self.assertEquals(form('"#{"', 1), None)
+        self.assertEquals(form('(a) b', 4), None)
+
+    def test_small_windows(self):
+        text = '(ns a)\n(defn f [x]\n  (let [y "(\\")" z \\)]\n    {:y y}))\n(def b ; )\n  [])'
+
+        for point in range(1, len(text)):
+            expected = form(text, point, ignored=literals(text))
+            self.assertEquals(form(text, point, size=1), expected)
+            self.assertEquals(form(text, point, size=3), expected)
+            self.assertEquals(form(text, point, size=1, ignored=literals(text)), expected)
+
+    def test_top_level_start(self):
+        text = Text('(ns a)\n\n(defn f [x]\n  (inc x))\n')
+
+        for size in (1, 4, scanner.WINDOW):
+            self.assertEquals(scanner.top_level_start(text.fetch, 3, size), 0)
+            self.assertEquals(scanner.top_level_start(text.fetch, 9, size), 8)
+            self.assertEquals(scanner.top_level_start(text.fetch, 30, size), 8)
+
+    def test_token_at(self):
+        text = Text('(a "b c" ; d\n e)')
+        self.assertEquals(scanner.token_at(text.fetch, 5, 2).kind, 'string')
+        self.assertEquals(scanner.token_at(text.fetch, 11, 2).kind, 'comment')
+        self.assertEquals(scanner.token_at(text.fetch, 14, 2).kind, 'atom')
+
+    def test_reads_the_top_level_form_only(self):
+        forms = '(def x "{}")\n' * 10000
+        text = Text(forms + '(defn f [x]\n  (let [y (inc x)]\n    {:y y}))\n' + forms)
+        point = len(forms) + 30
+
+        lbracket, lpoint = scanner.find_open(text.fetch, point)
+        self.assertEquals(text.text[lpoint:lpoint + 9], '(let [y (')
+        rpoint = scanner.find_close(text.fetch, lpoint + 1, len(text.text), ')')
+        self.assertEquals(text.text[lpoint:rpoint], '(let [y (inc x)]\n    {:y y})')
+        self.assertLess(text.fetched, 4 * scanner.WINDOW)
+
+    def test_fetches_in_growing_windows(self):
+        text = Text('(do ' + 'x ' * 100000 + ')')
+
+        self.assertEquals(scanner.find_open(text.fetch, 150000), ('(', 0))
+        self.assertEquals(scanner.find_close(text.fetch, 1, len(text.text), ')'), len(text.text))
+
+        # Finding where the form starts, tokenizing up to 150,000 and then
+        # the 50,000 characters after it each take about log2(n / 256)
+        # windows.
+        self.assertLess(text.fetches, 40)
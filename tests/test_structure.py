@@ -0,0 +1,109 @@
+import random
+from unittest import TestCase
+
+from tutkain import structure
+
+
+class Text(object):
+    '''A text that counts how much of it you fetch.'''
+
+    def __init__(self, text):
+        self.text = text
+        self.fetched = 0
+
+    def fetch(self, begin, end):
+        self.fetched += end - begin
+        return self.text[begin:end]
+
+
+def edit(index, text, begin, end, length, size=structure.WINDOW):
+    index.edit(Text(text).fetch, len(text), begin, end, length, size)
+
+
+def form(text, point):
+    region = structure.Index(text).form_at(point)
+
+    if region:
+        return text[region[0]:region[1]]
+
+
+class TestIndex(TestCase):
+    def test_form_at(self):
+        text = '(+ 1 2)'
+
+        for point in range(len(text) + 1):
+            self.assertEquals(form(text, point), text)
+
+        text = '[1 [2 3] 4]'
+        self.assertEquals(form(text, 0), text)
+        self.assertEquals(form(text, len(text)), text)
+        self.assertEquals(form(text, 3), '[2 3]')
+        self.assertEquals(form(text, 5), '[2 3]')
+        self.assertEquals(form(text, 8), '[2 3]')
+
+    def test_prefixes(self):
+        text = "(a #{1} #(inc %) @(b) '(c))"
+        self.assertEquals(form(text, 3), '#{1}')
+        self.assertEquals(form(text, 8), '#(inc %)')
+        self.assertEquals(form(text, 12), '#(inc %)')
+        self.assertEquals(form(text, 17), '@(b)')
+        self.assertEquals(form(text, 22), "'(c)")
+
+    def test_ignores_strings_comments_and_chars(self):
+        text = '(str "(" \\) ; )\n 1)'
+
+        for point in (1, 6, 9, 14, 18):
+            self.assertEquals(form(text, point), text)
+
+    def test_outside_of_forms(self):
+        self.assertEquals(form('(a) b', 4), None)
+        self.assertEquals(form('(a', 1), None)
+        self.assertEquals(form('', 0), None)
+
+    def test_is_anchor(self):
+        index = structure.Index('(a) #(b) c')
+        anchors = [point for point in range(11) if index.is_anchor(point)]
+        self.assertEquals(anchors, [0, 2, 3, 4, 5, 7, 8])
+
+    def assertSameIndex(self, index, text):
+        fresh = structure.Index(text)
+        self.assertEquals(index.starts, fresh.starts)
+        self.assertEquals(index.ends, fresh.ends)
+        self.assertEquals(index.pairs, fresh.pairs)
+
+    def test_edit(self):
+        text = '(ns a)\n\n(defn f [x]\n  (inc x))\n\n(def y "z")\n'
+        index = structure.Index(text)
+
+        # Open a string that swallows the rest of the text, then close it.
+        edited = text[:10] + '"' + text[10:]
+        edit(index, edited, 10, 10, 1)
+        self.assertSameIndex(index, edited)
+
+        edit(index, text, 10, 11, 0)
+        self.assertSameIndex(index, text)
+
+    def test_random_edits(self):
+        rng = random.Random(42)
+        pieces = ['(', ')', '[', ']', '{', '}', '"', ';', '\n', ' ', 'a', '\\', '#', '#_', "'", '@']
+        text = '(ns a)\n(defn f [x] (g x))\n#_(h)\n(def m {:a [1 2]})\n(str "b" \\c)\n'
+        index = structure.Index(text)
+
+        for i in range(500):
+            begin = rng.randint(0, len(text))
+            end = min(len(text), begin + rng.randint(0, 4))
+            inserted = ''.join(rng.choice(pieces) for _ in range(rng.randint(0, 3)))
+            text = text[:begin] + inserted + text[end:]
+            edit(index, text, begin, end, len(inserted), size=[1, 4, 256][i % 3])
+            self.assertSameIndex(index, text)
+
+    def test_edit_reads_only_the_forms_it_touches(self):
+        forms = '(def x "{}")\n' * 10000
+        text = forms + '(defn f [x]\n  (inc x))\n' + forms
+        index = structure.Index(text)
+        point = len(forms) + 17
+
+        edited = Text(text[:point] + ' 1' + text[point:])
+        index.edit(edited.fetch, len(edited.text), point, point, 2)
+        self.assertSameIndex(index, edited.text)
+        self.assertLess(edited.fetched, 2 * structure.WINDOW)
@@ -0,0 +1,150 @@
+import json
+import os
+import tempfile
+from unittest import TestCase
+
+from tutkain import testing
+from tutkain.repl import Client
+from tutkain.tests.fake_server import FakeServer
+
+
+def value(results):
+    '''Return `results` the way nREPL prints the JSON string the test
+    runner code evaluates into.'''
+    return json.dumps(json.dumps(results))
+
+
+def result(name, ns='foo.bar-test', passed=1, assertions=()):
+    return {
+        'name': name,
+        'ns': ns,
+        'pass': passed,
+        'fail': len([a for a in assertions if a['type'] == 'fail']),
+        'error': len([a for a in assertions if a['type'] == 'error']),
+        'time_ms': 1.5,
+        'assertions': list(assertions)
+    }
+
+
+FAILURE = {
+    'type': 'fail',
+    'file': 'bar_test.clj',
+    'line': 12,
+    'message': None,
+    'testing': 'when "quoted"',
+    'expected': '(= 1 2)',
+    'actual': '(not (= 1 2))'
+}
+
+
+class TestResults(TestCase):
+    def test_parse(self):
+        results = {'tests': [result('a', assertions=[FAILURE])], 'errors': []}
+        self.assertEquals(testing.parse(value(results)), results)
+
+    def test_summarize(self):
+        results = testing.merge([
+            {'tests': [result('a'), result('b', assertions=[FAILURE])], 'errors': []},
+            {'tests': [result('c', ns='baz-test')], 'errors': [dict(FAILURE, type='error')]}
+        ])
+
+        self.assertEquals(
+            testing.summarize(results),
+            {'tests': 3, 'namespaces': 2, 'pass': 3, 'fail': 1, 'error': 1, 'time_ms': 4.5}
+        )
+
+        self.assertFalse(testing.succeeded(results))
+
+        text = testing.format_results(results)
+        self.assertIn('FAIL in foo.bar-test/b (bar_test.clj:12)', text)
+        self.assertIn('ERROR outside of any test', text)
+        self.assertTrue(text.endswith('3 assertions passed, 1 failed, 1 errors.\n'))
+
+    def test_run_tests_code(self):
+        code = testing.run_tests_code('foo.bar-test', ['a', 'b'], require=True)
+        self.assertTrue(code.startswith("(do (require 'foo.bar-test) (let"))
+        self.assertIn("(ns-resolve 'foo.bar-test %) '[a b]", code)
+        self.assertIn('(ns-interns *ns*)', testing.run_tests_code())
+
+    def test_tests_in(self):
+        text = '(ns foo-test)\n(deftest ^:slow a (is 1))\n(defn f [])\n(t/deftest b)'
+
+        self.assertEquals(
+            [name for _, name in testing.tests_in(text, [(0, len(text))])],
+            ['a', 'b']
+        )
+
+        self.assertEquals(testing.tests_in(text, [(5, 5)]), [])
+        self.assertEquals([name for _, name in testing.tests_in(text, [(20, 20)])], ['a'])
+
+
+class TestRunNamespaces(TestCase):
+    def test_run_namespaces(self):
+        script = {
+            testing.run_tests_code('a-test', require=True): value(
+                {'tests': [result('a')], 'errors': []}
+            ),
+            testing.run_tests_code('b-test', require=True): [
+                {'ex': 'class java.io.FileNotFoundException', 'status': ['eval-error']}
+            ]
+        }
+
+        with FakeServer(script) as server:
+            with Client(*server.address).go() as client:
+                sessions = client.clone_sessions(2, timeout=1)
+                results = testing.run_namespaces(sessions, ['a-test', 'b-test'], timeout=1)
+
+                self.assertEquals(results['a-test']['tests'][0]['name'], 'a')
+                self.assertEquals(results['b-test']['tests'], [])
+                self.assertIn('FileNotFoundException', results['b-test']['errors'][0]['actual'])
+
+                # Closing the sessions leaves the connection open.
+                for session in sessions:
+                    session.close().result(timeout=1)
+
+                self.assertEquals(client.sessions, {})
+                self.assertFalse(client.closed)
+
+
+class TestResultCache(TestCase):
+    def test_cache(self):
+        path = os.path.join(tempfile.mkdtemp(), 'Tutkain', 'test-results.json')
+        results = {'tests': [result('a')], 'errors': []}
+        key = testing.cache_key('(ns a-test)', '1')
+
+        self.assertNotEqual(key, testing.cache_key('(ns a-test)', '2'))
+
+        cache = testing.ResultCache(path)
+        self.assertEquals(cache.get('1000@1', 'a-test', key), None)
+        cache.put('1000@1', 'a-test', key, results)
+        cache.save()
+
+        # The cache outlives the connection...
+        cache = testing.ResultCache(path)
+        self.assertEquals(cache.get('1000@1', 'a-test', key), results)
+        self.assertEquals(cache.get('1000@1', 'a-test', testing.cache_key('(ns a-test) ', '1')), None)
+
+        # ...but not the REPL.
+        self.assertEquals(cache.get('2000@1', 'a-test', key), None)
+
+    def test_cache_per_repl(self):
+        path = os.path.join(tempfile.mkdtemp(), 'test-results.json')
+        cache = testing.ResultCache(path)
+        key = testing.cache_key('(ns a-test)', '1')
+
+        for epoch in range(testing.MAX_EPOCHS + 1):
+            cache.put(str(epoch), 'a-test', key, {'tests': [], 'errors': [epoch]})
+
+        # Results from one REPL don't clear the ones from another...
+        self.assertEquals(cache.get('1', 'a-test', key), {'tests': [], 'errors': [1]})
+        self.assertEquals(cache.get(str(testing.MAX_EPOCHS), 'a-test', key)['errors'], [testing.MAX_EPOCHS])
+
+        # ...but the REPL seen least recently goes.
+        self.assertEquals(cache.get('0', 'a-test', key), None)
+
+    def test_state_code(self):
+        code = testing.state_code('a-test')
+        self.assertIn("(find-ns 'a-test)", code)
+        self.assertIn('(all-ns)', code)
+        self.assertNotIn('{json}', code)
+        self.assertNotIn('slurp', code)
@@ -0,0 +1,73 @@
+from unittest import TestCase
+
+from tutkain import tokenizer
+
+
+def tokens(text):
+    return [
+        (token.kind, text[token.start:token.end])
+        for token in tokenizer.significant(text)
+    ]
+
+
+class TestTokenizer(TestCase):
+    def test_covers_text(self):
+        text = '(defn f [x] ; hi\n  {:a "b" \\c #"d"})'
+        found = list(tokenizer.tokenize(text))
+
+        self.assertEquals(found[0].start, 0)
+        self.assertEquals(found[-1].end, len(text))
+
+        for a, b in zip(found, found[1:]):
+            self.assertEquals(a.end, b.start)
+
+    def test_chars(self):
+        self.assertEquals(
+            tokens('[\\( \\) \\newline \\u0041 \\" \\;]'),
+            [
+                ('open', '['),
+                ('char', '\\('),
+                ('char', '\\)'),
+                ('char', '\\newline'),
+                ('char', '\\u0041'),
+                ('char', '\\"'),
+                ('char', '\\;'),
+                ('close', ']')
+            ]
+        )
+
+    def test_strings_and_regexes(self):
+        self.assertEquals(
+            tokens('"a\\"(" #"[)]\\"" "never'),
+            [('string', '"a\\"("'), ('regex', '#"[)]\\""'), ('string', '"never')]
+        )
+
+        # A string that ends in a backslash runs to the end of the text.
+        self.assertEquals(tokens('"a\\'), [('string', '"a\\')])
+
+    def test_comments(self):
+        self.assertEquals(
+            [token.kind for token in tokenizer.tokenize('a ; (b\nc')],
+            ['atom', 'whitespace', 'comment', 'whitespace', 'atom']
+        )
+
+    def test_reader_macros(self):
+        self.assertEquals(
+            tokens("#_a ^:m #?(:clj 1) #?@(2) #(%) #{} #:a{} #inst \"x\" ##Inf @a ~@b 'c `d #'e"),
+            [
+                ('discard', '#_'), ('atom', 'a'),
+                ('meta', '^'), ('atom', ':m'),
+                ('prefix', '#?'), ('open', '('), ('atom', ':clj'), ('atom', '1'), ('close', ')'),
+                ('prefix', '#?@'), ('open', '('), ('atom', '2'), ('close', ')'),
+                ('prefix', '#'), ('open', '('), ('atom', '%'), ('close', ')'),
+                ('prefix', '#'), ('open', '{'), ('close', '}'),
+                ('prefix', '#:a'), ('open', '{'), ('close', '}'),
+                ('tag', '#inst'), ('string', '"x"'),
+                ('atom', '##Inf'),
+                ('prefix', '@'), ('atom', 'a'),
+                ('prefix', '~@'), ('atom', 'b'),
+                ('prefix', "'"), ('atom', 'c'),
+                ('prefix', '`'), ('atom', 'd'),
+                ('prefix', "#'"), ('atom', 'e')
+            ]
+        )
@@ -79,6 +79,71 @@ class TestCommands(TestCase):
 4
 ''')
 
+    def test_evaluate_view_form_by_form(self):
+        append_to_view(self.view, '(ns app.core) (defn square [x] (* x x))')
+        self.view.run_command('tutkain_evaluate_view', {'mode': 'forms'})
+        time.sleep(self.delay)
+
+        self.assertEquals(
+            tutkain.region_content(self.output_panel),
+            ''';; Loading view...\n'''
+        )
+
+    def test_evaluate_view_form_by_form_stops_at_error(self):
+        append_to_view(self.view, '(ns app.stop) (throw (Exception. "Boom")) (def after 1)')
+        self.view.run_command('tutkain_evaluate_view', {'mode': 'forms'})
+        time.sleep(self.delay)
+
+        # The form after the one that failed never got evaluated.
+        self.view.window().run_command('tutkain_clear_output_panel')
+        self.view.run_command('select_all')
+        self.view.run_command('right_delete')
+        append_to_view(self.view, "(resolve 'app.stop/after)")
+        move_cursor(self.view, 0)
+        self.view.run_command('tutkain_evaluate_form')
+        time.sleep(self.delay)
+
+        self.assertEquals(
+            tutkain.region_content(self.output_panel),
+            ''';; => (resolve 'app.stop/after)\nnil\n'''
+        )
+
+    def test_evaluate_changed_forms(self):
+        append_to_view(self.view, '(ns app.changed) (def x 1)')
+        self.view.run_command('tutkain_evaluate_changed_forms')
+        time.sleep(self.delay)
+
+        append_to_view(self.view, ' (def y 2)')
+        self.view.run_command('tutkain_evaluate_changed_forms')
+        time.sleep(self.delay)
+
+        self.assertEquals(
+            tutkain.region_content(self.output_panel),
+            ''';; Evaluating 2 changed forms...
+;; Evaluating 1 changed forms...
+'''
+        )
+
+    def test_evaluate_changed_forms_after_reconnecting(self):
+        append_to_view(self.view, '(ns app.reconnected) (def x 1)')
+        self.view.run_command('tutkain_evaluate_changed_forms')
+        time.sleep(self.delay)
+
+        # There's no telling whether the REPL we connect to next has any of
+        # the forms, so they all count as changed again.
+        self.view.window().run_command('tutkain_disconnect')
+        self.view.window().run_command('tutkain_connect', {'host': 'localhost', 'port': 1234})
+        time.sleep(1)
+
+        self.view.window().run_command('tutkain_clear_output_panel')
+        self.view.run_command('tutkain_evaluate_changed_forms')
+        time.sleep(self.delay)
+
+        self.assertEquals(
+            tutkain.region_content(self.output_panel),
+            ''';; Evaluating 2 changed forms...\n'''
+        )
+
     def test_evaluate_view_with_error(self):
         content = '''(ns app.core) (inc "a")'''
         append_to_view(self.view, content)
@@ -101,9 +166,14 @@ class TestCommands(TestCase):
         self.view.run_command('tutkain_run_tests_in_current_namespace')
         time.sleep(self.delay)
 
-        self.assertEquals(
-            tutkain.region_content(self.output_panel).splitlines()[-1],
-            '''{:test 2, :pass 1, :fail 1, :error 0, :type :summary}'''
+        self.assertRegex(
+            tutkain.region_content(self.output_panel),
+            r'FAIL in app\.core-test/nok.*\nexpected: \(= 3 \(\+ 1 1\)\)\n'
+        )
+
+        self.assertRegex(
+            tutkain.region_content(self.output_panel),
+            r'Ran 2 tests in 1 namespaces \(\d+ ms\): 1 assertions passed, 1 failed, 0 errors\.\n*$'
         )
 
     def test_run_test_in_current_namespace_with_error(self):
@@ -0,0 +1,70 @@
+'''
+Splits Clojure source code into tokens.
+
+Doesn't need Sublime Text, so it doesn't depend on the syntax definition you
+have installed, works on any string and you can test it without an editor.
+It also scans the whole text with one regular expression instead of
+looking at one character at a time.
+'''
+import collections
+import re
+
+
+# A token: what kind it is and where it starts and ends in the text.
+#
+# The kinds are:
+#
+# - whitespace: whitespace and commas
+# - comment: from a ; to the end of the line
+# - string: a string, or the rest of the text if it never ends
+# - regex: a regular expression literal such as #"[()]"
+# - char: a character literal such as \a, \( or \newline
+# - discard: the #_ that discards the form after it
+# - meta: the ^ of the metadata that goes on the form after the one after it
+# - prefix: something that goes on the form after it, such as ', `, ~@,
+#   @, #', #?, #?@, the # of #( and #{, or the #:ns of a namespaced map
+# - tag: the tag of a tagged literal such as #inst
+# - open: an opening bracket
+# - close: a closing bracket
+# - atom: a symbol, keyword, number or anything else
+Token = collections.namedtuple('Token', ['kind', 'start', 'end'])
+
+DELIMITERS = r'\s,;"()\[\]{}'
+
+TOKEN = re.compile(
+    r'''
+      (?P<whitespace>[\s,]+)
+    | (?P<comment>;[^\n]*)
+    | (?P<string>"[^"\\]*(?:\\.?[^"\\]*)*"?)
+    | (?P<regex>\#"[^"\\]*(?:\\.?[^"\\]*)*"?)
+    | (?P<char>\\(?:[a-zA-Z][a-zA-Z0-9]*|.)?)
+    | (?P<discard>\#_)
+    | (?P<meta>\#?\^)
+    | (?P<prefix>~@|[`'~@]|\#\?@|\#[?'=]|\#(?=[({{])|\#::?[^{d}]*)
+    | (?P<tag>\#[^\#{d}][^{d}]*)
+    | (?P<open>[(\[{{])
+    | (?P<close>[)\]}}])
+    | (?P<atom>[^{d}]+)
+    '''.format(d=DELIMITERS),
+    re.VERBOSE | re.DOTALL
+)
+
+# The tokens that aren't forms and don't go on a form.
+INSIGNIFICANT = {'whitespace', 'comment'}
+
+
+def tokenize(text, start=0, end=None):
+    '''Yield every token in `text` between `start` and `end`, in order.'''
+    if end is None:
+        end = len(text)
+
+    for match in TOKEN.finditer(text, start, end):
+        yield Token(match.lastgroup, match.start(), match.end())
+
+
+def significant(text, start=0, end=None):
+    '''Yield every token in `text` between `start` and `end` that isn't
+    whitespace or a comment.'''
+    for token in tokenize(text, start, end):
+        if token.kind not in INSIGNIFICANT:
+            yield token
@@ -1,24 +1,39 @@
 import os
+import socket
 import sublime
 import sublime_plugin
+import tempfile
+import time
+from concurrent.futures import CancelledError
 from threading import Thread
 
 from . import brackets
+from . import engine
 from . import formatter
+from . import forms
+from . import latency
 from . import sessions
-from .log import enable_debug, log
-from .repl import Client
+from . import testing
+from .log import DEBUG, enable_debug, log, recorder, start_writer, stop_writer
+from .repl import AF_UNIX, Client, OrderedOutput, is_done
+
+
+def settings():
+    return sublime.load_settings('{}.sublime-settings'.format('tutkain'))
 
 
 def plugin_loaded():
-    settings = sublime.load_settings('{}.sublime-settings'.format('tutkain'))
+    start_writer()
+    recorder.resize(settings().get('flight_recorder_size', 1000))
 
-    if settings.get('debug', False):
+    if settings().get('debug', False):
         enable_debug()
 
 
 def plugin_unloaded():
     sessions.wipe()
+    engine.stop()
+    stop_writer()
 
 
 def print_characters(panel, characters):
@@ -46,6 +61,81 @@ def region_content(view):
     return view.substr(sublime.Region(0, view.size()))
 
 
+# The client of the REPL that last evaluated top-level forms of every view
+# and those forms as they were then, by view ID.
+evaluated = {}
+
+# The top-level forms of every view that hasn't changed since we last looked
+# for them, and the change count of the view then, by view ID.
+parsed = {}
+
+
+def evaluated_forms(view, client):
+    '''Return the forms of `view` the REPL of `client` has evaluated.
+
+    A REPL we've connected to since knows nothing of the forms an earlier
+    one evaluated, so the forms start over with every connection.'''
+    client_then, tracker = evaluated.get(view.id(), (None, None))
+
+    if client_then is not client:
+        tracker = forms.Evaluated()
+        evaluated[view.id()] = (client, tracker)
+
+    return tracker
+
+
+def top_level_forms(view, text):
+    change_count = view.change_count()
+    change_count_then, found = parsed.get(view.id(), (None, None))
+
+    if change_count_then != change_count:
+        found = forms.top_level_forms(text)
+        parsed[view.id()] = (change_count, found)
+
+    return found
+
+
+def forget_evaluated(client):
+    '''Forget the forms the REPL of `client` has evaluated.'''
+    for view_id, (client_then, _) in list(evaluated.items()):
+        if client_then is client:
+            evaluated.pop(view_id, None)
+
+
+def remember_evaluated(view, client, codes):
+    '''Return a done callback for the future of an op that evaluates `codes`
+    on the REPL of `client` that remembers them as evaluated if the op
+    succeeded.'''
+    def done(future):
+        if future.exception() is None and not future.result().failed:
+            tracker = evaluated_forms(view, client)
+
+            for code in codes:
+                tracker.add(code)
+
+    return done
+
+
+def eval_ops(view, text, found, ns=None):
+    '''Return an eval op for each form in `found`, with where it is in the
+    view.'''
+    path = view.file_name()
+    ops = []
+
+    for form in found:
+        op = {'op': 'eval', 'code': text[form.start:form.end], 'line': form.line, 'column': form.column}
+
+        if path:
+            op['file'] = path
+
+        if ns:
+            op['ns'] = ns
+
+        ops.append(op)
+
+    return ops
+
+
 class TutkainClearOutputPanelCommand(sublime_plugin.WindowCommand):
     def run(self):
         panel = self.window.find_output_panel('tutkain')
@@ -56,49 +146,128 @@ class TutkainClearOutputPanelCommand(sublime_plugin.WindowCommand):
 
 
 class TutkainEvaluateFormCommand(sublime_plugin.TextCommand):
+    def regions(self):
+        '''Return every selection, or the form around every cursor, in the
+        order they're in the view, without duplicates.'''
+        selections = sorted(self.view.sel(), key=lambda region: region.begin())
+        cursors = [region.begin() for region in selections if region.empty()]
+        forms = iter(brackets.current_form_regions(self.view, cursors))
+        regions = []
+        seen = set()
+
+        for region in selections:
+            if region.empty():
+                region = next(forms)
+
+            if region is not None and (region.begin(), region.end()) not in seen:
+                seen.add((region.begin(), region.end()))
+                regions.append(region)
+
+        return regions
+
     def run(self, edit):
         window = self.view.window()
         session = sessions.get_by_owner(window.id(), 'user')
 
         if session is None:
             window.status_message('ERR: Not connected to a REPL.')
-        else:
-            for region in self.view.sel():
-                eval_region = region if not region.empty() else (
-                    brackets.current_form_region(
-                        self.view,
-                        region.begin()
-                    )
-                )
+            return
 
-                code = self.view.substr(eval_region)
+        codes = [self.view.substr(region) for region in self.regions()]
 
-                session.output({'out': '=> {}\n'.format(code)})
+        if not codes:
+            window.status_message('No form to evaluate.')
+            return
 
-                log.debug({
-                    'event': 'send',
-                    'scope': 'form',
-                    'code': code
-                })
+        log.debug({
+            'event': 'send',
+            'scope': 'form',
+            'codes': codes
+        })
 
-                session.send(
-                    {'op': 'eval', 'code': code},
-                    handler=lambda response: (
-                        session.output({'append': '\n'})
-                        if response.get('status') == ['done']
-                        else session.output(response)
-                    )
-                )
+        # Send every form at once, and print the results of each one under
+        # its echo, in the order the forms are in.
+        output = OrderedOutput(session, [{'out': '=> {}\n'.format(code)} for code in codes])
+
+        futures = session.request_all(
+            [{'op': 'eval', 'code': code} for code in codes],
+            max_in_flight=len(codes),
+            handlers=[output.handler(n) for n in range(len(codes))]
+        )
+
+        for code, future in zip(codes, futures):
+            future.add_done_callback(remember_evaluated(self.view, session.client, [code]))
 
 
 class TutkainEvaluateViewCommand(sublime_plugin.TextCommand):
     def handler(self, session, response):
-        if response.get('value'):
+        if 'value' in response:
             pass
         else:
             session.output(response)
 
-    def run(self, edit):
+    def load_file(self, session, text):
+        op = {'op': 'load-file', 'file': text}
+        path = self.view.file_name()
+
+        if path:
+            op['file-name'] = os.path.basename(path)
+            op['file-path'] = path
+
+        codes = [text[form.start:form.end] for form in top_level_forms(self.view, text)]
+
+        session.request(
+            op,
+            handler=lambda response: self.handler(session, response)
+        ).add_done_callback(remember_evaluated(self.view, session.client, codes))
+
+    def point_at(self, form):
+        view = self.view
+        view.sel().clear()
+        view.sel().add(sublime.Region(form.start))
+        view.show_at_center(form.start)
+
+    def evaluate_forms(self, session, text):
+        window = self.view.window()
+        found = top_level_forms(self.view, text)
+        ops = eval_ops(self.view, text, found)
+        tracker = evaluated_forms(self.view, session.client)
+
+        # Send the next form only once the one before it has succeeded, so
+        # that nothing after a form that fails gets evaluated.
+        futures = session.request_all(
+            ops,
+            max_in_flight=1,
+            stop=lambda result: result.failed
+        )
+
+        for n, (form, future) in enumerate(zip(found, futures), 1):
+            try:
+                result = future.result()
+            except CancelledError:
+                break
+            except Exception as e:
+                session.output({'err': 'Evaluation failed: {}\n'.format(e)})
+                return
+
+            window.status_message('Evaluated {} of {} forms...'.format(n, len(found)))
+
+            for response in result.responses:
+                self.handler(session, response)
+
+            if result.failed:
+                session.output({
+                    'err': 'Evaluation stopped at line {}, column {}.\n'.format(form.line, form.column)
+                })
+
+                sublime.set_timeout(lambda: self.point_at(form), 0)
+                return
+
+            tracker.add(text[form.start:form.end])
+
+        window.status_message('Evaluated {} forms.'.format(len(found)))
+
+    def run(self, edit, mode=None):
         window = self.view.window()
         session = sessions.get_by_owner(window.id(), 'user')
 
@@ -106,56 +275,356 @@ class TutkainEvaluateViewCommand(sublime_plugin.TextCommand):
             window.status_message('ERR: Not connected to a REPL.')
         else:
             session.output({'out': 'Loading view...\n'})
+            text = region_content(self.view)
 
-            session.send(
-                {'op': 'eval', 'code': region_content(self.view)},
-                handler=lambda response: self.handler(session, response)
-            )
+            if (mode or settings().get('evaluate_view_mode', 'load-file')) == 'forms':
+                evaluate_forms = Thread(
+                    daemon=True,
+                    target=self.evaluate_forms,
+                    args=(session, text)
+                )
+
+                evaluate_forms.name = 'tutkain.evaluate_forms'
+                evaluate_forms.start()
+            else:
+                self.load_file(session, text)
+
+
+class TutkainEvaluateChangedFormsCommand(sublime_plugin.TextCommand):
+    def evaluate(self, session, text, changed, ns):
+        tracker = evaluated_forms(self.view, session.client)
+        ops = eval_ops(self.view, text, changed, ns)
+
+        # Send them all at once.
+        futures = session.request_all(ops, max_in_flight=len(ops))
+        failed = 0
+
+        for form, future in zip(changed, futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                session.output({'err': 'Evaluation failed: {}\n'.format(e)})
+                return
+
+            for response in result.responses:
+                if 'value' not in response:
+                    session.output(response)
+
+            if result.failed:
+                failed += 1
+                session.output({'err': 'Form at line {}, column {} failed.\n'.format(form.line, form.column)})
+            else:
+                tracker.add(text[form.start:form.end])
+
+        self.view.window().status_message(
+            'Evaluated {} changed forms, {} failed.'.format(len(changed), failed)
+        )
+
+    def run(self, edit):
+        window = self.view.window()
+        session = sessions.get_by_owner(window.id(), 'user')
+
+        if session is None:
+            window.status_message('ERR: Not connected to a REPL.')
+            return
+
+        text = region_content(self.view)
+        found = top_level_forms(self.view, text)
+        changed = evaluated_forms(self.view, session.client).changed(text, found)
+
+        if not changed:
+            window.status_message('No forms changed since they were last evaluated.')
+            return
+
+        session.output({'out': 'Evaluating {} changed forms...\n'.format(len(changed))})
+
+        # Evaluate the forms in the view's namespace. If the ns form itself
+        # changed, it comes first and switches to the namespace, which might
+        # not exist yet.
+        ns = forms.namespace(text, found)
+
+        if forms.namespace(text, changed[:1]):
+            ns = None
+
+        evaluate = Thread(
+            daemon=True,
+            target=self.evaluate,
+            args=(session, text, changed, ns)
+        )
+
+        evaluate.name = 'tutkain.evaluate_changed_forms'
+        evaluate.start()
+
+
+def print_output(session, response, values=True):
+    if not is_done(response) and (values or 'value' not in response):
+        session.output(response)
+
+
+def report_results(window, session, results, cached=False):
+    '''Print a summary of the results of a test run and say in the status
+    bar whether every test passed.'''
+    summary = testing.summarize(results)
+    note = ' (cached)' if cached else ''
+
+    if cached:
+        session.output({'out': 'Nothing changed since the last run. Its results:\n'})
+
+    session.output({'out': testing.format_results(results)})
+    session.output({'append': '\n'})
+
+    if testing.succeeded(results):
+        window.status_message('Ran {tests} tests: all passed{note}.'.format(note=note, **summary))
+    else:
+        window.status_message(
+            'Ran {tests} tests: {fail} failed, {error} errors{note}.'.format(note=note, **summary)
+        )
+
+
+# The results of the last test run of every namespace, or None until the
+# first run.
+result_cache = None
+
+
+def test_result_cache():
+    global result_cache
+
+    if result_cache is None:
+        result_cache = testing.ResultCache(
+            os.path.join(sublime.cache_path(), 'Tutkain', 'test-results.json')
+        )
+
+    return result_cache
+
+
+def test_state(session, ns):
+    '''Return the epoch of the REPL and a hash of the namespaces it has
+    loaded other than `ns`, or None if the REPL can't tell.'''
+    result = session.request({'op': 'eval', 'code': testing.state_code(ns)}).result()
+
+    if result.failed or result.value is None:
+        return None
+
+    return testing.parse(result.value)
 
 
 class TutkainRunTestsInCurrentNamespaceCommand(sublime_plugin.TextCommand):
-    def evaluate_view(self, session, response):
-        if response.get('status') == ['done']:
-            session.send(
-                {'op': 'eval', 'code': region_content(self.view)},
-                handler=lambda response: self.run_tests(session, response)
-            )
+    '''Run the tests in the namespace of the view.
 
-    def run_tests(self, session, response):
-        if response.get('status') == ['eval-error']:
-            session.denounce(response)
-        elif response.get('status') == ['done']:
-            if not session.is_denounced(response):
-                session.send(
-                    {'op': 'eval',
-                     'code': '((requiring-resolve \'clojure.test/run-tests))'},
-                    handler=lambda response: (
-                        session.output({'append': '\n'})
-                        if response.get('status') == ['done']
-                        else session.output(response)
-                    )
+    If neither the view nor anything else the REPL has loaded has changed
+    since the last run on the same REPL, print the results of that run
+    instead, unless `force` is true.'''
+
+    def cached_results(self, session, ns, code):
+        state = test_state(session, ns)
+
+        if state is None:
+            return None
+
+        return test_result_cache().get(
+            state['epoch'], ns, testing.cache_key(code, state['state'])
+        )
+
+    def cache_results(self, session, ns, code, results):
+        state = test_state(session, ns)
+
+        if state is not None:
+            cache = test_result_cache()
+            cache.put(state['epoch'], ns, testing.cache_key(code, state['state']), results)
+
+            try:
+                cache.save()
+            except OSError as e:
+                log.error({'event': 'error', 'exception': e})
+
+    def run_tests(self, session, code, force):
+        window = self.view.window()
+        found = top_level_forms(self.view, code)
+        ns = forms.namespace(code, found)
+
+        if ns and not force:
+            results = self.cached_results(session, ns, code)
+
+            if results is not None:
+                report_results(window, session, results, cached=True)
+                return
+
+        session.request({
+            'op': 'eval',
+            'code': '''
+                    (run! (fn [[sym _]] (ns-unmap *ns* sym))
+                          (ns-publics *ns*))
+                    '''
+        }).result()
+
+        result = session.request(
+            {'op': 'eval', 'code': code},
+            handler=lambda response: print_output(session, response, values=False)
+        ).result()
+
+        if not result.failed:
+            try:
+                results = testing.run_tests(
+                    session,
+                    testing.run_tests_code(),
+                    handler=lambda response: print_output(session, response, values=False)
                 )
-        elif response.get('value'):
-            pass
+            except RuntimeError as e:
+                window.status_message('ERR: could not run tests: {}'.format(e))
+            else:
+                report_results(window, session, results)
+
+                if ns:
+                    self.cache_results(session, ns, code, results)
+
+    def run(self, edit, force=False):
+        window = self.view.window()
+        session = sessions.get_by_owner(window.id(), 'plugin')
+
+        if session is None:
+            window.status_message('ERR: Not connected to a REPL.')
         else:
-            session.output(response)
+            run_tests = Thread(
+                daemon=True,
+                target=self.run_tests,
+                args=(session, region_content(self.view), force)
+            )
+
+            run_tests.name = 'tutkain.run_tests'
+            run_tests.start()
+
+
+class TutkainRunTestsUnderCursorCommand(sublime_plugin.TextCommand):
+    '''Run the deftest under every cursor, or every deftest a selection
+    touches.'''
+
+    def run_tests(self, session, ops, ns, names):
+        window = self.view.window()
+
+        # Evaluate the deftest forms first, so that the tests that run are
+        # the ones in the view.
+        for future in session.request_all(ops, stop=lambda result: result.failed):
+            try:
+                result = future.result()
+            except CancelledError:
+                return
+
+            if result.failed:
+                for response in result.responses:
+                    print_output(session, response)
+
+                window.status_message('ERR: could not evaluate the tests.')
+                return
+
+        try:
+            results = testing.run_tests(
+                session,
+                testing.run_tests_code(ns, names),
+                handler=lambda response: print_output(session, response, values=False)
+            )
+        except RuntimeError as e:
+            window.status_message('ERR: could not run tests: {}'.format(e))
+        else:
+            report_results(window, session, results)
 
     def run(self, edit):
         window = self.view.window()
         session = sessions.get_by_owner(window.id(), 'plugin')
 
+        if session is None:
+            window.status_message('ERR: Not connected to a REPL.')
+            return
+
+        text = region_content(self.view)
+        found = top_level_forms(self.view, text)
+        regions = [(region.begin(), region.end()) for region in self.view.sel()]
+        tests = testing.tests_in(text, regions, found)
+
+        if not tests:
+            window.status_message('No deftest under the cursor.')
+            return
+
+        ns = forms.namespace(text, found)
+
+        run_tests = Thread(
+            daemon=True,
+            target=self.run_tests,
+            args=(
+                session,
+                eval_ops(self.view, text, [form for form, _ in tests], ns),
+                ns,
+                [name for _, name in tests]
+            )
+        )
+
+        run_tests.name = 'tutkain.run_tests'
+        run_tests.start()
+
+
+class NamespacesInputHandler(sublime_plugin.TextInputHandler):
+    def placeholder(self):
+        return 'Namespaces, separated by spaces'
+
+    def validate(self, text):
+        return len(text.split()) > 0
+
+
+class TutkainRunTestsInNamespacesCommand(sublime_plugin.WindowCommand):
+    '''Require and run the tests in several namespaces at once, spread over
+    sessions cloned for the run.'''
+
+    def run_tests(self, session, namespaces):
+        window = self.window
+        count = min(len(namespaces), settings().get('test_parallelism', 4))
+
+        window.status_message('Running tests in {} namespaces...'.format(len(namespaces)))
+
+        try:
+            clones = session.client.clone_sessions(count, timeout=settings().get('handshake_timeout'))
+        except (TimeoutError, ConnectionError) as e:
+            window.status_message('ERR: could not clone sessions: {}'.format(e))
+            return
+
+        try:
+            results = testing.run_namespaces(
+                clones,
+                namespaces,
+                handler=lambda response: print_output(session, response, values=False)
+            )
+        finally:
+            for clone in clones:
+                clone.close()
+
+        report_results(window, session, testing.merge(results[ns] for ns in namespaces))
+
+    def run(self, namespaces):
+        window = self.window
+        session = sessions.get_by_owner(window.id(), 'plugin')
+
+        if isinstance(namespaces, str):
+            namespaces = namespaces.split()
+
         if session is None:
             window.status_message('ERR: Not connected to a REPL.')
         else:
-            session.send(
-                {'op': 'eval',
-                 'code': '''
-                         (run! (fn [[sym _]] (ns-unmap *ns* sym))
-                               (ns-publics *ns*))
-                         '''},
-                handler=lambda response: self.evaluate_view(session, response)
+            run_tests = Thread(
+                daemon=True,
+                target=self.run_tests,
+                args=(session, list(namespaces))
             )
 
+            run_tests.name = 'tutkain.run_tests'
+            run_tests.start()
+
+    def input(self, args):
+        return NamespacesInputHandler()
+
+
+def is_port(text):
+    '''Return True if `text` is a port number or the path of a Unix domain
+    socket, if the platform has them.'''
+    return text.isdigit() or (AF_UNIX is not None and os.path.exists(os.path.expanduser(text)))
+
 
 class HostInputHandler(sublime_plugin.TextInputHandler):
     def __init__(self, window):
@@ -172,7 +641,13 @@ class HostInputHandler(sublime_plugin.TextInputHandler):
 
     def read_port(self, path):
         with open(path, 'r') as file:
-            return (path, file.read())
+            port = file.read().strip()
+
+        # A socket path is relative to the folder the file is in.
+        if not port.isdigit():
+            port = os.path.join(os.path.dirname(path), os.path.expanduser(port))
+
+        return (path, port)
 
     def discover_ports(self):
         # I mean, this is Pythonic, right...?
@@ -208,10 +683,10 @@ class PortInputHandler(sublime_plugin.TextInputHandler):
         return 'port'
 
     def placeholder(self):
-        return 'Port'
+        return 'Port or socket path'
 
     def validate(self, text):
-        return text.isdigit()
+        return is_port(text)
 
     def initial_text(self):
         return self.default_value
@@ -225,7 +700,7 @@ class PortsInputHandler(sublime_plugin.ListInputHandler):
         return 'port'
 
     def validate(self, text):
-        return text.isdigit()
+        return is_port(text)
 
     def contract_path(self, path):
         return path.replace(os.path.expanduser('~'), '~')
@@ -265,7 +740,7 @@ class TutkainEvaluateInputCommand(sublime_plugin.WindowCommand):
                 {'op': 'eval', 'code': code},
                 handler=lambda response: (
                     session.output({'append': '\n'})
-                    if response.get('status') == ['done']
+                    if is_done(response)
                     else session.output(response)
                 )
             )
@@ -306,58 +781,149 @@ class TutkainConnectCommand(sublime_plugin.WindowCommand):
             if item is None:
                 break
 
-            log.debug({'event': 'printer/recv', 'data': item})
+            if log.isEnabledFor(DEBUG):
+                log.debug({'event': 'printer/recv', 'data': item})
 
             append_to_output_panel(self.window, item)
 
         log.debug({'event': 'thread/exit'})
 
-    def run(self, host, port):
+    def connect(self, host, port):
         window = self.window
+        address = '{}:{}'.format(host, port) if port.isdigit() else port
+        socket_options = settings().get('socket_options', {})
+
+        client = Client(
+            host,
+            port,
+            stream_threshold=settings().get('stream_threshold'),
+            limits=settings().get('decoder_limits', {}),
+            recvq_size=settings().get('output_queue_size', 256),
+            overflow=settings().get('output_overflow', 'block'),
+            handler_ttl=settings().get('handler_ttl'),
+            nodelay=socket_options.get('nodelay', True),
+            send_buffer_size=socket_options.get('send_buffer_size'),
+            receive_buffer_size=socket_options.get('receive_buffer_size')
+        )
 
-        try:
-            client = Client(host, int(port)).go()
+        started = time.monotonic()
 
-            plugin_session = client.clone_session()
-            sessions.register(window.id(), 'plugin', plugin_session)
+        try:
+            window.status_message('Connecting to {}...'.format(address))
+            client.go(timeout=settings().get('connect_timeout'))
+        except ConnectionRefusedError:
+            window.status_message('ERR: connection to {} refused.'.format(address))
+            return
+        except (TimeoutError, socket.timeout):
+            window.status_message('ERR: connection to {} timed out.'.format(address))
+            return
+        except OSError as e:
+            window.status_message('ERR: could not connect to {}: {}'.format(address, e))
+            return
 
-            user_session = client.clone_session()
-            sessions.register(window.id(), 'user', user_session)
+        connected = time.monotonic()
 
-            # Create an output panel for printing evaluation results and show
-            # it.
-            self.configure_output_panel()
+        try:
+            window.status_message('Connected to {}, cloning sessions...'.format(address))
 
-            # Start a worker thread that reads items from a queue and prints
-            # them into an output panel.
-            print_loop = Thread(
-                daemon=True,
-                target=self.print_loop,
-                args=(client.recvq,)
+            (plugin_session, user_session), describe = client.handshake(
+                timeout=settings().get('handshake_timeout')
             )
-            print_loop.name = 'tutkain.print_loop'
-            print_loop.start()
+        except (TimeoutError, ConnectionError) as e:
+            client.abort()
+            window.status_message('ERR: handshake with {} failed: {}'.format(address, e))
+            return
 
-            plugin_session.output(
-                {'out': 'Connected to {}:{}.\n'.format(host, port)}
-            )
+        finished = time.monotonic()
 
-            plugin_session.client.sendq.put({'op': 'describe'})
-        except ConnectionRefusedError:
-            window.status_message(
-                'ERR: connection to {}:{} refused.'.format(host, port)
+        log.debug({
+            'event': 'client/handshake',
+            'connect_ms': (connected - started) * 1000,
+            'handshake_ms': (finished - connected) * 1000
+        })
+
+        sessions.register(window.id(), 'plugin', plugin_session)
+        sessions.register(window.id(), 'user', user_session)
+
+        # Create an output panel for printing evaluation results and show
+        # it.
+        self.configure_output_panel()
+
+        # Start a worker thread that reads items from a queue and prints
+        # them into an output panel.
+        print_loop = Thread(
+            daemon=True,
+            target=self.print_loop,
+            args=(client.recvq,)
+        )
+        print_loop.name = 'tutkain.print_loop'
+        print_loop.start()
+
+        plugin_session.output({
+            'out': 'Connected to {} in {:.0f} ms (connect {:.0f} ms, handshake {:.0f} ms).\n'.format(
+                address,
+                (finished - started) * 1000,
+                (connected - started) * 1000,
+                (finished - connected) * 1000
             )
+        })
+
+        versions = describe.get('versions')
+
+        if versions:
+            plugin_session.output({'versions': versions})
+
+        window.status_message('Connected to {}.'.format(address))
+
+    def run(self, host, port):
+        # Connecting can take a while, so do it off the UI thread.
+        connect = Thread(daemon=True, target=self.connect, args=(host, str(port)))
+        connect.name = 'tutkain.connect'
+        connect.start()
 
     def input(self, args):
         return HostInputHandler(self.window)
 
 
+def export_latency(client):
+    path = settings().get('latency_export_path')
+
+    if path:
+        latency.export(client.latency.report(), os.path.expanduser(path))
+
+
+class TutkainShowLatencyCommand(sublime_plugin.WindowCommand):
+    def run(self):
+        session = sessions.get_by_owner(self.window.id(), 'plugin')
+
+        if session is None:
+            self.window.status_message('ERR: Not connected to a REPL.')
+        else:
+            report = session.client.latency.report()
+            session.output({'out': latency.format_report(report)})
+            export_latency(session.client)
+
+
+class TutkainDumpFlightRecorderCommand(sublime_plugin.WindowCommand):
+    def run(self):
+        path = os.path.join(
+            tempfile.gettempdir(),
+            'tutkain-flight-recorder-{}.jsonl'.format(time.strftime('%Y%m%d-%H%M%S'))
+        )
+
+        n = recorder.dump(path)
+        self.window.open_file(path)
+        self.window.status_message('Wrote {} events into {}.'.format(n, path))
+
+
 class TutkainDisconnectCommand(sublime_plugin.WindowCommand):
     def run(self):
         window = self.window
         session = sessions.get_by_owner(window.id(), 'plugin')
 
         if session is not None:
+            export_latency(session.client)
+            forget_evaluated(session.client)
             session.output({'out': 'Disconnecting...\n'})
             session.terminate()
             user_session = sessions.get_by_owner(window.id(), 'user')
@@ -381,31 +947,73 @@ class TutkainListenerCommand(sublime_plugin.EventListener):
             syntax = view.settings().get('syntax')
             return 'Clojure' in syntax or 'Markdown' in syntax
 
+    def on_modified_async(self, view):
+        # The forms we found in the view might be gone now.
+        parsed.pop(view.id(), None)
+
+    def on_close(self, view):
+        parsed.pop(view.id(), None)
+        evaluated.pop(view.id(), None)
+        brackets.forget_index(view)
+
+
+# Sublime Text 4 tells us what changed, so we can keep the structure index of
+# a buffer up to date as it changes. Sublime Text 3 doesn't, so there the
+# index gets built again once the buffer has changed.
+if hasattr(sublime_plugin, 'TextChangeListener'):
+    class TutkainTextChangeListener(sublime_plugin.TextChangeListener):
+        def on_text_changed(self, changes):
+            view = self.buffer.primary_view()
+
+            if len(changes) == 1:
+                brackets.update_index(view, changes[0])
+            else:
+                # Each change is relative to the text as it was after the
+                # one before it, and we only have the text after all of
+                # them.
+                brackets.forget_index(view)
+
 
 class TutkainExpandSelectionCommand(sublime_plugin.TextCommand):
     def run(self, edit):
         view = self.view
         selection = view.sel()
+        regions = sorted(selection, key=lambda region: region.begin())
+
+        # The cursors next to a character that delimits a Clojure form
+        # select that form.
+        anchors = [
+            region.begin() for region in regions
+            if region.empty() and brackets.is_next_to_expand_anchor(view, region.begin())
+        ]
+
+        forms = [
+            form if form is not None else sublime.Region(point)
+            for point, form in zip(anchors, brackets.current_form_regions(view, anchors))
+        ]
+
+        # Every other selection expands to the scope around it.
+        rest = []
 
-        # TODO: Add proper support for multiple cursors.
-        for region in selection:
+        for region in regions:
             pos = region.begin()
 
-            if not region.empty():
-                view.run_command('expand_selection', {'to': 'scope'})
+            if region.empty() and pos in anchors:
+                continue
+            # If the next character is a double quote, move the cursor to
+            # within the string before expanding.
+            elif region.empty() and brackets.char_range(view, pos, pos + 1) == '"':
+                rest.append(sublime.Region(pos + 1))
             else:
-                # If we're next to a character that delimits a Clojure form
-                if brackets.is_next_to_expand_anchor(view, pos):
-                    selection.add(brackets.current_form_region(view, pos))
-                # If the next character is a double quote
-                elif brackets.char_range(view, pos, pos + 1) == '"':
-                    # Move cursor to within string
-                    selection.add(sublime.Region(pos + 1))
-
-                    # Then expand
-                    view.run_command('expand_selection', {'to': 'scope'})
-                else:
-                    view.run_command('expand_selection', {'to': 'scope'})
+                rest.append(region)
+
+        selection.clear()
+
+        if rest:
+            selection.add_all(rest)
+            view.run_command('expand_selection', {'to': 'scope'})
+
+        selection.add_all(forms)
 
 
 class TutkainInterruptEvaluationCommand(sublime_plugin.WindowCommand):